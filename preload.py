@@ -12,4 +12,47 @@ def preload(parser):
         "--api-aux-auth",
         help="comma separated list of user:password for auxiliary authentication",
         default=None
-    )
\ No newline at end of file
+    )
+    # lock files let several processes sharing a model directory (i.e. over NFS) upload to it safely
+    parser.add_argument(
+        "--uploader-file-locks",
+        action="store_true",
+        help="lock uploaded paths with fcntl lock files in the model directory's staging directory, for model directories shared between processes or hosts",
+        default=False
+    )
+
+    # concurrency limits per operation class, excess requests wait in a bounded queue or get 503 with Retry-After
+    for name, default in (("uploads", 8), ("hashes", 1), ("syncs", 2), ("downloads", 2)):
+        parser.add_argument(
+            f"--uploader-max-{name}",
+            type=int,
+            help=f"maximum number of concurrent {name} of the uploader API, default {default}",
+            default=None
+        )
+    # hash new and changed models in the background, so hash queries of syncs hit the index
+    parser.add_argument(
+        "--uploader-watch-models",
+        action="store_true",
+        help="watch the model directories (with watchdog if installed, otherwise by polling) and hash new or changed files in the background",
+        default=False
+    )
+    # parallel hash streams per device, detected from the device type if not given
+    parser.add_argument(
+        "--uploader-hash-streams",
+        type=int,
+        help="number of files hashed in parallel per device, default 16 for NVMe, 8 for SSDs, 2 for network filesystems and 1 for spinning disks",
+        default=None
+    )
+    # slow full rehash of the indexed models, to find files which changed on disk without their mtime
+    parser.add_argument(
+        "--uploader-scrub-rate",
+        type=float,
+        help="enable the background integrity scrub of indexed models, reading at most this many MB/s at idle I/O priority",
+        default=None
+    )
+    parser.add_argument(
+        "--uploader-queue-size",
+        type=int,
+        help="number of requests per operation class which may wait for a slot before new ones are rejected with 503, default 16",
+        default=None
+    )
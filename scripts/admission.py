@@ -0,0 +1,133 @@
+"""
+Admission control for expensive operations.
+Uploads, hash walks, syncs and downloads each have a concurrency limit, a bounded queue of waiting requests
+and their own thread pool, so a burst of one kind of work can not starve the disk or the other endpoints.
+Requests which do not fit in the queue are rejected with 503 and Retry-After.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from typing import Callable, Dict
+from fastapi import HTTPException
+
+RETRY_AFTER_SECONDS = 5
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_LIMITS = {
+    'upload': 8,
+    'hash': 1, # hashing is bound by disk reads, parallel walks only seek more
+    'sync': 2,
+    'download': 2,
+}
+# operation class -> cmd_opts attribute of its --uploader-max-* option in preload.py
+LIMIT_OPTIONS = {
+    'upload': 'uploader_max_uploads',
+    'hash': 'uploader_max_hashes',
+    'sync': 'uploader_max_syncs',
+    'download': 'uploader_max_downloads',
+}
+
+@lru_cache(maxsize=1)
+def get_cmd_opts():
+    try:
+        from modules.shared import cmd_opts
+        return cmd_opts
+    except (ModuleNotFoundError, ImportError):
+        return None
+
+def get_limit(name:str) -> int:
+    """
+    Returns the concurrency limit of an operation class, its --uploader-max-* option overrides the default
+    """
+    value = getattr(get_cmd_opts(), LIMIT_OPTIONS[name], None)
+    return value if value else DEFAULT_LIMITS[name]
+
+def get_queue_size() -> int:
+    value = getattr(get_cmd_opts(), 'uploader_queue_size', None)
+    return DEFAULT_QUEUE_SIZE if value is None else value
+
+class OperationGate:
+    """
+    Limits how many operations of one class run at once.
+    Up to concurrency operations run, up to queue_size more wait for a slot, the rest are rejected with 503.
+    usage :
+        async with gate.admit(): ... (async work, i.e. streaming a request body)
+        await gate.run(func, *args) (admits, then runs blocking func on the gate's thread pool)
+        await gate.acquire(); ...; gate.release() (admission which outlives the request handler, i.e. a streamed response)
+    """
+    def __init__(self, name:str, concurrency:int, queue_size:int = DEFAULT_QUEUE_SIZE, retry_after:int = RETRY_AFTER_SECONDS):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f'uploader-{name}')
+
+    async def acquire(self) -> None:
+        """
+        Waits for a slot, raises HTTPException 503 if the queue is full. The slot must be given back with release().
+        """
+        # counters are only touched from the event loop, so they need no lock
+        if self.running >= self.concurrency and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail=f"Too many {self.name} operations, {self.running} running and {self.waiting} waiting, retry later",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def release(self) -> None:
+        """
+        Gives back a slot of acquire(), must be called from the event loop
+        """
+        self.running -= 1
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run_in_executor(self, func:Callable, *args, **kwargs):
+        """
+        Runs blocking func on the gate's thread pool, the caller must already be admitted
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def run(self, func:Callable, *args, **kwargs):
+        """
+        Waits for a slot, then runs blocking func on the gate's thread pool
+        """
+        async with self.admit():
+            return await self.run_in_executor(func, *args, **kwargs)
+
+    def status(self) -> dict:
+        return {
+            'concurrency': self.concurrency,
+            'queue_size': self.queue_size,
+            'running': self.running,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
+
+gates:Dict[str, OperationGate] = {}
+
+def get_gate(name:str) -> OperationGate:
+    """
+    Returns the gate of an operation class ('upload', 'hash', 'sync' or 'download'), created on first use
+    """
+    if name not in gates:
+        gates[name] = OperationGate(name, get_limit(name), get_queue_size())
+    return gates[name]
@@ -1,74 +1,64 @@
 ### accept file upload and save for relative paths
 #pip install python-multipart for fastapi.File
 import os
-import shutil
+import json
+import zlib
 import time
+import bisect
+import threading
+import posixpath
 import uuid
 import asyncio
-import json
-from contextlib import asynccontextmanager
-from fastapi import File, UploadFile, FastAPI, Form
+from typing import Dict, Iterator, List, Optional, Tuple
+from functools import partial
+from fastapi import File, UploadFile, FastAPI, Form, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import gradio as gr
 from logging import getLogger
 from scripts.download_models import download_controlnet_xl_models, download_controlnet_v11_models, download_model_by_name
 from scripts.paths import get_sd_ckpt_dir, get_vae_ckpt_dir, get_lora_ckpt_dir, get_textual_inversion_dir, basepath, get_controlnet_dir
 from scripts.auxilary_api import add_token_count_api
-from scripts.auth import secure_post, secure_get, init_auth
-from scripts.uploader import Connection
+from scripts.auth import secure_post, secure_get, secure_put, secure_delete, init_auth
+from scripts.uploader import Connection, DEFAULT_UPLOAD_CONCURRENCY
+from scripts.hashes import compute_file_hash, compute_file_digests, compute_file_fingerprint, compute_file_structure_hash, supported_algorithms, DEFAULT_ALGORITHM, DEFAULT_SIZE_TO_READ, HASH_MODES
+from scripts.streaming_upload import EncodingRejected, FileSink, UploadRejected, read_multipart
+from scripts.upload_sessions import UploadSessionStore, SessionRangeWriter
+from scripts.safetensors_header import SafetensorsError, SafetensorsStreamValidator, read_header, data_length
+from scripts.archive_upload import AsyncStreamReader, COPY_CHUNK_SIZE, open_archive_stream, extract_archive
+from scripts.staging import STAGING_DIR_NAME, get_staging_dir, check_free_space, commit_file
+from scripts.locks import path_locks
+from scripts.admission import DEFAULT_LIMITS, get_gate
+from scripts.loop_monitor import loop_monitor
+from scripts.transfer_encoding import DECODE_ERRORS, ResponseEncoder, choose_response_encoding, decode, open_decoder, supported_encodings
+from scripts.normalize import NORMALIZE_MODES, NormalizeError, get_original_hash, normalize_file, normalized_filename, register_original_hash
+from scripts.hash_index import hash_index, read_length
+from scripts.hash_scheduler import hash_files, hash_flights, iter_hash_files
+from scripts.merkle import get_merkle_tree
+from scripts.model_watcher import ModelWatcher, use_model_watcher
+from scripts.scrubber import Scrubber, get_scrub_rate
+from scripts.webui_hashes import new_upload_hasher, upload_digests, register_webui_hashes, uses_addnet_hash, wants_webui_hashes
 from scripts.api_functions_state import api_functions
 
 logger = getLogger("Auxilary API")
 OVERWRITE = False # if True, overwrites existing files
+STREAM_CHUNK_SIZE = 1 << 24 # bytes buffered before an upload session writes to disk
+STREAM_BATCH_SIZE = 1 << 20 # received bytes handed to a worker thread at once
+MAX_LISTED_FAILURES = 20 # failed paths listed in the message of a library sync
 
-# saving context, to prevent multiple threads from reading the same file
-file_locks = {}
-# atomic boolen to prevent multiple threads from saving at the same time
-is_saving = False
-class FileAccessContextManager:
-    """
-    Context Manager that locks a file path
-    """
-    def __init__(self, path):
-        self.path = path
-        self.lock = file_locks.setdefault(path, asyncio.Lock())
-
-    async def __aenter__(self):
-        await self.lock.acquire()
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        self.lock.release()
-
-@asynccontextmanager
-async def handle_file_access(path):
-    """
-    Handles file access
-    """
-    async with FileAccessContextManager(path) as manager:
-        yield
-
-# read if file_caches.json exists
-if os.path.exists(os.path.join(basepath, 'file_caches.json')):
-    with open(os.path.join(basepath, 'file_caches.json'), 'r', encoding='utf-8') as f:
-        file_caches = json.load(f)
-else:
-    file_caches = {}
-    
 def remove_missing_files():
     """
-    Removes missing files from file_caches
+    Removes missing files from the hash index
     """
-    for file_path in list(file_caches.keys()):
-        if not os.path.exists(file_path):
-            del file_caches[file_path]
-    
+    return hash_index.remove_missing()
+
 class BasicModelResponse(BaseModel):
     """
     Basic model response
     """
     message: str
     success: bool
+    hashvalue: str = ""
     
 class HashModelResponse(BaseModel):
     """
@@ -77,6 +67,30 @@ class HashModelResponse(BaseModel):
     hashvalue: str
     success: bool
     message: str
+    hash_mode: str = ""
+    hash_algorithm: str = ""
+    original_hashvalue: str = "" # upload hash of a file normalized here, see normalize.py
+
+class UploadSessionResponse(BaseModel):
+    """
+    Upload session response
+    """
+    session_id: str = ""
+    size: int = 0
+    received: int = 0
+    ranges: list = []
+    missing: list = []
+    success: bool
+    message: str
+
+class ArchiveUploadResponse(BaseModel):
+    """
+    Archive upload response
+    """
+    files: dict = {} # relative path -> hashvalue
+    skipped: dict = {} # relative path -> reason
+    success: bool
+    message: str
 
 class ModelListResponse(BaseModel):
     """
@@ -131,42 +145,70 @@ def call_download_model_by_name(name:str):
         print(f"Could not download controlnet models: {e}")
         return False
 
-def register_cache(file_path:str, cache:str):
+def register_cache(file_path:str, cache:str, size_to_read:int = DEFAULT_SIZE_TO_READ):
     """
-    Registers a cache for a file path
+    Registers a cache for a file path, validated against the current size, mtime and inode of the file
     """
-    file_caches[file_path] = cache
-    dump_caches()
+    hash_index.set(file_path, cache, size_to_read)
     
 def dump_caches():
     """
-    Dumps caches to file_caches.json
+    Writes pending caches to the hash index
     """
-    global is_saving
-    remove_missing_files()
-    if is_saving:
-        return
-    is_saving = True
-    with open(os.path.join(basepath, 'file_caches.json'), 'w') as f:
-        json.dump(file_caches, f)
-    is_saving = False
+    hash_index.flush()
     
 def remove_cache(file_path:str):
     """
     Removes a cache for a file path
     """
-    if file_path in file_caches:
-        del file_caches[file_path]
-        dump_caches()
+    hash_index.remove(file_path)
         
-def get_cache(file_path:str) -> str:
+def get_cache(file_path:str, size_to_read:int = DEFAULT_SIZE_TO_READ) -> str:
     """
-    Gets a cache for a file path
+    Gets a cache for a file path, None if there is none or the file changed since it was hashed
     """
-    if file_path in file_caches:
-        return file_caches[file_path]
+    return hash_index.get(file_path, size_to_read)
+
+MODEL_TYPES = ["sd", "vae", "lora", "textual_inversion", "controlnet", "dynamic_prompts"]
+HASHED_MODEL_TYPES = ["lora", "vae", "sd", "textual_inversion"] # model types of the hash walks, streams and sync diffs
+NORMALIZE_MODELTYPES = ["sd", "vae", "lora", "controlnet"] # embeddings keep their pickle layout
+
+def get_model_dir(modeltype:str) -> str:
+    """
+    Returns the model directory for modeltype, None if modeltype is invalid
+    """
+    if modeltype == "sd":
+        return get_sd_ckpt_dir()
+    elif modeltype == "vae":
+        return get_vae_ckpt_dir()
+    elif modeltype == "lora":
+        return get_lora_ckpt_dir()
+    elif modeltype == "textual_inversion":
+        return get_textual_inversion_dir()
+    elif modeltype == "controlnet":
+        return get_controlnet_dir()
+    elif modeltype == "dynamic_prompts":
+        if not os.path.exists(os.path.join(basepath, 'extensions', 'sd-dynamic-prompts')):
+            return None
+        return os.path.join(basepath, 'extensions', 'sd-dynamic-prompts', 'wildcards')
     return None
 
+def get_model_dirs() -> list:
+    """
+    Returns every model directory which exists
+    """
+    model_dirs = []
+    for modeltype in MODEL_TYPES:
+        try:
+            model_dir = get_model_dir(modeltype)
+        except (AssertionError, ImportError, ModuleNotFoundError):
+            continue
+        if model_dir:
+            model_dirs.append(model_dir)
+    return model_dirs
+
+upload_sessions = UploadSessionStore(get_model_dirs)
+
 def upload_root_api(app:FastAPI):
     """
     Bind ping response to app
@@ -176,7 +218,46 @@ def upload_root_api(app:FastAPI):
         """
         curl http://test.api.address/uploader/ping
         """
-        return {"message": "hello"}
+        loop_monitor.ensure_started()
+        return {"message": "hello", "encodings": supported_encodings(), "hash_modes": HASH_MODES, "hash_algorithms": supported_algorithms()}
+
+    @secure_get("/uploader/loop_lag")
+    async def loop_lag_status():
+        """
+        Returns how late the event loop ran scheduled work (seconds), high lag means a handler blocked it.
+        Monitoring starts with the first ping or loop_lag request.
+        curl http://test.api.address/uploader/loop_lag
+        """
+        loop_monitor.ensure_started()
+        return {"message": "", 'success': True, **loop_monitor.status()}
+
+    @secure_get("/uploader/admission")
+    async def admission_status():
+        """
+        Returns running, waiting and rejected operations of each class (upload, hash, sync, download)
+        curl http://test.api.address/uploader/admission
+        """
+        return {"message": "", 'success': True, 'gates': {name: get_gate(name).status() for name in DEFAULT_LIMITS}}
+
+    @secure_get("/uploader/watcher")
+    async def watcher_status():
+        """
+        Returns the state of the background model watcher, enabled with --uploader-watch-models
+        curl http://test.api.address/uploader/watcher
+        """
+        if model_watcher is None:
+            return {"message": "Model watcher is not enabled", 'success': False}
+        return {"message": "", 'success': True, **model_watcher.status()}
+
+    @secure_get("/uploader/scrubber")
+    async def scrubber_status():
+        """
+        Returns the progress of the background integrity scrub and the files whose hashes changed, enabled with --uploader-scrub-rate
+        curl http://test.api.address/uploader/scrubber
+        """
+        if scrubber is None:
+            return {"message": "Scrubber is not enabled", 'success': False}
+        return {"message": "", 'success': True, **(await asyncio.to_thread(scrubber.status))}
     
 def set_overwrite(overwrite_:bool):
     """
@@ -196,6 +277,31 @@ def parse_response_or_dict(response_or_dict):
     # should be dict, raise error
     raise ValueError(f"Could not parse response or dict {response_or_dict}")
 
+def sync_succeeded(result) -> bool:
+    """
+    Returns True if the sync or upload response (or dict) of a model reports success
+    """
+    if isinstance(result, dict):
+        return bool(result.get('success'))
+    if result.status_code != 200:
+        return False
+    try:
+        return bool(result.json().get('success'))
+    except ValueError:
+        return False
+
+def failed_syncs(results:dict, prefix:str = "") -> List[str]:
+    """
+    Returns the paths whose sync failed in results, relative path -> response, or model type -> such results (see sync_models)
+    """
+    failed = []
+    for key, result in results.items():
+        if isinstance(result, dict) and 'success' not in result:
+            failed.extend(failed_syncs(result, f"{key}:"))
+        elif not sync_succeeded(result):
+            failed.append(prefix + key)
+    return failed
+
 def delete_api(app:FastAPI):
     """
     Binds delete API to app
@@ -237,7 +343,18 @@ def delete_api(app:FastAPI):
                 os.rmdir(subdir)
                 return
         #print(f"Directory {subdir} is not empty, not removing")
-        
+
+    def delete_model(model_path:str, model_dir:str) -> bool:
+        """
+        Deletes <model_dir>/<model_path> and its directory if it becomes empty, under the lock of the path,
+        so a delete does not interleave with an upload committing the same path
+        """
+        file_path = os.path.join(model_dir, model_path)
+        with path_locks.lock(file_path, model_dir):
+            if not delete_file(file_path):
+                return False
+            delete_empty_dir(model_path, model_dir) # delete empty directories
+            return True
                 
     @secure_post("/delete/sd_model", response_model=BasicModelResponse)
     async def delete_sd_model(model_path:str = Form("")):
@@ -247,8 +364,7 @@ def delete_api(app:FastAPI):
         """
         # curl -X POST -F "model_path=test" http://test.api.address/delete/sd_model
         file_path = os.path.join(get_sd_ckpt_dir(), model_path)
-        if delete_file(file_path):
-            delete_empty_dir(model_path, get_sd_ckpt_dir()) # delete empty directories
+        if await asyncio.to_thread(delete_model, model_path, get_sd_ckpt_dir()):
             return {"message": f"Successfully deleted {file_path}", 'success': True}
         else:
             return {"message": f"Could not find {file_path}", 'success': False}
@@ -262,8 +378,7 @@ def delete_api(app:FastAPI):
         """
         # curl -X POST -F "model_path=test" http://test.api.address/delete/vae_model
         file_path = os.path.join(get_vae_ckpt_dir(), model_path)
-        if delete_file(file_path):
-            delete_empty_dir(model_path, get_vae_ckpt_dir()) # delete empty directories
+        if await asyncio.to_thread(delete_model, model_path, get_vae_ckpt_dir()):
             return {"message": f"Successfully deleted {file_path}", 'success': True}
         else:
             return {"message": f"Could not find {file_path}", 'success': False}
@@ -276,8 +391,7 @@ def delete_api(app:FastAPI):
         """
         # curl -X POST -F "model_path=test" http://test.api.address/delete/lora_model
         file_path = os.path.join(get_lora_ckpt_dir(), model_path)
-        if delete_file(file_path):
-            delete_empty_dir(model_path, get_lora_ckpt_dir()) # delete empty directories
+        if await asyncio.to_thread(delete_model, model_path, get_lora_ckpt_dir()):
             return {"message": f"Successfully deleted {file_path}", 'success': True}
         else:
             return {"message": f"Could not find {file_path}", 'success': False}
@@ -290,8 +404,7 @@ def delete_api(app:FastAPI):
         """
         # curl -X POST -F "model_path=test" http://test.api.address/delete/embedding
         file_path = os.path.join(get_textual_inversion_dir(), model_path)
-        if delete_file(file_path):
-            delete_empty_dir(model_path, get_textual_inversion_dir()) # delete empty directories
+        if await asyncio.to_thread(delete_model, model_path, get_textual_inversion_dir()):
             return {"message": f"Successfully deleted {file_path}", 'success': True}
         else:
             return {"message": f"Could not find {file_path}", 'success': False}
@@ -304,8 +417,7 @@ def delete_api(app:FastAPI):
         """
         # curl -X POST -F "model_path=test" http://test.api.address/delete/controlnet_model
         file_path = os.path.join(get_controlnet_dir(), model_path)
-        if delete_file(file_path):
-            delete_empty_dir(model_path, get_controlnet_dir())
+        if await asyncio.to_thread(delete_model, model_path, get_controlnet_dir()):
             return {"message": f"Successfully deleted {file_path}", 'success': True}
         else:
             return {"message": f"Could not find {file_path}", 'success': False}
@@ -314,122 +426,109 @@ def sync_api(app:FastAPI):
     """
     Binds sync API with app
     """
+    async def run_sync(func, *args, message:str = "") -> dict:
+        """
+        Runs a blocking Connection method on the sync pool once the sync gate admits it.
+        If message is given, func syncs many models (see sync_models), message is returned if every model was synced,
+        otherwise the failed paths. Without message, the response of func is returned.
+        """
+        sync_gate = get_gate('sync')
+        async with sync_gate.admit():
+            try:
+                result = await sync_gate.run_in_executor(func, *args)
+            except Exception as exception:
+                if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
+                    return {"message": str(exception), 'success': False}
+                logger.exception(f"Exception at syncing model {exception}")
+                raise exception
+        if message:
+            failed = failed_syncs(result)
+            if failed:
+                listed = ', '.join(failed[:MAX_LISTED_FAILURES]) + (", ..." if len(failed) > MAX_LISTED_FAILURES else "")
+                return {"message": f"Could not sync {len(failed)} models : {listed}", 'success': False}
+            return {"message": message, 'success': True}
+        return parse_response_or_dict(result)
+
     @secure_post("/sync/sd_model", response_model=BasicModelResponse)
-    async def sync_sd_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form("")):
+    async def sync_sd_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://<target>/" -F "model_path=<model_name>" http://<this>:<port>/sync/sd_model
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            return parse_response_or_dict(connection.sync_sd_model(model_path))
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_sd_model, model_path)
     
     @secure_post("/sync/vae_model", response_model=BasicModelResponse)
-    async def sync_vae_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form("")):
+    async def sync_vae_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" -F "model_path=test/test.safetensors" http://<this>:<port>/sync/vae_model
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            return parse_response_or_dict(connection.sync_vae_model(model_path))
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_vae_model, model_path)
         
     @secure_post("/sync/lora_model", response_model=BasicModelResponse)
-    async def sync_lora_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form("")):
+    async def sync_lora_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" -F "model_path=test/test.safetensors" http://127.0.0.1:7860/sync/lora_model
         
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            return parse_response_or_dict(connection.sync_lora_model(model_path))
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_lora_model, model_path)
         
     @secure_post("/sync/embedding", response_model=BasicModelResponse)
-    async def sync_textual_inversion_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form("")):
+    async def sync_textual_inversion_model(target_api_address:str = Form(""), model_path:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" -F "model_path=test/test.safetensors" http://127.0.0.1:7860/sync/embedding
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            return parse_response_or_dict(connection.sync_textual_inversion_model(model_path))
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_textual_inversion_model, model_path)
         
     @secure_post("/sync/all_sd_models", response_model=BasicModelResponse)
-    async def sync_all_sd_models(target_api_address:str = Form(""), auth:str = Form("")):
+    async def sync_all_sd_models(target_api_address:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" http://127.0.0.1:7860/sync/all_sd_models
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            connection.sync_all_sd_models()
-            return {"message": "Successfully synced all sd models", 'success': True}
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_all_sd_models, message="Successfully synced all sd models")
         
     @secure_post("/sync/all_vae_models", response_model=BasicModelResponse)
-    async def sync_all_vae_models(target_api_address:str = Form(""), auth:str = Form("")):
+    async def sync_all_vae_models(target_api_address:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" http://localhost:7860/sync/all_vae_models
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            connection.sync_all_vae_models()
-            return {"message": "Successfully synced all vae models", 'success': True}
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_all_vae_models, message="Successfully synced all vae models")
         
     @secure_post("/sync/all_lora_models", response_model=BasicModelResponse)
-    async def sync_all_lora_models(target_api_address:str = Form(""), auth:str = Form("")):
+    async def sync_all_lora_models(target_api_address:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" http://localhost:7860/sync/all_lora_models
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            connection.sync_all_lora_models()
-            return {"message": "Successfully synced all lora models", 'success': True}
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_all_lora_models, message="Successfully synced all lora models")
         
     @secure_post("/sync/all_models", response_model=BasicModelResponse)
-    async def sync_all_models(target_api_address:str = Form(""), auth:str = Form("")):
+    async def sync_all_models(target_api_address:str = Form(""), auth:str = Form(""), concurrency:int = Form(DEFAULT_UPLOAD_CONCURRENCY),
+                            hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM), verify_full_hash:bool = Form(False)):
         """
         curl -X POST -F "target_api_address=http://test.api.address/" http://localhost:7860/sync/all_models
         """
-        connection = Connection(target_api_address, auth=auth)
-        try:
-            connection.sync_everything()
-            return {"message": "Successfully synced all models", 'success': True}
-        except Exception as exception:
-            if isinstance(exception, (FileNotFoundError, ConnectionRefusedError)):
-                return {"message": str(exception), 'success': False}
-            logger.exception(f"Exception at syncing model {exception}")
-            raise exception
+        connection = Connection(target_api_address, auth=auth, concurrency=concurrency, hash_mode=hash_mode,
+                                hash_algorithm=hash_algorithm, verify_full_hash=verify_full_hash)
+        return await run_sync(connection.sync_everything, message="Successfully synced all models")
         
 def remove_cache_api(app:FastAPI):
     """
@@ -441,8 +540,8 @@ def remove_cache_api(app:FastAPI):
         Removes the cache for file_path
         curl -X POST -F "file_path=some_path/data.safetensors" "http://localhost:7860/remove_cache"
         """
-        if file_path in file_caches:
-            remove_cache(file_path)
+        if await asyncio.to_thread(hash_index.__contains__, file_path):
+            await asyncio.to_thread(remove_cache, file_path)
             return {"message": f"Successfully removed cache for {file_path}", 'success': True}
         else:
             return {"message": f"Could not find cache for {file_path}", 'success': False}
@@ -453,18 +552,16 @@ def remove_cache_api(app:FastAPI):
         Removes all caches
         curl -X POST "http://localhost:7860/remove_all_caches"
         """
-        global file_caches
-        file_caches = {}
-        dump_caches()
+        await asyncio.to_thread(hash_index.clear)
         return {"message": f"Successfully removed all caches", 'success': True}
     
     @secure_post("/remove_missing_files", response_model=BasicModelResponse)
     async def remove_missing_files_api_endpoint():
         """
-        Removes all missing files from file_caches
+        Removes all missing files from the hash index
         curl -X POST "http://localhost:7860/remove_missing_files"
         """
-        remove_missing_files()
+        await asyncio.to_thread(remove_missing_files)
         return {"message": f"Successfully removed missing files", 'success': True}
     
     @secure_post("/get_cache_list")
@@ -473,7 +570,7 @@ def remove_cache_api(app:FastAPI):
         Gets a list of cached files
         curl -X POST "http://localhost:7860/get_cache_list"
         """
-        return {"message": "", 'success': True, 'caches': list(file_caches.keys())}
+        return {"message": "", 'success': True, 'caches': await asyncio.to_thread(hash_index.paths)}
         
 def upload_txt_api(app:FastAPI):
     """
@@ -491,15 +588,18 @@ def upload_txt_api(app:FastAPI):
         # check if sd-dynamic-prompts exists
         if not os.path.exists(os.path.join(basepath, 'extensions', 'sd-dynamic-prompts')):
             return {"message": "Could not find sd-dynamic-prompts extension", 'success': False}
-        async with handle_file_access(text.filename):
-            real_file_path = os.path.join(basepath, 'extensions', 'sd-dynamic-prompts', 'wildcards', path, text.filename)
-            os.makedirs(os.path.dirname(real_file_path), exist_ok=True)
-            try:
+        wildcards_dir = os.path.join(basepath, 'extensions', 'sd-dynamic-prompts', 'wildcards')
+        real_file_path = os.path.join(wildcards_dir, path, text.filename)
+        def save_text():
+            with path_locks.lock(real_file_path, wildcards_dir):
+                os.makedirs(os.path.dirname(real_file_path), exist_ok=True)
                 contents = text.file.read()
                 with open(real_file_path, 'wb') as f:
                     f.write(contents)
-            except Exception as e:
-                return {"message": f"There was an error uploading the file : {e}", 'success': False}
+        try:
+            await asyncio.to_thread(save_text)
+        except Exception as e:
+            return {"message": f"There was an error uploading the file : {e}", 'success': False}
         return {"message": f"Successfully saved text to {real_file_path}", 'success': True}
     
         
@@ -516,116 +616,429 @@ def upload_api(app:FastAPI):
         set_overwrite(overwrite_)
         return {"message": f"Set overwrite to {overwrite_}", 'success': True}
     
-    @secure_post("/upload", response_model=BasicModelResponse)
-        # test with {'file': open('images/1.png', 'rb')}
-    async def upload(file: UploadFile = File(...), path: str = Form('./tmp'), modeltype:str = Form(""), custom_name:str = Form("")):
+    def resolve_upload_path(path:str, modeltype:str, filename:str, custom_name:str = "") -> Tuple[str, str]:
+        """
+        Returns (<model dir>/<path>/<filename or custom_name>, error message)
+        error message is empty if the file can be stored there
+        """
+        # get path
+        model_dir = get_model_dir(modeltype)
+        if model_dir is None:
+            return "", f"Invalid modeltype {modeltype}"
+        if '../' in path:
+            return "", "path must not contain ../"
+        path = os.path.join(model_dir, path)
+        if custom_name:
+            custom_name = custom_name.strip().replace(' ', '_').replace('/', '_').replace('\\', '_') # no path separators allowed
+            # if custom_name does not have extension, add extension '.safetensors'
+            if '.' not in custom_name:
+                custom_name += '.safetensors'
+        else:
+            custom_name = ""
+        real_file_path = os.path.join(path, filename if custom_name == "" else custom_name)
+        if os.path.exists(real_file_path) and not OVERWRITE:
+            return real_file_path, f"File {real_file_path} already exists, set overwrite to True to overwrite"
+        elif os.path.isdir(real_file_path):
+            return real_file_path, f"File {real_file_path} is a directory"
+        return real_file_path, ""
+
+    def store_upload(target_filename:str, real_file_path:str) -> dict:
         """
-        Uploads a file to path
-        Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "path=subpath" -F "custom_name=a.safetensors http://localhost:7860/upload
-        """
-        async with handle_file_access(file.filename):
-            # get path
-            if modeltype == "sd":
-                path = os.path.join(get_sd_ckpt_dir(), path)
-            elif modeltype == "vae":
-                path = os.path.join(get_vae_ckpt_dir(), path)
-            elif modeltype == "lora":
-                path = os.path.join(get_lora_ckpt_dir(), path)
-            elif modeltype == "textual_inversion":
-                path = os.path.join(get_textual_inversion_dir(), path)
-            elif modeltype == "controlnet":
-                path = os.path.join(get_controlnet_dir(), path)
-            else:
-                return {"message": f"Invalid modeltype {modeltype}", 'success': False}
-            if custom_name:
-                custom_name = custom_name.strip().replace(' ', '_').replace('/', '_').replace('\\', '_') # no path separators allowed
-                # if custom_name does not have extension, add extension '.safetensors'
-                if '.' not in custom_name:
-                    custom_name += '.safetensors'
-            else:
-                custom_name = ""
-            real_file_path = os.path.join(path, file.filename if custom_name == "" else custom_name)
-            if os.path.exists(real_file_path) and not OVERWRITE:
-                return {"message": f"File {real_file_path} already exists, set overwrite to True to overwrite", 'success': False}
-            elif os.path.isdir(real_file_path):
-                return {"message": f"File {real_file_path} is a directory", 'success': False}
+        Moves a received upload from its staging file to real_file_path
+        """
+        # move file to path, an existing file is replaced by the same rename
+        try:
+            remove_cache(real_file_path)
+            if os.path.exists(real_file_path) and OVERWRITE:
+                print(f"Replacing {real_file_path} to overwrite")
+            commit_file(target_filename, real_file_path)
+        except Exception as e:
+            return {"message": f"There was an error moving the {target_filename} to {real_file_path} : {e}", 'success': False}
+        print(f"Successfully uploaded {os.path.basename(real_file_path)} to {real_file_path}")
+        return {"message": f"Successfully uploaded {os.path.basename(real_file_path)} to {real_file_path}", 'success': True}
+
+    def check_normalize(normalize:str, modeltype:str) -> str:
+        """
+        Returns an error message if normalize can not be applied to modeltype
+        """
+        if normalize not in NORMALIZE_MODES:
+            return f"normalize must be one of {NORMALIZE_MODES}"
+        if normalize and modeltype not in NORMALIZE_MODELTYPES:
+            return f"normalize is only supported for {NORMALIZE_MODELTYPES}"
+        return ""
+
+    def normalize_upload(staged_path:str, filename:str, normalize:str, hashvalue:str) -> Tuple[str, str]:
+        """
+        Writes the normalized form of a staged upload next to it, returns (normalized path or "", message)
+        """
+        normalized_path = os.path.join(os.path.dirname(staged_path), uuid.uuid4().hex + '.part')
+        try:
+            check_free_space(os.path.dirname(staged_path), os.path.getsize(staged_path))
+            if not normalize_file(staged_path, normalized_path, filename, normalize, hashvalue):
+                return "", ""
+        except (NormalizeError, OSError) as e:
+            return "", f", stored without normalization : {e}"
+        return normalized_path, f", normalized to {normalize}"
+
+    def commit_upload(staged_path:str, path:str, modeltype:str, filename:str, custom_name:str, hashvalue:str, normalize:str = "",
+                      digests:Optional[Dict[str, str]] = None) -> dict:
+        """
+        Moves a staged upload to <model dir>/<path>/<filename or custom_name> and registers its hash.
+        digests of the staged file (see MultiDigestHasher) are written to webui's hash cache, unless it was normalized.
+        The destination is checked and replaced while holding its lock, the staged file is kept on failure.
+        If normalize is given ('safetensors' or 'fp16'), the normalized file is stored instead and the staged file is removed,
+        hashvalue (of the upload) is registered as its original hash so syncs still match the original, its own hash is
+        computed from its content on the next query.
+        Blocking, called from a worker thread.
+        """
+        normalized_path, note = "", ""
+        if normalize:
+            real_file_path, error = resolve_upload_path(path, modeltype, normalized_filename(filename, normalize), normalized_filename(custom_name, normalize))
+            if error:
+                return {"message": error, 'success': False}
+            normalized_path, note = normalize_upload(staged_path, filename, normalize, hashvalue)
+            if normalized_path:
+                filename, custom_name = normalized_filename(filename, normalize), normalized_filename(custom_name, normalize)
+        real_file_path, error = resolve_upload_path(path, modeltype, filename, custom_name)
+        result = {"message": error, 'success': False}
+        if real_file_path:
+            with path_locks.lock(real_file_path, get_model_dir(modeltype)):
+                # checked again under the lock, another upload may have stored the same file meanwhile
+                real_file_path, error = resolve_upload_path(path, modeltype, filename, custom_name)
+                if error:
+                    result = {"message": error, 'success': False}
+                else:
+                    result = store_upload(normalized_path or staged_path, real_file_path)
+                if result['success']:
+                    if normalized_path:
+                        register_original_hash(real_file_path, hashvalue)
+                    else:
+                        register_cache(real_file_path, hashvalue)
+                        if digests:
+                            register_webui_hashes(modeltype, real_file_path, digests)
+                    result['hashvalue'] = hashvalue
+                    result['message'] += note
+        if normalized_path:
+            # keep only the file which is still needed, the staged upload on failure
+            os.remove(staged_path if result['success'] else normalized_path)
+        return result
+
+    async def upload(request:Request, modeltype:str = "", path_field:str = "path", default_path:str = ""):
+        """
+        Receives an upload once the upload gate admits it, see receive_upload
+        """
+        async with get_gate('upload').admit():
+            return await receive_upload(request, modeltype, path_field, default_path)
+
+    async def receive_upload(request:Request, modeltype:str = "", path_field:str = "path", default_path:str = ""):
+        """
+        Streams the multipart body of request to a staging file, then moves it to the model directory.
+        The body is written to disk chunk by chunk as it arrives, so memory usage does not depend on the file size.
+        Form fields : file, <path_field>, custom_name, size (optional, exact file size), modeltype if it is not given,
+        file_encoding (optional, 'zstd' if the file part is compressed, see /uploader/ping for supported encodings)
+        and normalize (optional, 'safetensors' converts pickle checkpoints, 'fp16' also casts float tensors to float16)
+        """
+        def open_file(field_name:str, filename:str, fields:dict) -> FileSink:
+            if field_name != 'file':
+                raise UploadRejected(f"Unexpected file field {field_name}")
+            # stage next to the target so the upload is committed with a rename.
+            # if modeltype was not received before the file, stage in the models directory instead
+            model_dir = get_model_dir(modeltype or fields.get('modeltype', ""))
+            staging_dir = get_staging_dir(model_dir or os.path.join(basepath, 'models'))
+            # file_encoding (i.e. zstd) is how the file data is compressed on the wire, the file is stored decoded
+            encoding = fields.get('file_encoding', "")
+            if encoding and not fields.get('size', '').isdigit():
+                raise EncodingRejected("size is required when file_encoding is given, it must be received before the file")
+            # size field is the exact file size, Content-Length of the whole body is an upper bound unless the file is encoded
+            exact_size = int(fields['size']) if fields.get('size', '').isdigit() else 0
+            content_length = int(request.headers.get('content-length', 0)) if not encoding else 0
+            declared_size = exact_size or content_length
+            # safetensors headers are checked as soon as they arrive, so truncated or broken files are rejected early
+            validator = SafetensorsStreamValidator(exact_size, content_length) if filename.endswith('.safetensors') else None
+            # webui's hashes are computed while receiving too, so webui does not read the file again
+            hasher = new_upload_hasher(modeltype or fields.get('modeltype', ""), filename)
             try:
-                contents = file.file.read()
-                _suffix = uuid.uuid4().hex
-                original_filename = file.filename
-                target_filename = file.filename + _suffix
-                with open(target_filename, 'wb') as f:
-                    f.write(contents)
-                print(f"Successfully uploaded {original_filename} to {real_file_path}")
+                os.makedirs(staging_dir, exist_ok=True)
+                check_free_space(staging_dir, declared_size)
+                return FileSink(os.path.join(staging_dir, uuid.uuid4().hex + '.part'), filename, declared_size, validator, encoding, hasher)
+            except OSError as e:
+                raise UploadRejected(str(e)) from e
+        try:
+            fields, files = await read_multipart(request, open_file, get_gate('upload').executor)
+        except EncodingRejected as e:
+            # the body itself is malformed (i.e. truncated), not the model it carries
+            raise HTTPException(status_code=400, detail=f"There was an error uploading the file : {e}") from e
+        except UploadRejected as e:
+            return {"message": f"There was an error uploading the file : {e}", 'success': False}
+        if 'file' not in files:
+            return {"message": "file is required", 'success': False}
+        sink = files['file']
+        if fields.get('size', '').isdigit() and sink.size != int(fields['size']):
+            sink.discard()
+            return {"message": f"Received {sink.size} bytes of {sink.filename}, but size is {fields['size']}", 'success': False}
+        modeltype = modeltype or fields.get('modeltype', "")
+        normalize = fields.get('normalize', "")
+        error = check_normalize(normalize, modeltype)
+        if error:
+            sink.discard()
+            return {"message": error, 'success': False}
+        # hash was computed while receiving, no need to read the file again
+        result = await get_gate('upload').run_in_executor(commit_upload, sink.target_path, fields.get(path_field, default_path),
+                                         modeltype, sink.filename, fields.get('custom_name', ""), sink.hashvalue, normalize,
+                                         upload_digests(sink.hasher))
+        if not result['success']:
+            sink.discard()
+        return result
+
+    def finalize_session(session, hashvalue:str = "", normalize:str = "") -> dict:
+        """
+        Checks the safetensors header and the hash of a complete session, then commits it. Blocking, reads the file.
+        """
+        if session.filename.endswith('.safetensors'):
+            try:
+                header, data_offset = read_header(session.part_path)
+                if data_offset + data_length(header) != session.size:
+                    raise SafetensorsError(f"Safetensors header declares {data_offset + data_length(header)} bytes, but the upload size is {session.size}")
+            except SafetensorsError as e:
+                upload_sessions.remove(session.session_id)
+                return {"message": f"Invalid {session.filename} : {e}", 'success': False}
+        uploaded_hash = session.finish_hash()
+        expected_hash = hashvalue or session.hashvalue
+        if expected_hash and uploaded_hash != expected_hash:
+            upload_sessions.remove(session.session_id)
+            return {"message": f"Hash mismatch for upload session {session.session_id}, expected {expected_hash}, received {uploaded_hash}", 'success': False}
+        result = commit_upload(session.part_path, session.path, session.modeltype, session.filename, session.custom_name, uploaded_hash, normalize,
+                               upload_digests(session.hasher) if session.hashed_until == session.size else None)
+        if result['success']:
+            upload_sessions.remove(session.session_id)
+        return result
+
+    @secure_post("/upload_session/create", response_model=UploadSessionResponse)
+    async def create_upload_session(modeltype:str = Form(""), path:str = Form(""), filename:str = Form(""), custom_name:str = Form(""),
+                                    size:int = Form(...), hashvalue:str = Form("")):
+        """
+        Creates a resumable upload session for a file of size bytes, returns its session_id.
+        If an unfinished session uploads the same file to the same place, that session is returned instead,
+        check 'ranges' to see what was already received.
+        hashvalue is optional, if given, the uploaded file is verified against it on finalize.
+        Usage: curl -X POST -F "modeltype=lora" -F "path=test" -F "filename=test.safetensors" -F "size=123456" http://localhost:7860/upload_session/create
+        """
+        if not filename or size < 0:
+            return {"message": "filename and size are required", 'success': False}
+        _, error = resolve_upload_path(path, modeltype, filename, custom_name)
+        if error:
+            return {"message": error, 'success': False}
+        try:
+            session = await asyncio.to_thread(upload_sessions.create, get_model_dir(modeltype), modeltype, path, filename, custom_name, size, hashvalue)
+        except OSError as e:
+            return {"message": f"Could not create upload session : {e}", 'success': False}
+        return {"message": "", 'success': True, **session.status()}
+
+    @secure_put("/upload_session/{session_id}", response_model=UploadSessionResponse)
+    async def upload_session_range(session_id:str, request:Request, offset:int = 0):
+        """
+        Writes the request body to the session file at offset, the body may be compressed with Content-Encoding: zstd
+        Usage: curl -X PUT --data-binary @part.bin "http://localhost:7860/upload_session/<session_id>?offset=0"
+        """
+        session = await asyncio.to_thread(upload_sessions.get, session_id)
+        if session is None:
+            return {"message": f"Could not find upload session {session_id}", 'success': False}
+        if offset < 0 or offset > session.size:
+            return {"message": f"Invalid offset {offset} for size {session.size}", 'success': False}
+        # a range may be zstd compressed (Content-Encoding: zstd), offsets always refer to the decoded file
+        writer = SessionRangeWriter(session, offset, STREAM_CHUNK_SIZE)
+        try:
+            decoder = open_decoder(request.headers.get('content-encoding', ""), writer.write)
+        except ValueError as e:
+            return {"message": str(e), 'success': False, **session.status()}
+        def write_chunks(chunks):
+            for chunk in chunks:
+                decoder.write(chunk)
+        upload_gate = get_gate('upload')
+        async with upload_gate.admit():
+            chunks = []
+            buffered = 0
+            try:
+                # chunks are decoded and written in a worker thread, in bounded batches
+                async for chunk in request.stream():
+                    chunks.append(chunk)
+                    buffered += len(chunk)
+                    if buffered >= STREAM_BATCH_SIZE:
+                        await upload_gate.run_in_executor(write_chunks, chunks)
+                        chunks = []
+                        buffered = 0
+                await upload_gate.run_in_executor(write_chunks, chunks)
+                # a truncated range is rejected, the decoded part which was written stays recorded
+                await upload_gate.run_in_executor(decoder.close)
+                await upload_gate.run_in_executor(writer.flush)
+            except SafetensorsError as e:
+                await asyncio.to_thread(upload_sessions.remove, session_id)
+                return {"message": f"Invalid {session.filename} : {e}", 'success': False}
+            except (ValueError, *DECODE_ERRORS) as e:
+                # data buffered by the writer is dropped, the client resumes from the recorded ranges
+                return {"message": str(e), 'success': False, **session.status()}
+        return {"message": f"Received {writer.written} bytes at {offset}", 'success': True, **session.status()}
+
+    @secure_get("/upload_session/{session_id}", response_model=UploadSessionResponse)
+    async def upload_session_status(session_id:str):
+        """
+        Returns the ranges which were received by the session
+        Usage: curl http://localhost:7860/upload_session/<session_id>
+        """
+        session = await asyncio.to_thread(upload_sessions.get, session_id)
+        if session is None:
+            return {"message": f"Could not find upload session {session_id}", 'success': False}
+        return {"message": "", 'success': True, **session.status()}
+
+    @secure_post("/upload_session/{session_id}/finalize", response_model=BasicModelResponse)
+    async def finalize_upload_session(session_id:str, hashvalue:str = Form(""), normalize:str = Form("")):
+        """
+        Verifies the size and hash of the uploaded file, then moves it to the model directory
+        normalize : optional, 'safetensors' converts pickle checkpoints, 'fp16' also casts float tensors to float16
+        Usage: curl -X POST -F "hashvalue=<hash>" http://localhost:7860/upload_session/<session_id>/finalize
+        """
+        session = await asyncio.to_thread(upload_sessions.get, session_id)
+        if session is None:
+            return {"message": f"Could not find upload session {session_id}", 'success': False}
+        if not session.is_complete():
+            return {"message": f"Upload session {session_id} is missing ranges {session.missing()}", 'success': False}
+        error = check_normalize(normalize, session.modeltype)
+        if error:
+            return {"message": error, 'success': False}
+        return await get_gate('upload').run(finalize_session, session, hashvalue, normalize)
+
+    @secure_delete("/upload_session/{session_id}", response_model=BasicModelResponse)
+    async def abort_upload_session(session_id:str):
+        """
+        Aborts the session and removes the received data
+        Usage: curl -X DELETE http://localhost:7860/upload_session/<session_id>
+        """
+        if await asyncio.to_thread(upload_sessions.get, session_id) is None:
+            return {"message": f"Could not find upload session {session_id}", 'success': False}
+        await asyncio.to_thread(upload_sessions.remove, session_id)
+        return {"message": f"Removed upload session {session_id}", 'success': True}
+
+    @secure_post("/upload_archive", response_model=ArchiveUploadResponse)
+    async def upload_archive(request:Request, modeltype:str = "", path:str = "", compression:str = ""):
+        """
+        Extracts a tar archive (request body) to <model dir>/<path>, entries keep their relative paths.
+        Entries are staged and committed one by one while the archive streams in, existing files follow the overwrite option.
+        modeltype : sd, vae, lora, textual_inversion, controlnet or dynamic_prompts
+        compression : "" (tar, tar.gz) or zstd, Content-Encoding: zstd works too
+        Usage: tar -cf - -C loras . | curl -X POST -H "Content-Type: application/x-tar" --data-binary @- "http://localhost:7860/upload_archive?modeltype=lora&path=test"
+        """
+        model_dir = get_model_dir(modeltype)
+        if model_dir is None:
+            return {"message": f"Invalid modeltype {modeltype}", 'success': False}
+        if '../' in path:
+            return {"message": "path must not contain ../", 'success': False}
+        if not compression and request.headers.get('content-encoding', '') == 'zstd':
+            compression = 'zstd'
+        staging_dir = get_staging_dir(model_dir)
+        await asyncio.to_thread(os.makedirs, staging_dir, exist_ok=True)
+
+        def store_member(name:str, size:int, file_obj) -> Tuple[bool, str]:
+            member_dir, filename = posixpath.split(name)
+            real_file_path, error = resolve_upload_path(posixpath.join(path, member_dir), modeltype, filename)
+            if error:
+                return False, error
+            validator = SafetensorsStreamValidator(size) if filename.endswith('.safetensors') else None
+            try:
+                check_free_space(staging_dir, size)
+                sink = FileSink(os.path.join(staging_dir, uuid.uuid4().hex + '.part'), filename, size, validator, hasher=new_upload_hasher(modeltype, filename))
+            except OSError as e:
+                return False, str(e)
+            try:
+                while True:
+                    data = file_obj.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    sink.write(data)
+                sink.close()
             except Exception as e:
-                return {"message": f"There was an error uploading the file : {e}", 'success': False}
-            finally:
-                file.file.close()
-            # move file to path
+                sink.discard()
+                return False, str(e)
+            result = commit_upload(sink.target_path, posixpath.join(path, member_dir), modeltype, filename, "", sink.hashvalue, digests=upload_digests(sink.hasher))
+            if not result['success']:
+                sink.discard()
+                return False, result['message']
+            return True, sink.hashvalue
+
+        def extract(reader:AsyncStreamReader):
+            with open_archive_stream(reader, compression) as archive:
+                return extract_archive(archive, store_member)
+
+        # tarfile reads blocking, so extraction runs in a thread which pulls the body from the event loop
+        reader = AsyncStreamReader(request.stream(), asyncio.get_running_loop())
+        upload_gate = get_gate('upload')
+        async with upload_gate.admit():
             try:
-                os.makedirs(path, exist_ok=True)
-                remove_cache(real_file_path)
-                if os.path.exists(real_file_path) and OVERWRITE:
-                    print(f"Removing {real_file_path} to overwrite")
-                    os.remove(real_file_path)
-                shutil.move(target_filename, real_file_path)
+                stored, skipped = await upload_gate.run_in_executor(extract, reader)
             except Exception as e:
-                return {"message": f"There was an error moving the {target_filename} to {real_file_path} : {e}", 'success': False}
-        return {"message": f"Successfully uploaded {file.filename} to {real_file_path}", 'success': True}
+                return {"message": f"There was an error extracting the archive : {e}", 'success': False}
+        return {"message": f"Stored {len(stored)} files, skipped {len(skipped)} files", 'success': True, 'files': stored, 'skipped': skipped}
+
+    @secure_post("/upload", response_model=BasicModelResponse)
+        # test with {'file': open('images/1.png', 'rb')}
+    async def upload_any_model(request:Request):
+        """
+        Uploads a file to path
+        Form fields : file, path (default ./tmp), modeltype, custom_name
+        Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "path=subpath" -F "modeltype=lora" -F "custom_name=a.safetensors" http://localhost:7860/upload
+        """
+        return await upload(request, path_field="path", default_path="./tmp")
 
     @secure_post("/upload_sd_model", response_model=BasicModelResponse)
-    async def upload_sd_model(file:UploadFile = File(...), sd_path:str= Form(""), custom_name:str = Form("")):
+    async def upload_sd_model(request:Request):
         """
         Uploads a Stable-diffusion model to <root>/models/Stable-diffusion/<sd_path>/<sd_model_name>
+        Form fields : file, sd_path, custom_name
         Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "sd_path=test" http://localhost:7860/upload_sd_model
         """
         # upload file to <root>/models/Stable-diffusion/<sd_model_name>/<sd_model_name>
         # sd_model_name may be a.safetensors or /sd_path/../<model_name>
-        assert '../' not in sd_path, "sd_model_name must not contain ../"
-        return await upload(file, sd_path, "sd", custom_name=custom_name)
+        return await upload(request, "sd", "sd_path")
         
     @secure_post("/upload_vae_model", response_model=BasicModelResponse)
-    async def upload_vae_model(file:UploadFile = File(...), vae_path:str = Form(""), custom_name:str = Form("")):
+    async def upload_vae_model(request:Request):
         """
         Uploads a VAE model to <root>/models/VAE/<vae_path>/<vae_model_name>
+        Form fields : file, vae_path, custom_name
         Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "vae_path=test" http://localhost:7860/upload_vae_model
         """
         # upload file to <root>/models/VAE/<vae_path>/<vae_model_name>
-        assert '../' not in vae_path, "vae_path must not contain ../"
-        return await upload(file, vae_path, "vae", custom_name=custom_name)
+        return await upload(request, "vae", "vae_path")
 
     @secure_post("/upload_lora_model", response_model=BasicModelResponse)
-    async def upload_lora_model(file:UploadFile = File(...), lora_path:str = Form(""), custom_name:str = Form("")):
+    async def upload_lora_model(request:Request):
         """
         Uploads a LoRA model to <root>/models/LoRA/<lora_path>/<lora_model_name>
+        Form fields : file, lora_path, custom_name
         Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "lora_path=test" http://localhost:7860/upload_lora_model
         """
         # upload file to <root>/models/LoRA/<lora_path>/<lora_model_name>
         # l /lora_path/<model_name>
-        # assert lora_model_name does not contain ../
-        assert '../' not in lora_path, "lora_path must not contain ../"
-        return await upload(file, lora_path, "lora", custom_name=custom_name)
+        return await upload(request, "lora", "lora_path")
     
     @secure_post("/upload_embedding", response_model=BasicModelResponse)
-    async def upload_textual_inversion_model(file:UploadFile = File(...), textual_inversion_path:str = Form(""), custom_name:str = Form("")):
+    async def upload_textual_inversion_model(request:Request):
         """
         Uploads a textual inversion model to <root>/embeddings/<textual_inversion_path>/<textual_inversion_model_name>
+        Form fields : file, textual_inversion_path, custom_name
         Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "textual_inversion_path=test" http://localhost:7860/upload_embedding
         """
         # upload file to <root>/embeddings/<textual_inversion_path>/<textual_inversion_model_name>
         # l /textual_inversion_path/<model_name>
-        # assert textual_inversion_model_name does not contain ../
-        assert '../' not in textual_inversion_path, "textual_inversion_path must not contain ../"
-        return await upload(file, textual_inversion_path, "textual_inversion", custom_name=custom_name)
+        return await upload(request, "textual_inversion", "textual_inversion_path")
     
     @secure_post("/upload_controlnet_model", response_model=BasicModelResponse)
-    async def upload_controlnet_model(file:UploadFile = File(...), controlnet_path:str = Form(""), custom_name:str = Form("")):
+    async def upload_controlnet_model(request:Request):
         """
         Uploads a controlnet model to <root>/env_dependent_controlnet_path/<controlnet_model_name>
+        Form fields : file, controlnet_path, custom_name
         Usage: curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "controlnet_path=test" http://localhost:7860/upload_controlnet_model
         """
-        assert '../' not in controlnet_path, "controlnet_path must not contain ../"
-        return await upload(file, controlnet_path, "controlnet", custom_name=custom_name)
+        return await upload(request, "controlnet", "controlnet_path")
     
     # can be used with curl
     #curl -X POST -F "file=@C:\\Users\\UserName\\Downloads\\test.safetensors" -F "lora_path=test" http://127.0.0.1:7860/upload_lora_model
@@ -634,32 +1047,57 @@ def upload_api(app:FastAPI):
     # or with python requests
     # requests.post("<api>/upload_lora_model", files={"file": open("<path>", "rb")}, data={"lora_path": "<lora_path>"})
 
-def fast_file_hash(file_path:str, size_to_read:int=1<<31) -> str:
+def hash_options_error(hash_mode:str, hash_algorithm:str = DEFAULT_ALGORITHM) -> str:
+    """
+    Returns an error message if hash_mode or hash_algorithm is not supported
+    """
+    if hash_mode not in HASH_MODES:
+        return f"hash_mode must be one of {HASH_MODES}"
+    if hash_algorithm not in supported_algorithms():
+        return f"hash_algorithm must be one of {supported_algorithms()}"
+    return ""
+
+def fast_file_hash(file_path:str, size_to_read:int=DEFAULT_SIZE_TO_READ, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM) -> str:
     """
-    Computes a hash of the file at file_path with first 1MB of file, and total file size
+    Computes a hash of the file at file_path with first size_to_read bytes of file, and total file size.
+    hash_mode 'fingerprint' computes a quick fingerprint from sampled blocks instead, see compute_file_fingerprint,
+    'structure' fingerprints the safetensors header, see compute_file_structure_hash.
+    hash_algorithm is one of supported_algorithms(), i.e. 'xxh3' is much faster and enough to compare files.
+    Concurrent calls for the same file, algorithm and read length wait for one computation instead of reading the file again.
     """
-    if file_path in file_caches and os.path.exists(file_path):
-        #print(f"Using cache for {file_path}")
-        return get_cache(file_path)
+    algorithm = f"{hash_mode}:{hash_algorithm}" if hash_mode else hash_algorithm
+    hashvalue = hash_index.get(file_path, size_to_read, algorithm)
+    if hashvalue is not None:
+        return hashvalue
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Could not find file at {file_path} at func_fast_file_hash")
+    key = (file_path, algorithm, read_length(os.path.getsize(file_path), size_to_read))
+    return hash_flights.run(key, partial(compute_fast_file_hash, file_path, size_to_read, hash_mode, hash_algorithm))
+
+def compute_fast_file_hash(file_path:str, size_to_read:int, hash_mode:str, hash_algorithm:str) -> str:
+    """
+    Computes and registers the hash of fast_file_hash, unless a caller which finished meanwhile registered it
+    """
+    algorithm = f"{hash_mode}:{hash_algorithm}" if hash_mode else hash_algorithm
+    hashvalue = hash_index.get(file_path, size_to_read, algorithm)
+    if hashvalue is not None:
+        return hashvalue
+    stat = os.stat(file_path) # before hashing, so a file written meanwhile is not indexed with a stale hash
+    if hash_mode:
+        hash_func = compute_file_fingerprint if hash_mode == 'fingerprint' else compute_file_structure_hash
+        hashvalue = hash_func(file_path, hash_algorithm)
+        hash_index.set(file_path, hashvalue, size_to_read, algorithm, stat)
+        return hashvalue
     #print(f"Computing hash for {file_path} with size_to_read {size_to_read}...")
-    import hashlib # import hashlib in-context, maybe hashlib is overwritten by other modules
-    BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
-    sha256 = hashlib.sha256()
-    filesize = os.path.getsize(file_path)
-    # with lock, prevent multiple threads from reading the same file
-    with open(file_path, 'rb') as f:
-        bytes_read = 0
-        while True:
-            data = f.read(BUF_SIZE)
-            bytes_read += BUF_SIZE
-            if not data or bytes_read > size_to_read or bytes_read > filesize:
-                break
-            sha256.update(data)
-    sha256.update(str(os.path.getsize(file_path)).encode('utf-8'))
-    hashvalue = sha256.hexdigest()
-    register_cache(file_path, hashvalue)
+    webui_modeltype = wants_webui_hashes(file_path, size_to_read) if hash_algorithm == DEFAULT_ALGORITHM else ""
+    if webui_modeltype:
+        # the file is read completely anyway, so webui's hashes come from the same pass
+        digests = compute_file_digests(file_path, size_to_read, uses_addnet_hash(webui_modeltype, file_path))
+        register_webui_hashes(webui_modeltype, file_path, digests)
+        hashvalue = digests['hashvalue']
+    else:
+        hashvalue = compute_file_hash(file_path, size_to_read, hash_algorithm)
+    hash_index.set(file_path, hashvalue, size_to_read, algorithm, stat)
     return hashvalue
     
     
@@ -676,7 +1114,7 @@ def download_controlnet_models_api(app:FastAPI):
         curl -X POST http://localhost:7860/download_controlnet_models/xl
         """
         # curl -X POST http://127.0.0.1:7860/download_controlnet_models/xl
-        result = call_download_controlnet_xl()
+        result = await get_gate('download').run(call_download_controlnet_xl)
         if result:
             return {"message": "Successfully downloaded controlnet models XL", 'success': True}
         else:
@@ -690,7 +1128,7 @@ def download_controlnet_models_api(app:FastAPI):
         curl -X POST http://localhost:7860/download_controlnet_models/v11
         """
         # curl -X POST http://127.0.0.1:7860/download_controlnet_models/v11
-        result = call_download_controlnet_v11()
+        result = await get_gate('download').run(call_download_controlnet_v11)
         if result:
             return {"message": "Successfully downloaded controlnet models v11", 'success': True}
         else:
@@ -706,7 +1144,7 @@ def download_controlnet_models_api(app:FastAPI):
         # curl -X POST -F "name=controlnet_xl" http://127.0.0.1:7860/download_controlnet_models/by_name
         if name == "":
             return {"message": "name must not be empty", 'success': False}
-        result = call_download_model_by_name(name)
+        result = await get_gate('download').run(call_download_model_by_name, name)
         if result:
             return {"message": f"Successfully downloaded controlnet models {name}", 'success': True}
         else:
@@ -732,13 +1170,12 @@ def query_api(app:FastAPI):
     Binds Querying API to app
     """
     
-    def walk_get_hashes(path:str, basepath:str = "", size_to_read:int=1<<31):
+    def walk_model_files(path:str, basepath:str = "") -> Dict[str, str]:
         """
-        Walks through path and returns a dict of hashes of files in path
+        Walks through path and returns a dict of model files in path, relative path -> file path
         Removes basepath from file paths
         path : relative path to walk through
         basepath : basepath to start from
-        size_to_read : size to read from each file
         """
         new_dict = {}
         if basepath == "":
@@ -750,37 +1187,54 @@ def query_api(app:FastAPI):
         else:
             path = os.path.join(basepath, path)
         for root, dirs, files in os.walk(path):
+            if STAGING_DIR_NAME in dirs:
+                dirs.remove(STAGING_DIR_NAME) # uploads in progress
             for file in files:
                 #print(root, file)
                 file_path = os.path.join(root, file)
                 if os.path.isfile(file_path) and file.endswith(".safetensors") or file.endswith(".ckpt") or file.endswith(".pt"):
                     file_path_without_basepath = file_path.replace(basepath+'\\', "").replace(basepath+'/', "")
-                    try:
-                        new_dict[file_path_without_basepath] = fast_file_hash(file_path, size_to_read=size_to_read)
-                    except FileNotFoundError:
-                        new_dict[file_path_without_basepath] = ""
+                    new_dict[file_path_without_basepath] = file_path
         return new_dict
+
+    def walk_get_hashes(path:str, basepath:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
+        """
+        Walks through path and returns a dict of hashes of files in path
+        Removes basepath from file paths
+        path : relative path to walk through
+        basepath : basepath to start from
+        size_to_read : size to read from each file
+        hash_mode : "", 'fingerprint' or 'structure', see fast_file_hash
+        hash_algorithm : one of supported_algorithms()
+        """
+        model_files = walk_model_files(path, basepath)
+        hashes = hash_files(list(model_files.values()), partial(fast_file_hash, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm))
+        return {relative_path: hashes[file_path] for relative_path, file_path in model_files.items()}
     
-    def coroutine_walk_get_hashes(path:str, basepath:str = "", size_to_read:int=1<<31):
+    def coroutine_walk_get_hashes(path:str, basepath:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Coroutine version of walk_get_hashes
         """
-        return asyncio.to_thread(walk_get_hashes, path, basepath, size_to_read)
+        return asyncio.to_thread(walk_get_hashes, path, basepath, size_to_read, hash_mode, hash_algorithm)
     
-    def get_hash(path:str = "", size_to_read:int=1<<31):
+    def get_hash(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns the hash of the file at path.
         path may be Stable-diffusion/<model_name>
         """
-        return wrap_return_hash(path, size_to_read=size_to_read)
+        return wrap_return_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     
-    def wrap_return_hash(path:str, size_to_read:int=1<<31):
+    def wrap_return_hash(path:str, size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
+        if hash_options_error(hash_mode, hash_algorithm):
+            return {"message": hash_options_error(hash_mode, hash_algorithm), "hashvalue":"", 'success': False}
         try:
-            return {"message":"", "hashvalue": fast_file_hash(path, size_to_read=size_to_read), 'success': True}
+            hashvalue = fast_file_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
+            return {"message":"", "hashvalue": hashvalue, 'success': True, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm,
+                    'original_hashvalue': get_original_hash(path)}
         except FileNotFoundError as e:
-            return {"message": str(e),"hashvalue":"", 'success': False}
+            return {"message": str(e),"hashvalue":"", 'success': False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
     
-    def get_hash_lora(path:str = "", size_to_read:int=1<<31):
+    def get_hash_lora(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get LoRA/<model_name>)
@@ -788,42 +1242,45 @@ def query_api(app:FastAPI):
         curl -X POST -F "path=some_path/data.safetensors" "http://127.0.0.1:7860/models/query_hash_lora"
         """
         path = os.path.join(get_lora_ckpt_dir(), path)
-        return wrap_return_hash(path, size_to_read=size_to_read)
+        return wrap_return_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     
-    def get_hash_vae(path:str = "", size_to_read:int=1<<31):
+    def get_hash_vae(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get VAE/<model_name>)
         """
         path = os.path.join(get_vae_ckpt_dir(), path)
-        return wrap_return_hash(path, size_to_read=size_to_read)
+        return wrap_return_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
 
-    def get_hash_sd(path:str = "", size_to_read:int=1<<31):
+    def get_hash_sd(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get Stable-diffusion/<model_name>)
         curl -X POST -F "path=some_path/data.safetensors" "http://127.0.0.1:7860/models/query_hash_sd"
         """
         path = os.path.join(get_sd_ckpt_dir(), path)
-        return wrap_return_hash(path, size_to_read=size_to_read)
+        return wrap_return_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
 
-    def get_hash_textual_inversion(path:str = "", size_to_read:int=1<<31):
+    def get_hash_textual_inversion(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get embeddings/<model_name>)
         curl -X POST -F "path=some_path/data.safetensors" "http://127.0.0.1:7860/models/query_hash_embedding"
         """
         path = os.path.join(get_textual_inversion_dir(), path)
-        return wrap_return_hash(path, size_to_read=size_to_read)
+        return wrap_return_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
 
-    def get_hash_lora_all(path:str = "", size_to_read:int=1<<31):
+    def get_hash_lora_all(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns all hashes of all loras in path.
         path may be some folder path
         curl -X POST -F "path=some_path" "http://example.com/models/query_hash_lora_all" -u username:password
         """
         started_at = time.time()
-        json_response = {'success' : False}
+        json_response = {'success' : False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        if hash_options_error(hash_mode, hash_algorithm):
+            json_response['message'] = hash_options_error(hash_mode, hash_algorithm)
+            return json_response
         if path is None or path == "":
             path = get_lora_ckpt_dir()
         else:
@@ -837,17 +1294,20 @@ def query_api(app:FastAPI):
         # recursive
         time_elapsed = time.time() - started_at
         json_response['time_elapsed'] = time_elapsed
-        json_response['hashes'] = walk_get_hashes(path, get_lora_ckpt_dir(), size_to_read=size_to_read)
+        json_response['hashes'] = walk_get_hashes(path, get_lora_ckpt_dir(), size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
         json_response['success'] = True
         return json_response
 
-    def get_hash_vae_all(path:str = "", size_to_read:int=1<<31):
+    def get_hash_vae_all(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns all hashes of all vaes in path.
         path may be some folder path
         """
         started_at = time.time()
-        json_response = {'success' : False}
+        json_response = {'success' : False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        if hash_options_error(hash_mode, hash_algorithm):
+            json_response['message'] = hash_options_error(hash_mode, hash_algorithm)
+            return json_response
         if path is None or path == "":
             path = get_vae_ckpt_dir()
         else:
@@ -861,16 +1321,19 @@ def query_api(app:FastAPI):
         time_elapsed = time.time() - started_at
         json_response['time_elapsed'] = time_elapsed
         json_response['success'] = True
-        json_response['hashes'] = walk_get_hashes(path, get_vae_ckpt_dir(), size_to_read=size_to_read)
+        json_response['hashes'] = walk_get_hashes(path, get_vae_ckpt_dir(), size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
         return json_response
 
-    def get_hash_sd_all(path:str = "", size_to_read:int=1<<31):
+    def get_hash_sd_all(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns all hashes of all sds in path.
         path may be some folder path
         """
         started_at = time.time()
-        json_response = {'success' : False}
+        json_response = {'success' : False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        if hash_options_error(hash_mode, hash_algorithm):
+            json_response['message'] = hash_options_error(hash_mode, hash_algorithm)
+            return json_response
         if path is None or path == "":
             path = get_sd_ckpt_dir()
         else:
@@ -885,17 +1348,20 @@ def query_api(app:FastAPI):
         json_response['time_elapsed'] = time_elapsed
         json_response['success'] = True
         # run in thread, because walk_get_hashes is blocking
-        json_response['hashes'] = walk_get_hashes(path, get_sd_ckpt_dir(), size_to_read=size_to_read)
-        #json_response['hashes'] = walk_get_hashes(path, get_sd_ckpt_dir(), size_to_read=size_to_read)
+        json_response['hashes'] = walk_get_hashes(path, get_sd_ckpt_dir(), size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
+        #json_response['hashes'] = walk_get_hashes(path, get_sd_ckpt_dir(), size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
         return json_response
 
-    def get_hash_textual_inversion_all(path:str = "", size_to_read:int=1<<31):
+    def get_hash_textual_inversion_all(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns all hashes of all embeddings in path.
         path may be some folder path
         """
         started_at = time.time()
-        json_response = {'success' : False}
+        json_response = {'success' : False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        if hash_options_error(hash_mode, hash_algorithm):
+            json_response['message'] = hash_options_error(hash_mode, hash_algorithm)
+            return json_response
         if path is None or path == "":
             path = get_textual_inversion_dir()
         else:
@@ -909,117 +1375,372 @@ def query_api(app:FastAPI):
         time_elapsed = time.time() - started_at
         json_response['time_elapsed'] = time_elapsed
         json_response['success'] = True
-        json_response['hashes'] = walk_get_hashes(path, get_textual_inversion_dir(), size_to_read=size_to_read)
+        json_response['hashes'] = walk_get_hashes(path, get_textual_inversion_dir(), size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
         return json_response
 
-    def get_hash_all(path:str = "", size_to_read:int=1<<31):
+    def get_hash_all(path:str = "", size_to_read:int=1<<31, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM):
         """
         Returns all hashes of everything in path.
         path may be some folder path
         """
         started_at = time.time()
-        json_response_merged = {'success' : False}
+        json_response_merged = {'success' : False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        if hash_options_error(hash_mode, hash_algorithm):
+            json_response_merged['message'] = hash_options_error(hash_mode, hash_algorithm)
+            return json_response_merged
         hashes = {'lora':None, 'vae':None, 'sd':None, 'textual_inversion':None}
         json_response_merged['hashes'] = hashes
-        # responses are async, so we can run them in parallel
-        lora_hashes_result = get_hash_lora_all(path, size_to_read=size_to_read)
-        vae_hashes_result = get_hash_vae_all(path, size_to_read=size_to_read)
-        sd_hashes_result = get_hash_sd_all(path, size_to_read=size_to_read)
-        textual_inversion_hashes_result = get_hash_textual_inversion_all(path, size_to_read=size_to_read)
-        hashes['lora'] = lora_hashes_result['hashes']
-        hashes['vae'] = vae_hashes_result['hashes']
-        hashes['sd'] = sd_hashes_result['hashes']
-        hashes['textual_inversion'] = textual_inversion_hashes_result['hashes']
+        # files of every type are hashed in one schedule, so each device is read with its own parallelism
+        model_dirs = {'lora': get_lora_ckpt_dir(), 'vae': get_vae_ckpt_dir(), 'sd': get_sd_ckpt_dir(), 'textual_inversion': get_textual_inversion_dir()}
+        model_files = {}
+        for model_type, model_dir in model_dirs.items():
+            type_path = os.path.join(model_dir, path) if path else model_dir
+            if os.path.isdir(type_path):
+                model_files[model_type] = walk_model_files(type_path, model_dir)
+        all_files = list(dict.fromkeys(file_path for files in model_files.values() for file_path in files.values()))
+        all_hashes = hash_files(all_files, partial(fast_file_hash, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm))
+        for model_type, files in model_files.items():
+            hashes[model_type] = {relative_path: all_hashes[file_path] for relative_path, file_path in files.items()}
         time_elapsed = time.time() - started_at
         json_response_merged['success'] = True
         json_response_merged['time_elapsed'] = time_elapsed
         return json_response_merged
 
+    def list_hash_entries(model_types:List[str], path:str = "") -> List[Tuple[str, str, str]]:
+        """
+        Returns (model type, relative path, file path) of every model file of model_types in path, sorted by type and relative path
+        """
+        model_dirs = {'lora': get_lora_ckpt_dir, 'vae': get_vae_ckpt_dir, 'sd': get_sd_ckpt_dir, 'textual_inversion': get_textual_inversion_dir}
+        entries = []
+        for model_type in model_types:
+            model_dir = model_dirs[model_type]()
+            type_path = os.path.join(model_dir, path) if path else model_dir
+            if os.path.isdir(type_path):
+                entries.extend((model_type, relative_path, file_path) for relative_path, file_path in walk_model_files(type_path, model_dir).items())
+        return sorted(entries)
+
+    def iter_hash_stream(entries:List[Tuple[str, str, str]], next_cursor:str, encoding:str, size_to_read:int = 1<<31,
+                         hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM) -> Iterator[bytes]:
+        """
+        Hashes the files of entries and yields NDJSON lines {"type", "path", "hashvalue"} as the hashes are computed
+        (largest files first, not in entry order), encoded with encoding. The last line is {"done": true, "count",
+        "next_cursor", ...}, or {"done": false, "error"} if hashing failed.
+        """
+        started_at = time.time()
+        encoder = ResponseEncoder(encoding)
+        file_entries:Dict[str, List[Tuple[str, str]]] = {}
+        for model_type, relative_path, file_path in entries:
+            file_entries.setdefault(file_path, []).append((model_type, relative_path))
+        count = 0
+        try:
+            for batch in iter_hash_files(list(file_entries), partial(fast_file_hash, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)):
+                lines = []
+                for file_path, hashvalue in batch:
+                    for model_type, relative_path in file_entries[file_path]:
+                        lines.append(json.dumps({'type': model_type, 'path': relative_path, 'hashvalue': hashvalue}) + '\n')
+                count += len(lines)
+                yield encoder.encode(''.join(lines).encode('utf-8'))
+            last_line = {'done': True, 'count': count, 'next_cursor': next_cursor, 'hash_mode': hash_mode,
+                         'hash_algorithm': hash_algorithm, 'time_elapsed': time.time() - started_at}
+        except (OSError, ValueError) as e:
+            last_line = {'done': False, 'count': count, 'error': str(e)}
+        yield encoder.encode((json.dumps(last_line) + '\n').encode('utf-8')) + encoder.finish()
+
     @secure_post("/models/query_hash", response_model=HashModelResponse)
-    def get_hash_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    def get_hash_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns the hash of the file at path.
         path may be Stable-diffusion/<model_name>
         Usage : curl -X POST -F "path=some_path/data.safetensors" "http://localhost:7860/models/query_hash" -u username:password
         """
-        return get_hash(path, size_to_read=size_to_read)
+        return get_hash(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     
     @secure_post("/models/query_hash_lora", response_model=HashModelResponse)
-    def get_hash_lora_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    def get_hash_lora_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get LoRA/<model_name>)
         Usage : curl -X POST -F "path=some_path/data.safetensors" "http://localhost:7860/models/query_hash_lora" -u username:password
         """
-        return get_hash_lora(path, size_to_read=size_to_read)
+        return get_hash_lora(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_vae", response_model=HashModelResponse)
-    def get_hash_vae_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    def get_hash_vae_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get VAE/<model_name>)
         Usage : curl -X POST -F "path=some_path/data.safetensors" "http://localhost:7860/models/query_hash_vae" -u username:password
         """
-        return get_hash_vae(path, size_to_read=size_to_read)
+        return get_hash_vae(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_sd", response_model=HashModelResponse)
-    def get_hash_sd_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    def get_hash_sd_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get Stable-diffusion/<model_name>)
         Usage : curl -X POST -F "path=some_path/data.safetensors" "http://localhost:7860/models/query_hash_sd" -u username:password
         """
-        return get_hash_sd(path, size_to_read=size_to_read)
+        return get_hash_sd(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_embedding", response_model=HashModelResponse)
-    def get_hash_textual_inversion_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    def get_hash_textual_inversion_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns the hash of the file at path.
         path may be <model_name> (to get embeddings/<model_name>)
         Usage : curl -X POST -F "path=some_path/data.safetensors" "http://localhost:7860/models/query_hash_embedding" -u username:password
         """
-        return get_hash_textual_inversion(path, size_to_read=size_to_read)
+        return get_hash_textual_inversion(path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_lora_all")
-    def get_hash_lora_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    async def get_hash_lora_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns all hashes of all loras in path.
         path may be some folder path
         Usage : curl -X POST -F "path=some_path" "http://localhost:7860/models/query_hash_lora_all" -u username:password
         """
-        return get_hash_lora_all(path, size_to_read=size_to_read)
+        return await get_gate('hash').run(get_hash_lora_all, path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_vae_all")
-    def get_hash_vae_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    async def get_hash_vae_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns all hashes of all vaes in path.
         path may be some folder path
         Usage : curl -X POST -F "path=some_path" "http://localhost:7860/models/query_hash_vae_all" -u username:password
         """
-        return get_hash_vae_all(path, size_to_read=size_to_read)
+        return await get_gate('hash').run(get_hash_vae_all, path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_sd_all")
-    def get_hash_sd_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    async def get_hash_sd_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns all hashes of all sds in path.
         path may be some folder path
         Usage : curl -X POST -F "path=some_path" "http://localhost:7860/models/query_hash_sd_all" -u username:password
         """
-        return get_hash_sd_all(path, size_to_read=size_to_read)
+        return await get_gate('hash').run(get_hash_sd_all, path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_embedding_all")
-    def get_hash_textual_inversion_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    async def get_hash_textual_inversion_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns all hashes of all embeddings in path.
         path may be some folder path
         Usage : curl -X POST -F "path=some_path" "http://localhost:7860/models/query_hash_embedding_all" -u username:password
         """
-        return get_hash_textual_inversion_all(path, size_to_read=size_to_read)
+        return await get_gate('hash').run(get_hash_textual_inversion_all, path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
     @secure_post("/models/query_hash_all")
-    def get_hash_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31)):
+    async def get_hash_all_wrapper(path:str = Form(""), size_to_read:int=Form(1<<31), hash_mode:str = Form(""), hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
         """
         Returns all hashes of everything in path.
         path may be some folder path
         Usage : curl -X POST -F "path=some_path" "http://localhost:7860/models/query_hash_all" -u username:password
         """
-        return get_hash_all(path, size_to_read=size_to_read)
+        return await get_gate('hash').run(get_hash_all, path, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm)
+
+    def diff_manifest(body:bytes, encoding:str = "") -> dict:
+        """
+        Compares the manifest of a sync source (see sync_diff) with the models here.
+        Files whose size differs are different without hashing, only files of equal size are hashed.
+        Full hashes also match the original hash of a normalized file on either side, see normalize.py.
+        Returns relative paths per model type : missing (only in the manifest), different and extra (only here)
+        """
+        started_at = time.time()
+        try:
+            manifest = json.loads(decode(encoding, body))
+            hash_mode = manifest.get('hash_mode', "")
+            hash_algorithm = manifest.get('hash_algorithm', DEFAULT_ALGORITHM)
+            size_to_read = int(manifest.get('size_to_read', 1<<31))
+            models = {model_type: [(str(path), int(size), str(hashvalue), str(original[0]) if original else "")
+                                   for path, size, hashvalue, *original in items]
+                      for model_type, items in manifest['models'].items()}
+        except (ValueError, TypeError, KeyError, AttributeError, zlib.error, *DECODE_ERRORS) as e:
+            return {"message": f"Invalid manifest : {e}", 'success': False}
+        json_response = {'success': False, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        error = hash_options_error(hash_mode, hash_algorithm)
+        if not error and any(model_type not in HASHED_MODEL_TYPES for model_type in models):
+            error = f"model types must be in {HASHED_MODEL_TYPES}"
+        if error:
+            json_response['message'] = error
+            return json_response
+        local_files = {(model_type, relative_path.replace(os.sep, '/')): file_path for model_type, relative_path, file_path in list_hash_entries(list(models))}
+        full_hashes = not hash_mode and hash_algorithm == DEFAULT_ALGORITHM and size_to_read == DEFAULT_SIZE_TO_READ
+        missing, different, extra = {}, {}, {}
+        to_hash:Dict[str, List[Tuple[str, str, str, str]]] = {} # file path -> (model type, relative path, manifest hash, original hash)
+        for model_type, items in models.items():
+            for relative_path, size, hashvalue, original_hash in items:
+                file_path = local_files.get((model_type, relative_path))
+                try:
+                    local_size = os.path.getsize(file_path) if file_path else None
+                except OSError:
+                    local_size = None
+                if local_size is None:
+                    missing.setdefault(model_type, []).append(relative_path)
+                elif full_hashes and hashvalue == get_original_hash(file_path):
+                    continue # normalized here from the source's file
+                elif local_size != size and not (full_hashes and original_hash):
+                    different.setdefault(model_type, []).append(relative_path)
+                else:
+                    to_hash.setdefault(file_path, []).append((model_type, relative_path, hashvalue, original_hash if full_hashes else ""))
+        hashes = hash_files(list(to_hash), partial(fast_file_hash, size_to_read=size_to_read, hash_mode=hash_mode, hash_algorithm=hash_algorithm))
+        for file_path, entries in to_hash.items():
+            for model_type, relative_path, hashvalue, original_hash in entries:
+                if not hashes[file_path]:
+                    missing.setdefault(model_type, []).append(relative_path) # removed meanwhile
+                elif hashes[file_path] not in (hashvalue, original_hash):
+                    different.setdefault(model_type, []).append(relative_path)
+        source_paths = {(model_type, relative_path) for model_type, items in models.items() for relative_path, *_ in items}
+        for model_type, relative_path in local_files:
+            if (model_type, relative_path) not in source_paths:
+                extra.setdefault(model_type, []).append(relative_path)
+        json_response.update({'success': True, 'message': "", 'missing': missing, 'different': different, 'extra': extra,
+                              'time_elapsed': time.time() - started_at})
+        return json_response
+
+    @secure_post("/sync/diff")
+    async def sync_diff(request:Request):
+        """
+        Compares a manifest of the models of a sync source with the models here in one request.
+        Body : JSON {"models": {"<model type>": [[relative path, size, hashvalue(, original hash)], ...]}, "hash_mode", "hash_algorithm", "size_to_read"},
+        the optional original hash is the upload hash of a file the source normalized.
+        may be compressed with Content-Encoding: zstd or gzip. Model types are lora, vae, sd and textual_inversion.
+        Returns missing (only in the manifest), different and extra (only here) relative paths per model type.
+        Usage : curl -X POST -H "Content-Type: application/json" -d '{"models": {"lora": [["test/a.safetensors", 1234, "<hash>"]]}}' http://localhost:7860/sync/diff
+        """
+        body = await request.body()
+        return await get_gate('hash').run(diff_manifest, body, request.headers.get('content-encoding', ""))
+
+    def get_merkle_directories(modeltype:str = 'lora', paths:List[str] = [""], hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM) -> dict:
+        """
+        Returns the digests and children of the directories paths of the merkle tree of modeltype, see scripts/merkle.py.
+        The tree is refreshed when the root ("") is requested, so a comparison starting at the root sees current files.
+        With full hashes, files normalized here list their original hash after their hash : [kind, digest, original hash].
+        """
+        json_response = {'success': False, 'modeltype': modeltype, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+        error = hash_options_error(hash_mode, hash_algorithm)
+        if not error and modeltype not in HASHED_MODEL_TYPES:
+            error = f"modeltype must be in {HASHED_MODEL_TYPES}"
+        if error:
+            json_response['message'] = error
+            return json_response
+        def list_files() -> Dict[str, str]:
+            return {relative_path: file_path for _, relative_path, file_path in list_hash_entries([modeltype])}
+        tree = get_merkle_tree((modeltype, hash_mode, hash_algorithm), list_files,
+                               partial(hash_files, hash_func=partial(fast_file_hash, hash_mode=hash_mode, hash_algorithm=hash_algorithm)))
+        if "" in paths:
+            tree.refresh()
+        directories = {path: tree.directory(path) for path in paths}
+        if not hash_mode and hash_algorithm == DEFAULT_ALGORITHM:
+            model_dir = get_model_dir(modeltype)
+            for path, directory in directories.items():
+                for name, child in directory['children'].items():
+                    original_hash = get_original_hash(os.path.join(model_dir, path, name)) if child[0] == 'f' else ""
+                    if original_hash:
+                        child.append(original_hash)
+        json_response.update({'success': True, 'message': "", 'directories': directories})
+        return json_response
+
+    @secure_post("/models/merkle")
+    async def get_merkle(modeltype:str = Form('lora'), paths:List[str] = Form([""]), hash_mode:str = Form(""),
+                         hash_algorithm:str = Form(DEFAULT_ALGORITHM)):
+        """
+        Returns the digests of directories of the models of modeltype and the digests of their children, directory -> {"digest", "children": {name: [kind, digest]}}.
+        Kind is 'd' for directories and 'f' for files, the digest of a file is its hash. paths may be repeated, "" is the model directory.
+        Comparing two instances descends from "" only into directories whose digests differ.
+        Usage : curl -X POST -F "modeltype=lora" -F "paths=" -F "paths=test" http://localhost:7860/models/merkle
+        """
+        return await get_gate('hash').run(get_merkle_directories, modeltype, paths, hash_mode, hash_algorithm)
+
+    @secure_post("/models/query_hash_stream")
+    async def get_hash_stream(request:Request, path:str = Form(""), size_to_read:int = Form(1<<31), hash_mode:str = Form(""),
+                              hash_algorithm:str = Form(DEFAULT_ALGORITHM), modeltypes:str = Form("lora,vae,sd,textual_inversion"),
+                              cursor:str = Form(""), limit:int = Form(0)):
+        """
+        Streams the hashes of the models of modeltypes (comma separated) in path as NDJSON, one line per file as soon as
+        its hash is computed. The response is compressed with zstd or gzip if Accept-Encoding allows it.
+        Files are paged in (type, path) order : limit (0 for all) files after cursor are hashed, pass the next_cursor
+        of the last line to get the next page, it is "" after the last page.
+        The hash slot is given back once the page is hashed, lines wait in memory for a slow client.
+        Usage : curl -X POST --compressed -F "modeltypes=lora" -F "limit=1000" "http://localhost:7860/models/query_hash_stream" -u username:password
+        """
+        model_types = [model_type.strip() for model_type in modeltypes.split(',') if model_type.strip()]
+        error = hash_options_error(hash_mode, hash_algorithm)
+        if not error and any(model_type not in HASHED_MODEL_TYPES for model_type in model_types):
+            error = "modeltypes must be a comma separated list of lora, vae, sd and textual_inversion"
+        if not error and cursor and ':' not in cursor:
+            error = f"Invalid cursor {cursor}"
+        if error:
+            return {"message": error, 'success': False}
+        gate = get_gate('hash')
+        await gate.acquire()
+        try:
+            entries = await gate.run_in_executor(list_hash_entries, model_types, path)
+        except BaseException:
+            gate.release()
+            raise
+        if cursor:
+            entries = entries[bisect.bisect_right(entries, tuple(cursor.split(':', 1)) + (chr(0x10ffff),)):]
+        next_cursor = ""
+        if limit > 0 and len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = f"{entries[-1][0]}:{entries[-1][1]}"
+        encoding = choose_response_encoding(request.headers.get('accept-encoding', ""))
+        loop = asyncio.get_running_loop()
+        chunks:asyncio.Queue = asyncio.Queue() # unbounded, at most one page of encoded lines waits for a slow client
+        stopped = threading.Event()
+
+        def produce() -> None:
+            # holds the slot only while hashing, not while the client reads, so a slow client does not block other hash queries
+            iterator = iter_hash_stream(entries, next_cursor, encoding, size_to_read, hash_mode, hash_algorithm)
+            try:
+                for chunk in iterator:
+                    if stopped.is_set():
+                        return
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            finally:
+                iterator.close() # stops the hash workers if the client disconnected
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        producer = gate.executor.submit(produce)
+        producer.add_done_callback(lambda _: loop.call_soon_threadsafe(gate.release))
+
+        async def body():
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                # no await here, the body is cancelled if the client disconnects
+                stopped.set()
+
+        headers = {'Content-Encoding': encoding} if encoding else {}
+        return StreamingResponse(body(), media_type='application/x-ndjson', headers=headers)
     
-    return {func.__name__:func for func in [get_hash, get_hash_lora, get_hash_vae, get_hash_sd, get_hash_textual_inversion, get_hash_lora_all, get_hash_vae_all, get_hash_sd_all, get_hash_textual_inversion_all, get_hash_all]}
+    return {func.__name__:func for func in [get_hash, get_hash_lora, get_hash_vae, get_hash_sd, get_hash_textual_inversion, get_hash_lora_all, get_hash_vae_all, get_hash_sd_all, get_hash_textual_inversion_all, get_hash_all, get_merkle_directories]}
     
     
+model_watcher = None
+
+def start_model_watcher() -> ModelWatcher:
+    """
+    Starts hashing new and changed files of the model directories in the background
+    """
+    global model_watcher
+    if model_watcher is None:
+        roots = []
+        for modeltype in ["sd", "vae", "lora", "textual_inversion", "controlnet"]:
+            try:
+                roots.append(get_model_dir(modeltype))
+            except (AssertionError, ImportError, ModuleNotFoundError):
+                continue
+        model_watcher = ModelWatcher(roots, fast_file_hash)
+        model_watcher.start()
+    return model_watcher
+
+scrubber = None
+
+def start_scrubber(rate:float) -> Scrubber:
+    """
+    Starts rehashing the indexed files in the background, at most rate MB/s
+    """
+    global scrubber
+    if scrubber is None:
+        scrubber = Scrubber(hash_index, rate)
+        scrubber.start()
+    return scrubber
+
 def register_api(_:gr.Blocks, app:FastAPI):
     """
     Registers API to app
@@ -1035,6 +1756,10 @@ def register_api(_:gr.Blocks, app:FastAPI):
     delete_api(app)
     add_token_count_api(app) # auxilary
     api_functions.update(api_functions)
+    if use_model_watcher():
+        start_model_watcher()
+    if get_scrub_rate():
+        start_scrubber(get_scrub_rate())
 
 # only works in context of sdwebui
 try:
@@ -0,0 +1,95 @@
+"""
+Bulk upload of many small files (LoRAs, embeddings, wildcards) as a single streamed tar archive.
+The archive is read from the request body as it arrives, each entry is staged and committed to its final place
+before the next one is read, so neither the archive nor its entries are held in memory.
+"""
+import asyncio
+import posixpath
+import tarfile
+from typing import AsyncIterator, Callable, Dict, Tuple
+
+try:
+    import zstandard
+except (ImportError, ModuleNotFoundError):
+    zstandard = None
+
+COPY_CHUNK_SIZE = 1 << 20
+
+class AsyncStreamReader:
+    """
+    Blocking file-like reader over an async byte stream, for use from a worker thread.
+    Each read pulls the next chunk from the stream on the event loop.
+    """
+    def __init__(self, stream:AsyncIterator[bytes], loop:asyncio.AbstractEventLoop):
+        self.stream = stream
+        self.loop = loop
+        self.buffer = bytearray()
+        self.eof = False
+
+    async def _next_chunk(self) -> bytes:
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+    def _fill(self) -> None:
+        chunk = asyncio.run_coroutine_threadsafe(self._next_chunk(), self.loop).result()
+        if not chunk:
+            self.eof = True
+        self.buffer.extend(chunk)
+
+    def read(self, size:int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+def open_archive_stream(reader, compression:str = ""):
+    """
+    Opens reader as a streamed tar archive, compression may be "" or "zstd" (gzip and bz2 are detected by tarfile)
+    """
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compressed archives require the zstandard package, install it with 'pip install zstandard'")
+        reader = zstandard.ZstdDecompressor().stream_reader(reader)
+    elif compression:
+        raise ValueError(f"Unsupported archive compression {compression}")
+    return tarfile.open(fileobj=reader, mode='r|*')
+
+def normalize_member_name(name:str) -> str:
+    """
+    Returns the '/' separated relative path of an archive member, raises ValueError if it escapes the target
+    """
+    name = posixpath.normpath(name.replace('\\', '/'))
+    if name.startswith('/') or name == '..' or name.startswith('../') or ':' in name:
+        raise ValueError(f"Archive member {name} is not a relative path")
+    return name
+
+def extract_archive(archive:tarfile.TarFile, store_member:Callable[[str, int, object], Tuple[bool, str]]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Extracts regular files of archive one by one.
+    store_member(relative path, size, file object) stores one entry and returns (success, hashvalue or error message).
+    Returns (stored {path: hashvalue}, skipped {path: reason})
+    """
+    stored = {}
+    skipped = {}
+    for member in archive:
+        if member.isdir():
+            continue
+        if not member.isfile():
+            skipped[member.name] = "only regular files are extracted"
+            continue
+        try:
+            name = normalize_member_name(member.name)
+        except ValueError as e:
+            skipped[member.name] = str(e)
+            continue
+        success, result = store_member(name, member.size, archive.extractfile(member))
+        if success:
+            stored[name] = result
+        else:
+            skipped[name] = result
+    return stored, skipped
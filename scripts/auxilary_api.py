@@ -1,6 +1,7 @@
 """
 Auxilary API
 """
+import asyncio
 from functools import reduce
 from fastapi import Form, FastAPI
 from pydantic import BaseModel
@@ -25,7 +26,8 @@ def add_token_count_api(app : FastAPI):
         if not prompt:
             return TokenCountResponse(token_count=0, max_length=0)
         steps = 20 # default steps
-        token_count, max_length = calculate_token(prompt, steps)
+        # tokenizing is CPU bound, keep it off the event loop
+        token_count, max_length = await asyncio.to_thread(calculate_token, prompt, steps)
         return TokenCountResponse(token_count=token_count, max_length=max_length)
         
 def calculate_token(text:str, steps:int):
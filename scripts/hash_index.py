@@ -0,0 +1,319 @@
+"""
+Persistent index of file hashes.
+Entries are keyed by path and algorithm and store the size, mtime_ns and inode of the file when it was hashed, so a file
+replaced outside the API is detected on lookup and hashed again. New hashes are written behind in batches, and the
+database is only opened on first use. The index is a SQLite database in WAL mode, so several workers can share it.
+"""
+import os
+import json
+import atexit
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+from scripts.hashes import BUF_SIZE, DEFAULT_ALGORITHM, DEFAULT_SIZE_TO_READ
+from scripts.paths import basepath
+
+ALL_ALGORITHMS = '*' # pending marker, removes every entry of a path
+SCHEMA_VERSION = 1
+FLUSH_DELAY = 1.0 # seconds a new entry may wait before it is written
+MAX_PENDING = 256 # pending paths which force a write
+BUSY_TIMEOUT_MS = 10000 # other workers may hold the write lock meanwhile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    read_length INTEGER NOT NULL,
+    hashvalue TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS originals (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hashvalue TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mismatches (
+    path TEXT PRIMARY KEY,
+    algorithm TEXT NOT NULL,
+    expected TEXT NOT NULL,
+    actual TEXT NOT NULL,
+    detected REAL NOT NULL
+);
+"""
+
+def read_length(size:int, size_to_read:int) -> int:
+    """
+    Returns the number of bytes a hash of a size bytes file reads, two hashes with equal read lengths are equal
+    """
+    return min(size_to_read, size) // BUF_SIZE * BUF_SIZE
+
+class HashIndex:
+    """
+    Stat validated hash index backed by SQLite.
+    usage :
+        hashvalue = index.get(path, size_to_read) (None if unknown or the file changed)
+        stat = os.stat(path); hashvalue = ...; index.set(path, hashvalue, size_to_read, stat=stat)
+    """
+    def __init__(self, db_path:str, legacy_json_path:str = "", flush_delay:float = FLUSH_DELAY, max_pending:int = MAX_PENDING):
+        self.db_path = db_path
+        self.legacy_json_path = legacy_json_path
+        self.flush_delay = flush_delay
+        self.max_pending = max_pending
+        self.connection:Optional[sqlite3.Connection] = None
+        self.lock = threading.RLock()
+        self.pending:Dict[str, Dict[str, Optional[tuple]]] = {} # path -> algorithm -> row, ALL_ALGORITHMS removes the path
+        self.timer:Optional[threading.Timer] = None
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens the database on first use, creating it and importing file_caches.json if needed
+        """
+        with self.lock:
+            if self.connection is None:
+                os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+                connection = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+                connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent, only the last batch may be lost on power loss
+                if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                    # entries are only a cache, older layouts are dropped and file_caches.json is imported again
+                    connection.executescript("DROP TABLE IF EXISTS hashes; DROP TABLE IF EXISTS meta;")
+                    connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                connection.executescript(SCHEMA)
+                self.connection = connection
+                self.import_legacy_json()
+            return self.connection
+
+    def import_legacy_json(self) -> None:
+        """
+        Imports the path -> hash entries of file_caches.json once, with the current stat of each file
+        """
+        if not self.legacy_json_path or not os.path.exists(self.legacy_json_path):
+            return
+        connection = self.connection
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+            return
+        try:
+            with open(self.legacy_json_path, 'r', encoding='utf-8') as f:
+                file_caches = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not import {self.legacy_json_path} : {e}")
+            file_caches = {}
+        rows = []
+        for file_path, hashvalue in file_caches.items():
+            row = self.make_row(file_path, hashvalue, DEFAULT_SIZE_TO_READ, DEFAULT_ALGORITHM)
+            if row is not None:
+                rows.append(row)
+        with connection:
+            connection.executemany("INSERT OR IGNORE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_json_imported', ?)", (str(time.time()),))
+        print(f"Imported {len(rows)} hashes from {self.legacy_json_path}")
+
+    @staticmethod
+    def make_row(file_path:str, hashvalue:str, size_to_read:int, algorithm:str, stat:Optional[os.stat_result] = None) -> Optional[tuple]:
+        """
+        Returns the row of file_path with stat, the stat taken before hashing. None if the file changed since or is gone.
+        """
+        try:
+            current = os.stat(file_path)
+        except OSError:
+            return None
+        if stat is None:
+            stat = current
+        elif (stat.st_size, stat.st_mtime_ns, stat.st_ino) != (current.st_size, current.st_mtime_ns, current.st_ino):
+            return None # written while it was hashed, hashvalue may belong to neither version
+        return (file_path, stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm,
+                read_length(stat.st_size, size_to_read), hashvalue, time.time())
+
+    def get(self, file_path:str, size_to_read:int = DEFAULT_SIZE_TO_READ, algorithm:str = DEFAULT_ALGORITHM) -> Optional[str]:
+        """
+        Returns the hash of file_path if it is known for size_to_read and algorithm and the file did not change since
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            pending = self.pending.get(file_path, {})
+            if algorithm in pending or ALL_ALGORITHMS in pending:
+                row = pending.get(algorithm)
+            else:
+                row = self.connect().execute("SELECT * FROM hashes WHERE path = ? AND algorithm = ?", (file_path, algorithm)).fetchone()
+        if row is None:
+            return None
+        _, size, mtime_ns, inode, _, row_read_length, hashvalue, _ = row
+        if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            self.remove(file_path) # replaced or modified outside the API
+            return None
+        if row_read_length != read_length(stat.st_size, size_to_read):
+            return None
+        return hashvalue
+
+    def set(self, file_path:str, hashvalue:str, size_to_read:int = DEFAULT_SIZE_TO_READ, algorithm:str = DEFAULT_ALGORITHM,
+            stat:Optional[os.stat_result] = None) -> None:
+        """
+        Stores the hash of file_path, written with the next batch.
+        stat is the stat of file_path taken before it was hashed, the hash is not stored if the file changed since.
+        Without stat the current stat is stored, only for hashes which can not be stale (i.e. of a file just written).
+        """
+        row = self.make_row(file_path, hashvalue, size_to_read, algorithm, stat)
+        if row is None:
+            return
+        with self.lock:
+            self.pending.setdefault(file_path, {})[algorithm] = row
+            self.schedule_flush()
+
+    def remove(self, file_path:str) -> None:
+        """
+        Removes the entries of every algorithm of file_path
+        """
+        with self.lock:
+            self.pending[file_path] = {ALL_ALGORITHMS: None}
+            self.schedule_flush()
+
+    def schedule_flush(self) -> None:
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> None:
+        """
+        Writes pending entries in one transaction
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            connection = self.connect()
+            try:
+                with connection:
+                    removed = [(path,) for path, rows in pending.items() if ALL_ALGORITHMS in rows]
+                    connection.executemany("DELETE FROM hashes WHERE path = ?", removed)
+                    connection.executemany("DELETE FROM mismatches WHERE path = ?", removed)
+                    connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                           [row for rows in pending.values() for row in rows.values() if row is not None])
+            except sqlite3.Error as e:
+                print(f"Could not write hash index {self.db_path} : {e}")
+                for path, rows in pending.items():
+                    # retried with the next batch, entries queued meanwhile are newer
+                    newer = self.pending.get(path, {})
+                    self.pending[path] = newer if ALL_ALGORITHMS in newer else {**rows, **newer}
+
+    def __contains__(self, file_path:str) -> bool:
+        with self.lock:
+            pending = self.pending.get(file_path, {})
+            if any(row is not None for row in pending.values()):
+                return True
+            if ALL_ALGORITHMS in pending:
+                return False
+            return self.connect().execute("SELECT 1 FROM hashes WHERE path = ?", (file_path,)).fetchone() is not None
+
+    def paths(self) -> List[str]:
+        self.flush()
+        with self.lock:
+            return [row[0] for row in self.connect().execute("SELECT DISTINCT path FROM hashes ORDER BY path")]
+
+    def remove_missing(self) -> int:
+        """
+        Removes entries of files which do not exist anymore, returns the number of removed entries
+        """
+        missing = [path for path in self.paths() if not os.path.exists(path)]
+        with self.lock:
+            for path in missing:
+                self.pending[path] = {ALL_ALGORITHMS: None}
+            self.flush()
+            connection = self.connect()
+            with connection:
+                originals = [row[0] for row in connection.execute("SELECT path FROM originals")]
+                connection.executemany("DELETE FROM originals WHERE path = ?", [(path,) for path in originals if not os.path.exists(path)])
+        return len(missing)
+
+    def record_mismatch(self, file_path:str, algorithm:str, expected:str, actual:str) -> None:
+        """
+        Records that file_path hashed to actual while the index holds expected, i.e. found by the scrubber
+        """
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO mismatches VALUES (?, ?, ?, ?, ?)", (file_path, algorithm, expected, actual, time.time()))
+
+    def clear_mismatch(self, file_path:str) -> None:
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM mismatches WHERE path = ?", (file_path,))
+
+    def mismatches(self) -> List[dict]:
+        with self.lock:
+            rows = self.connect().execute("SELECT * FROM mismatches ORDER BY detected").fetchall()
+        return [dict(zip(('path', 'algorithm', 'expected', 'actual', 'detected'), row)) for row in rows]
+
+    def set_original(self, file_path:str, hashvalue:str) -> None:
+        """
+        Records hashvalue, the hash of the upload file_path was normalized from, with the current stat of file_path.
+        Originals are not a cache, they can not be computed again, so clear() and schema upgrades keep them.
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO originals VALUES (?, ?, ?, ?, ?, ?)",
+                                   (file_path, stat.st_size, stat.st_mtime_ns, stat.st_ino, hashvalue, time.time()))
+
+    def get_original(self, file_path:str) -> Optional[str]:
+        """
+        Returns the hash of the upload file_path was normalized from, None if there is none or the file changed since
+        """
+        with self.lock:
+            row = self.connect().execute("SELECT size, mtime_ns, inode, hashvalue FROM originals WHERE path = ?", (file_path,)).fetchone()
+        if row is None:
+            return None
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if tuple(row[:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+        return row[3]
+
+    def clear(self) -> None:
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = {}
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM hashes")
+
+    def close(self) -> None:
+        with self.lock:
+            self.flush()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+hash_index = HashIndex(os.path.join(basepath, 'file_hashes.sqlite3'), os.path.join(basepath, 'file_caches.json'))
+atexit.register(hash_index.close)
@@ -0,0 +1,226 @@
+"""
+Parallel hashing of many files.
+Files are grouped by the device they are stored on and hashed largest first on a thread pool (hashlib releases the GIL).
+Each device gets as many parallel streams as it handles well: many for NVMe, one for spinning disks, two for network
+filesystems. The limits are shared by every running schedule, so concurrent walks do not oversubscribe a disk.
+Concurrent requests for the same hash share one computation (see SingleFlight), so overlapping walks read each file once.
+"""
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+NVME_STREAMS = 16
+SSD_STREAMS = 8
+ROTATIONAL_STREAMS = 1
+NETWORK_STREAMS = 2
+UNKNOWN_STREAMS = 4
+RESULT_QUEUE_SIZE = 1024 # computed hashes which may wait for a slow consumer of iter_hash_files
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'ceph', 'glusterfs', 'lustre', 'fuse.sshfs', 'fuse.rclone', 'afs')
+
+@lru_cache(maxsize=1)
+def get_stream_override() -> Optional[int]:
+    """
+    Returns --uploader-hash-streams, which replaces the detected streams of every device
+    """
+    try:
+        from modules.shared import cmd_opts
+        return getattr(cmd_opts, 'uploader_hash_streams', None)
+    except (ModuleNotFoundError, ImportError):
+        return None
+
+def read_text(path:str) -> str:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def filesystem_type(path:str) -> str:
+    """
+    Returns the filesystem type of the mount containing path from /proc/mounts, "" if unknown
+    """
+    path = os.path.realpath(path)
+    best_mount, best_type = "", ""
+    for line in read_text('/proc/mounts').splitlines():
+        parts = line.split()
+        if len(parts) < 3:
+            continue
+        mount_point = parts[1].replace('\\040', ' ')
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, parts[2]
+    return best_type
+
+@lru_cache(maxsize=64)
+def detect_streams(device:int, path:str) -> int:
+    """
+    Returns the number of parallel hash streams for device, path is any file on it.
+    Uses /sys/dev/block/<major>:<minor> on Linux, other systems get UNKNOWN_STREAMS.
+    """
+    if filesystem_type(path) in NETWORK_FILESYSTEMS:
+        return NETWORK_STREAMS
+    block_dir = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'
+    if not os.path.exists(block_dir):
+        return UNKNOWN_STREAMS # i.e. Windows, macOS or overlay filesystems
+    block_dir = os.path.realpath(block_dir)
+    # partitions have no queue directory, their parent device has
+    queue_dir = os.path.join(block_dir, 'queue')
+    if not os.path.isdir(queue_dir):
+        queue_dir = os.path.join(os.path.dirname(block_dir), 'queue')
+    rotational = read_text(os.path.join(queue_dir, 'rotational'))
+    if rotational == '1':
+        return ROTATIONAL_STREAMS
+    if rotational == '0':
+        return NVME_STREAMS if os.path.basename(os.path.dirname(queue_dir)).startswith('nvme') else SSD_STREAMS
+    return UNKNOWN_STREAMS
+
+class DeviceLimiter:
+    """
+    Hands out one semaphore per device, sized by detect_streams or --uploader-hash-streams
+    """
+    def __init__(self):
+        self.semaphores:Dict[int, threading.BoundedSemaphore] = {}
+        self.streams:Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, device:int, path:str) -> Tuple[threading.BoundedSemaphore, int]:
+        with self.lock:
+            if device not in self.semaphores:
+                streams = max(1, get_stream_override() or detect_streams(device, path))
+                self.streams[device] = streams
+                self.semaphores[device] = threading.BoundedSemaphore(streams)
+            return self.semaphores[device], self.streams[device]
+
+    def status(self) -> dict:
+        return {str(device): streams for device, streams in self.streams.items()}
+
+device_limiter = DeviceLimiter()
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time, callers asking for a key which is being computed wait for that result.
+    usage : hashvalue = hash_flights.run((path, algorithm, length), lambda: compute(path))
+    """
+    def __init__(self):
+        self.flights:Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+    def run(self, key:Hashable, func:Callable[[], Any]) -> Any:
+        """
+        Returns func(), or the result of the running computation of key. Errors of func are raised to every caller.
+        """
+        with self.lock:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.flights[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.flights[key]
+        return future.result()
+
+hash_flights = SingleFlight()
+
+def hash_files(file_paths:List[str], hash_func:Callable[[str], str]) -> Dict[str, str]:
+    """
+    Returns file path -> hash_func(file path) for every file, files which disappeared meanwhile get "".
+    Blocking, runs up to the device limits of hash_func calls in parallel, largest files first.
+    """
+    results = {}
+    for batch in iter_hash_files(file_paths, hash_func):
+        results.update(batch)
+    return results
+
+def iter_hash_files(file_paths:List[str], hash_func:Callable[[str], str]) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Same as hash_files, but yields (file path, hash) pairs as soon as they are computed, in batches of the pairs
+    which are ready. At most RESULT_QUEUE_SIZE results wait for the consumer, so a slow consumer slows down hashing.
+    Closing the generator early stops the workers after their current file.
+    """
+    queues:Dict[int, deque] = {}
+    missing = []
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            missing.append(file_path)
+            continue
+        queues.setdefault(stat.st_dev, []).append((stat.st_size, file_path))
+    if missing:
+        yield [(file_path, "") for file_path in missing]
+    if not queues:
+        return
+    # the largest files start first, so the walk does not end waiting for one large file
+    queues = {device: deque(path for _, path in sorted(files, reverse=True)) for device, files in queues.items()}
+    queue_lock = threading.Lock()
+    results:queue.Queue = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker(device:int, semaphore:threading.BoundedSemaphore) -> None:
+        while not stopped.is_set():
+            with queue_lock:
+                if not queues[device]:
+                    return
+                file_path = queues[device].popleft()
+            with semaphore:
+                try:
+                    hashvalue = hash_func(file_path)
+                except FileNotFoundError:
+                    hashvalue = ""
+            if not put((file_path, hashvalue)):
+                return
+
+    def run_worker(device:int, semaphore:threading.BoundedSemaphore) -> None:
+        try:
+            worker(device, semaphore)
+        except BaseException as e:
+            put(e) # raised by the consumer, like errors of hash_func other than FileNotFoundError in hash_files
+        finally:
+            put(None)
+
+    workers = []
+    for device, device_queue in queues.items():
+        semaphore, streams = device_limiter.get(device, device_queue[0])
+        workers.extend((device, semaphore) for _ in range(min(streams, len(device_queue))))
+    executor = ThreadPoolExecutor(max_workers=len(workers), thread_name_prefix='uploader-hash-worker')
+    try:
+        for device, semaphore in workers:
+            executor.submit(run_worker, device, semaphore)
+        running = len(workers)
+        while running:
+            batch = []
+            item = results.get()
+            while True:
+                if item is None:
+                    running -= 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    batch.append(item)
+                try:
+                    item = results.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                yield batch
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
@@ -0,0 +1,287 @@
+"""
+Hash functions shared by the API and the uploader
+"""
+import os
+import io
+import json
+import mmap
+import hashlib
+from typing import Callable, Dict, Iterator, List
+from scripts.safetensors_header import SafetensorsError, read_header
+
+try:
+    import blake3
+except (ImportError, ModuleNotFoundError):
+    blake3 = None
+
+try:
+    import xxhash
+except (ImportError, ModuleNotFoundError):
+    xxhash = None
+
+BUF_SIZE = 65536 # lets read stuff in 64kb chunks!
+READ_BLOCK_SIZE = 1 << 24 # files are hashed in 16MB blocks, hashing a block releases the GIL
+DEFAULT_SIZE_TO_READ = 1 << 31
+DEFAULT_ALGORITHM = 'sha256'
+# "" hashes the first size_to_read bytes, fingerprint samples blocks over the whole file,
+# structure hashes the safetensors header and a few small samples of tensor data
+HASH_MODES = ("", "fingerprint", "structure")
+FINGERPRINT_BLOCK_SIZE = 1 << 16
+FINGERPRINT_BLOCKS = 8 # head, tail and evenly spaced blocks in between
+FINGERPRINT_VERSION = b'fingerprint-v1'
+STRUCTURE_SAMPLE_SIZE = 1 << 12
+STRUCTURE_SAMPLES = 4
+STRUCTURE_VERSION = b'structure-v1'
+# webui's short hashes, AutoV1 is the sha256 of 64KB at 1MB, AutoV2 the start of the full sha256
+AUTOV1_OFFSET = 0x100000
+AUTOV1_LENGTH = 0x10000
+AUTOV1_DIGITS = 8
+AUTOV2_DIGITS = 10
+
+def get_hash_constructors() -> Dict[str, Callable]:
+    """
+    Returns algorithm name -> constructor of a hashlib-like object, for the algorithms installed here.
+    blake3 hashes large blocks on several threads, xxh3 (128 bit, not cryptographic) is enough to compare files.
+    """
+    constructors = {'sha256': hashlib.sha256, 'blake2b': hashlib.blake2b}
+    if blake3 is not None:
+        constructors['blake3'] = lambda: blake3.blake3(max_threads=blake3.blake3.AUTO)
+    if xxhash is not None:
+        constructors['xxh3'] = xxhash.xxh3_128
+    return constructors
+
+HASH_CONSTRUCTORS = get_hash_constructors()
+
+def supported_algorithms() -> List[str]:
+    return list(HASH_CONSTRUCTORS)
+
+def new_hash(algorithm:str = DEFAULT_ALGORITHM, data:bytes = b''):
+    """
+    Returns a new hash object of algorithm, raises ValueError if it is not installed
+    """
+    if algorithm not in HASH_CONSTRUCTORS:
+        raise ValueError(f"Unsupported hash algorithm {algorithm}, supported algorithms are {supported_algorithms()}")
+    hash_object = HASH_CONSTRUCTORS[algorithm]()
+    if data:
+        hash_object.update(data)
+    return hash_object
+
+def iter_file_blocks(file_obj, length:int, block_size:int = READ_BLOCK_SIZE) -> Iterator[memoryview]:
+    """
+    Yields the first length bytes of file_obj in blocks of block_size, blocks are only valid until the next one.
+    The file is memory mapped with sequential readahead if possible, otherwise it is read into one reused buffer.
+    """
+    if length <= 0:
+        return
+    try:
+        mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        mapped = None
+    if mapped is not None:
+        if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, min(length, len(mapped)), block_size):
+                block = view[offset:offset + min(block_size, length - offset)]
+                try:
+                    yield block
+                finally:
+                    block.release() # the map can only be closed once every view is released
+        finally:
+            view.release()
+            mapped.close()
+        return
+    buffer = memoryview(bytearray(block_size))
+    file_obj.seek(0)
+    while length > 0:
+        read = file_obj.readinto(buffer[:min(block_size, length)])
+        if not read:
+            break
+        yield buffer[:read]
+        length -= read
+
+class FastFileHasher:
+    """
+    Incremental version of fast_file_hash.
+    Only whole BUF_SIZE blocks are hashed (up to size_to_read), then the total file size is appended,
+    so update() can be called with arbitrarily sized chunks and still match a hash computed from disk.
+    """
+    def __init__(self, size_to_read:int = DEFAULT_SIZE_TO_READ, algorithm:str = DEFAULT_ALGORITHM):
+        self.hash = new_hash(algorithm)
+        self.blocks_left = size_to_read // BUF_SIZE
+        self.size = 0
+        self._buffer = bytearray()
+
+    @property
+    def complete(self) -> bool:
+        """
+        True once further data only changes the size, so the rest of a file does not need to be read
+        """
+        return self.blocks_left <= 0
+
+    def update(self, data:bytes) -> None:
+        self.size += len(data)
+        if self.blocks_left <= 0:
+            return
+        self._buffer.extend(data)
+        while len(self._buffer) >= BUF_SIZE and self.blocks_left > 0:
+            self.hash.update(self._buffer[:BUF_SIZE])
+            del self._buffer[:BUF_SIZE]
+            self.blocks_left -= 1
+        if self.blocks_left <= 0:
+            self._buffer = bytearray()
+
+    def hexdigest(self) -> str:
+        hash_object = self.hash.copy()
+        hash_object.update(str(self.size).encode('utf-8'))
+        return hash_object.hexdigest()
+
+class MultiDigestHasher:
+    """
+    Computes several digests of a file from one pass over its data : the hash of fast_file_hash, the full sha256
+    (webui's hash), webui's AutoV1 and AutoV2 short hashes and, if addnet is set, the addnet hash of safetensors
+    (sha256 of the tensor data, used by webui for LoRAs).
+    The hash of fast_file_hash is a snapshot of the full sha256 taken at its last block, so it costs no extra hashing.
+    update() must receive the whole file in order, the digests are only valid once it did.
+    """
+    def __init__(self, size_to_read:int = DEFAULT_SIZE_TO_READ, addnet:bool = False):
+        self.size_to_read = size_to_read
+        self.sha256 = hashlib.sha256()
+        self.prefix = self.sha256.copy()
+        self.prefix_length = 0
+        self.autov1 = bytearray()
+        self.addnet = hashlib.sha256() if addnet else None
+        self.header = bytearray() # first 8 bytes, the safetensors header length
+        self.size = 0
+        self.complete = False # the whole file is needed, see FastFileHasher.complete
+
+    def update(self, data:bytes) -> None:
+        data = memoryview(data).cast('B')
+        start, end = self.size, self.size + len(data)
+        boundary = min(self.size_to_read, end) // BUF_SIZE * BUF_SIZE
+        if boundary > self.prefix_length:
+            self.sha256.update(data[:boundary - start])
+            self.prefix = self.sha256.copy()
+            self.prefix_length = boundary
+            self.sha256.update(data[boundary - start:])
+        else:
+            self.sha256.update(data)
+        if start < AUTOV1_OFFSET + AUTOV1_LENGTH and end > AUTOV1_OFFSET:
+            self.autov1.extend(data[max(AUTOV1_OFFSET - start, 0):AUTOV1_OFFSET + AUTOV1_LENGTH - start])
+        if self.addnet is not None:
+            if start < 8:
+                self.header.extend(data[:8 - start])
+            if len(self.header) == 8:
+                data_offset = 8 + int.from_bytes(self.header, 'little')
+                if end > data_offset:
+                    self.addnet.update(data[max(data_offset - start, 0):])
+        self.size = end
+
+    def hexdigest(self) -> str:
+        hash_object = self.prefix.copy()
+        hash_object.update(str(self.size).encode('utf-8'))
+        return hash_object.hexdigest()
+
+    def digests(self) -> Dict[str, str]:
+        """
+        Returns hashvalue (of fast_file_hash), sha256, autov1, autov2 and addnet (if requested) as hex strings
+        """
+        sha256 = self.sha256.hexdigest()
+        digests = {
+            'hashvalue': self.hexdigest(),
+            'sha256': sha256,
+            'autov1': hashlib.sha256(self.autov1).hexdigest()[:AUTOV1_DIGITS],
+            'autov2': sha256[:AUTOV2_DIGITS],
+        }
+        if self.addnet is not None:
+            digests['addnet'] = self.addnet.hexdigest()
+        return digests
+
+def compute_file_digests(file_path:str, size_to_read:int = DEFAULT_SIZE_TO_READ, addnet:bool = False) -> Dict[str, str]:
+    """
+    Reads the whole file at file_path once and returns the digests of MultiDigestHasher
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Could not find file at {file_path} at func_compute_file_digests")
+    hasher = MultiDigestHasher(size_to_read, addnet)
+    with open(file_path, 'rb') as f:
+        for block in iter_file_blocks(f, os.fstat(f.fileno()).st_size):
+            hasher.update(block)
+    return hasher.digests()
+
+def compute_file_hash(file_path:str, size_to_read:int = DEFAULT_SIZE_TO_READ, algorithm:str = DEFAULT_ALGORITHM) -> str:
+    """
+    Computes a hash of the file at file_path with first size_to_read bytes of file, and total file size
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Could not find file at {file_path} at func_compute_file_hash")
+    with open(file_path, 'rb') as f:
+        return compute_fileobj_hash(f, size_to_read, algorithm)
+
+def compute_fileobj_hash(file_obj, size_to_read:int = DEFAULT_SIZE_TO_READ, algorithm:str = DEFAULT_ALGORITHM) -> str:
+    """
+    Same as compute_file_hash, for an opened binary file. The file position is restored afterwards.
+    Only whole BUF_SIZE blocks are hashed, but they are read in READ_BLOCK_SIZE pieces, which gives the same hash.
+    """
+    position = file_obj.tell()
+    filesize = os.fstat(file_obj.fileno()).st_size
+    hash_object = new_hash(algorithm)
+    for block in iter_file_blocks(file_obj, min(size_to_read, filesize) // BUF_SIZE * BUF_SIZE):
+        hash_object.update(block)
+    file_obj.seek(position)
+    hash_object.update(str(filesize).encode('utf-8'))
+    return hash_object.hexdigest()
+
+def fingerprint_offsets(size:int, block_size:int = FINGERPRINT_BLOCK_SIZE, blocks:int = FINGERPRINT_BLOCKS) -> List[int]:
+    """
+    Returns the offsets of the blocks sampled by a fingerprint of a size bytes file, the first block starts at 0
+    and the last one ends at size
+    """
+    last = size - block_size
+    if last <= 0:
+        return [0] if size else []
+    step = last / (blocks - 1)
+    return sorted({int(step * i) for i in range(blocks)})
+
+def compute_file_fingerprint(file_path:str, algorithm:str = DEFAULT_ALGORITHM) -> str:
+    """
+    Computes a quick fingerprint of the file at file_path from its size and FINGERPRINT_BLOCKS sampled blocks.
+    Files sharing a prefix (i.e. fine-tunes of one model) still differ in the sampled tail and interior blocks,
+    but equal fingerprints only mean the files are probably equal.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Could not find file at {file_path} at func_compute_file_fingerprint")
+    hash_object = new_hash(algorithm, FINGERPRINT_VERSION)
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        hash_object.update(str(size).encode('utf-8'))
+        for offset in fingerprint_offsets(size):
+            f.seek(offset)
+            hash_object.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return hash_object.hexdigest()
+
+def compute_file_structure_hash(file_path:str, algorithm:str = DEFAULT_ALGORITHM) -> str:
+    """
+    Computes a fingerprint of a safetensors file from its header (tensor names, dtypes, shapes, offsets and __metadata__)
+    and STRUCTURE_SAMPLES small samples of the tensor data, which takes a few small reads.
+    Files which are not safetensors get compute_file_fingerprint instead.
+    """
+    if not file_path.endswith('.safetensors'):
+        return compute_file_fingerprint(file_path, algorithm)
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Could not find file at {file_path} at func_compute_file_structure_hash")
+    try:
+        header, data_offset = read_header(file_path)
+    except SafetensorsError:
+        return compute_file_fingerprint(file_path, algorithm)
+    hash_object = new_hash(algorithm, STRUCTURE_VERSION)
+    # keys are sorted, so the hash does not depend on how the header was serialized
+    hash_object.update(json.dumps(header, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        data_size = os.fstat(f.fileno()).st_size - data_offset
+        hash_object.update(str(data_size).encode('utf-8'))
+        for offset in fingerprint_offsets(data_size, STRUCTURE_SAMPLE_SIZE, STRUCTURE_SAMPLES):
+            f.seek(data_offset + offset)
+            hash_object.update(f.read(STRUCTURE_SAMPLE_SIZE))
+    return hash_object.hexdigest()
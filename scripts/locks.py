@@ -0,0 +1,114 @@
+"""
+Locks for destination paths.
+Writers of the same real path (after resolving symlinks and relative parts) are serialized, writers of different
+paths never wait for each other. Entries exist only while someone holds or waits for them.
+With file locking enabled, a lock file in the staging directory of the model directory is locked too,
+so several uvicorn workers or webui instances sharing a model directory (i.e. over NFS) are coordinated.
+"""
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Optional
+from scripts.staging import get_staging_dir
+
+try:
+    import fcntl
+except (ImportError, ModuleNotFoundError):
+    fcntl = None # Windows, only in-process locking is available
+
+LOCK_DIR_NAME = 'locks'
+
+@lru_cache(maxsize=1)
+def use_file_locks() -> bool:
+    """
+    Returns True if --uploader-file-locks is set
+    """
+    try:
+        from modules.shared import cmd_opts
+        return bool(getattr(cmd_opts, 'uploader_file_locks', False))
+    except (ModuleNotFoundError, ImportError):
+        return False
+
+class PathLock:
+    """
+    Lock of a single path, users counts the threads holding or waiting for it
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+class PathLockManager:
+    """
+    Hands out locks keyed on the real path, entries are removed when their last user releases them.
+    usage : with path_locks.lock(real_file_path, model_dir): ...
+    """
+    def __init__(self, file_locks:Optional[bool] = None):
+        self.file_locks = file_locks
+        self.locks:Dict[str, PathLock] = {}
+        self.entries_lock = threading.Lock()
+
+    @staticmethod
+    def key(path:str) -> str:
+        return os.path.normcase(os.path.realpath(path))
+
+    def file_locks_enabled(self) -> bool:
+        if fcntl is None:
+            return False
+        return use_file_locks() if self.file_locks is None else self.file_locks
+
+    def _acquire(self, key:str) -> PathLock:
+        with self.entries_lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = PathLock()
+            entry.users += 1
+        entry.lock.acquire()
+        return entry
+
+    def _release(self, key:str, entry:PathLock) -> None:
+        entry.lock.release()
+        with self.entries_lock:
+            entry.users -= 1
+            if entry.users == 0:
+                del self.locks[key]
+
+    def lock_file_path(self, key:str, model_dir:str) -> str:
+        """
+        Returns the lock file of key, named after the path relative to model_dir so every host mounting
+        the directory elsewhere still uses the same file
+        """
+        model_dir = self.key(model_dir)
+        relative_path = os.path.relpath(key, model_dir).replace(os.sep, '/')
+        name = hashlib.sha1(relative_path.encode('utf-8')).hexdigest() + '.lock'
+        return os.path.join(get_staging_dir(model_dir), LOCK_DIR_NAME, name)
+
+    @contextmanager
+    def lock(self, path:str, model_dir:Optional[str] = None):
+        """
+        Holds the lock of path. If file locking is enabled and model_dir is given, the lock file is locked as well
+        """
+        key = self.key(path)
+        entry = self._acquire(key)
+        try:
+            if model_dir and self.file_locks_enabled():
+                lock_file_path = self.lock_file_path(key, model_dir)
+                os.makedirs(os.path.dirname(lock_file_path), exist_ok=True)
+                # lockf uses POSIX record locks, which NFS forwards to the server unlike flock.
+                # lock files are never removed, removing them would let two holders lock different files
+                with open(lock_file_path, 'a+b') as lock_file:
+                    fcntl.lockf(lock_file.fileno(), fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.lockf(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                yield
+        finally:
+            self._release(key, entry)
+
+    def __len__(self) -> int:
+        return len(self.locks)
+
+path_locks = PathLockManager()
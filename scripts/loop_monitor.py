@@ -0,0 +1,61 @@
+"""
+Event loop lag monitor.
+A task sleeps for a fixed interval and measures how late it wakes up. Lag means a handler blocked the event loop,
+which stalls every other API route (webui's own included) for that long.
+"""
+import asyncio
+import time
+from logging import getLogger
+
+logger = getLogger("Auxilary API")
+
+class EventLoopLagMonitor:
+    """
+    Measures event loop lag every interval seconds, lags above warn_threshold seconds are logged.
+    ensure_started() must be called from the event loop, i.e. in an async endpoint.
+    """
+    def __init__(self, interval:float = 0.5, warn_threshold:float = 1.0):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.task = None
+        self.started_at = 0.0
+        self.samples = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.stalls = 0 # samples above warn_threshold
+
+    def ensure_started(self) -> None:
+        if self.task is None or self.task.done():
+            self.started_at = time.time()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled_at = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - scheduled_at - self.interval))
+
+    def record(self, lag:float) -> None:
+        self.samples += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        if lag >= self.warn_threshold:
+            self.stalls += 1
+            logger.warning(f"Event loop was blocked for {lag:.2f} seconds")
+
+    def status(self) -> dict:
+        return {
+            'running': self.task is not None and not self.task.done(),
+            'monitored_seconds': time.time() - self.started_at if self.started_at else 0.0,
+            'samples': self.samples,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'mean_lag': self.total_lag / self.samples if self.samples else 0.0,
+            'stalls': self.stalls,
+            'warn_threshold': self.warn_threshold,
+        }
+
+loop_monitor = EventLoopLagMonitor()
@@ -0,0 +1,141 @@
+"""
+Merkle trees of directory digests of the model roots.
+The digest of a directory covers the names and hashes of every model file below it, so two instances whose root digests
+are equal hold the same files, and a comparison only descends into directories whose digests differ.
+Trees are kept in memory and refreshed with a stat walk when a comparison starts : only new and changed files are hashed
+(usually found in the hash index), and only the digests of their ancestor directories are computed again.
+"""
+import os
+import time
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+DIRECTORY = 'd'
+FILE = 'f'
+
+def join_relative(directory:str, name:str) -> str:
+    return f"{directory}/{name}" if directory else name
+
+class MerkleTree:
+    """
+    Directory digests of the files of one model root, relative paths use '/' and the root is "".
+    list_files returns relative path -> file path of the files in the root, hash_files file paths -> hashes ("" if removed).
+    usage : tree = MerkleTree(list_files, hash_files); tree.refresh(); tree.directory("sub/dir")
+    """
+    def __init__(self, list_files:Callable[[], Dict[str, str]], hash_files:Callable[[List[str]], Dict[str, str]]):
+        self.list_files = list_files
+        self.hash_files = hash_files
+        self.lock = threading.RLock()
+        self.files:Dict[str, Tuple[tuple, str]] = {} # relative path -> (size, mtime_ns, inode), hash
+        self.tree:Dict[str, Dict[str, str]] = {"": {}} # directory -> child name -> DIRECTORY or FILE
+        self.digests:Dict[str, str] = {} # directory -> digest, removed when a file below changes
+        self.refresh_started:Optional[float] = None
+
+    def refresh(self) -> int:
+        """
+        Stats every file of the root and updates the tree with new, changed and removed files, returns the number of updated files.
+        Callers which waited for a refresh started after their call share its result.
+        """
+        requested = time.monotonic()
+        with self.lock:
+            if self.refresh_started is not None and self.refresh_started >= requested:
+                return 0
+            self.refresh_started = time.monotonic()
+            file_paths = {relative_path.replace(os.sep, '/'): file_path for relative_path, file_path in self.list_files().items()}
+            stats = {}
+            for relative_path, file_path in file_paths.items():
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                stats[relative_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            changed = [relative_path for relative_path, stat_key in stats.items()
+                       if relative_path not in self.files or self.files[relative_path][0] != stat_key]
+            removed = [relative_path for relative_path in self.files if relative_path not in stats]
+            hashes = self.hash_files([file_paths[relative_path] for relative_path in changed]) if changed else {}
+            for relative_path in removed:
+                self.remove_file(relative_path)
+            for relative_path in changed:
+                hashvalue = hashes.get(file_paths[relative_path], "")
+                if hashvalue:
+                    self.set_file(relative_path, stats[relative_path], hashvalue)
+                elif relative_path in self.files:
+                    self.remove_file(relative_path)
+            return len(changed) + len(removed)
+
+    def invalidate(self, relative_path:str) -> None:
+        """
+        Removes the digests of the directories containing relative_path
+        """
+        parts = relative_path.split('/')
+        for depth in range(len(parts)):
+            self.digests.pop('/'.join(parts[:depth]), None)
+
+    def set_file(self, relative_path:str, stat_key:tuple, hashvalue:str) -> None:
+        parts = relative_path.split('/')
+        for depth in range(len(parts)):
+            parent = '/'.join(parts[:depth])
+            self.tree.setdefault(parent, {})[parts[depth]] = FILE if depth == len(parts) - 1 else DIRECTORY
+        self.files[relative_path] = (stat_key, hashvalue)
+        self.invalidate(relative_path)
+
+    def remove_file(self, relative_path:str) -> None:
+        """
+        Removes relative_path and the directories which become empty
+        """
+        self.files.pop(relative_path, None)
+        self.invalidate(relative_path)
+        parts = relative_path.split('/')
+        for depth in range(len(parts) - 1, -1, -1):
+            parent = '/'.join(parts[:depth])
+            child = '/'.join(parts[:depth + 1])
+            if child in self.files or self.tree.get(child):
+                break # the directory still contains files
+            self.tree.pop(child, None)
+            self.tree.get(parent, {}).pop(parts[depth], None)
+
+    def digest(self, directory:str) -> str:
+        """
+        Returns the sha256 of the sorted (kind, name, digest) entries of directory, computed again only below changes
+        """
+        if directory in self.digests:
+            return self.digests[directory]
+        hasher = hashlib.sha256()
+        for name, kind, child_digest in self.children(directory):
+            hasher.update(f"{kind}\0{name}\0{child_digest}\n".encode('utf-8'))
+        self.digests[directory] = hasher.hexdigest()
+        return self.digests[directory]
+
+    def children(self, directory:str) -> List[Tuple[str, str, str]]:
+        """
+        Returns (name, kind, digest) of the children of directory sorted by name, the digest of a file is its hash
+        """
+        entries = []
+        for name, kind in sorted(self.tree.get(directory, {}).items()):
+            child = join_relative(directory, name)
+            entries.append((name, kind, self.digest(child) if kind == DIRECTORY else self.files[child][1]))
+        return entries
+
+    def directory(self, directory:str) -> dict:
+        """
+        Returns {"digest", "children": {name: [kind, digest]}} of directory, an empty digest if it does not exist
+        """
+        directory = directory.replace('\\', '/').strip('/')
+        with self.lock:
+            if directory and directory not in self.tree:
+                return {'digest': "", 'children': {}}
+            return {'digest': self.digest(directory),
+                    'children': {name: [kind, child_digest] for name, kind, child_digest in self.children(directory)}}
+
+merkle_trees:Dict[tuple, MerkleTree] = {}
+merkle_trees_lock = threading.Lock()
+
+def get_merkle_tree(key:tuple, list_files:Callable[[], Dict[str, str]], hash_files:Callable[[List[str]], Dict[str, str]]) -> MerkleTree:
+    """
+    Returns the tree of key, i.e. (model type, hash mode, hash algorithm), created on first use
+    """
+    with merkle_trees_lock:
+        if key not in merkle_trees:
+            merkle_trees[key] = MerkleTree(list_files, hash_files)
+        return merkle_trees[key]
@@ -0,0 +1,197 @@
+"""
+Background hashing of new and changed models.
+The model directories are watched with watchdog (inotify on Linux) if it is installed, otherwise they are polled.
+A changed file is hashed once its size and mtime stopped changing for STABLE_SECONDS, on a low priority thread,
+so the hash queries of the next sync find it in the hash index.
+"""
+import os
+import time
+import threading
+from functools import lru_cache
+from logging import getLogger
+from typing import Callable, Dict, List, Optional, Tuple
+from scripts.staging import STAGING_DIR_NAME
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except (ImportError, ModuleNotFoundError):
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = getLogger("Auxilary API")
+
+MODEL_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin')
+STABLE_SECONDS = 5.0 # a file is hashed once it did not change for this long
+CHECK_INTERVAL = 1.0 # seconds between checks of pending files
+POLL_INTERVAL = 60.0 # seconds between walks when watchdog is not installed
+WORKER_NICENESS = 19
+
+@lru_cache(maxsize=1)
+def use_model_watcher() -> bool:
+    """
+    Returns True if --uploader-watch-models is set
+    """
+    try:
+        from modules.shared import cmd_opts
+        return bool(getattr(cmd_opts, 'uploader_watch_models', False))
+    except (ModuleNotFoundError, ImportError):
+        return False
+
+def is_model_file(path:str) -> bool:
+    return path.endswith(MODEL_EXTENSIONS) and STAGING_DIR_NAME not in path.split(os.sep)
+
+def lower_thread_priority() -> None:
+    """
+    Lowers the CPU priority of the calling thread, Linux applies nice values per thread
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), WORKER_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+class WatchEventHandler(FileSystemEventHandler):
+    """
+    Passes created, modified and moved model files of watchdog to the watcher
+    """
+    def __init__(self, watcher:'ModelWatcher'):
+        self.watcher = watcher
+
+    def on_any_event(self, event) -> None:
+        if event.is_directory:
+            return
+        path = getattr(event, 'dest_path', "") or event.src_path
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if event.event_type in ('created', 'modified', 'moved', 'closed'):
+            self.watcher.touch(path)
+
+class ModelWatcher:
+    """
+    Watches roots for new and changed model files and calls hash_func(path) for each once it is stable.
+    usage : watcher = ModelWatcher(roots, fast_file_hash); watcher.start()
+    """
+    def __init__(self, roots:List[str], hash_func:Callable[[str], str], stable_seconds:float = STABLE_SECONDS, poll_interval:float = POLL_INTERVAL):
+        self.roots = sorted({os.path.realpath(root) for root in roots if root and os.path.isdir(root)})
+        self.hash_func = hash_func
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.pending:Dict[str, Tuple[int, int, float]] = {} # path -> (size, mtime_ns, time of last change)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread:Optional[threading.Thread] = None
+        self.observer = None
+        self.snapshot:Dict[str, Tuple[int, int]] = {} # polling only, path -> (size, mtime_ns)
+        self.hashed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        if Observer is not None:
+            self.observer = Observer()
+            handler = WatchEventHandler(self)
+            for root in self.roots:
+                self.observer.schedule(handler, root, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+        self.thread = threading.Thread(target=self.run, name='uploader-model-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+
+    def touch(self, path:str) -> None:
+        """
+        Marks path as changed, it is hashed once it stays unchanged for stable_seconds
+        """
+        if not is_model_file(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self.lock:
+                self.pending.pop(path, None)
+            return
+        with self.lock:
+            previous = self.pending.get(path)
+            if previous is None or previous[:2] != (stat.st_size, stat.st_mtime_ns):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+    def scan(self) -> None:
+        """
+        Walks every root and marks new or changed files, the first scan marks every file so the index is warmed
+        """
+        snapshot = {}
+        for root in self.roots:
+            for directory, dirs, files in os.walk(root):
+                if STAGING_DIR_NAME in dirs:
+                    dirs.remove(STAGING_DIR_NAME)
+                for file in files:
+                    path = os.path.join(directory, file)
+                    if not is_model_file(path):
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+                    if self.snapshot.get(path) != snapshot[path]:
+                        self.touch(path)
+        self.snapshot = snapshot
+
+    def stable_files(self) -> List[str]:
+        """
+        Returns pending files which did not change for stable_seconds and removes them from pending
+        """
+        now = time.monotonic()
+        stable = []
+        with self.lock:
+            for path, (size, mtime_ns, changed_at) in list(self.pending.items()):
+                if now - changed_at < self.stable_seconds:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del self.pending[path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    self.pending[path] = (stat.st_size, stat.st_mtime_ns, now) # still being written
+                    continue
+                del self.pending[path]
+                stable.append(path)
+        return stable
+
+    def run(self) -> None:
+        lower_thread_priority()
+        last_scan = None
+        while not self.stopped.is_set():
+            # without watchdog changes are only found by walking, with it the first walk warms the index
+            if last_scan is None or (self.observer is None and time.monotonic() - last_scan >= self.poll_interval):
+                try:
+                    self.scan()
+                except OSError as e:
+                    logger.warning(f"Could not scan model directories : {e}")
+                last_scan = time.monotonic()
+            for path in self.stable_files():
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.hash_func(path)
+                    self.hashed += 1
+                except OSError as e:
+                    self.failed += 1
+                    logger.warning(f"Could not hash {path} : {e}")
+            self.stopped.wait(CHECK_INTERVAL)
+
+    def status(self) -> dict:
+        return {
+            'running': self.thread is not None and self.thread.is_alive(),
+            'mode': 'watchdog' if self.observer is not None else 'polling',
+            'roots': self.roots,
+            'pending': len(self.pending),
+            'hashed': self.hashed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,103 @@
+"""
+Streaming multipart/form-data request body for uploading a single file.
+The file is memory mapped (or read in large blocks where mmap is not possible) and handed to requests block by block,
+so memory usage stays flat and Content-Length is known before anything is sent.
+"""
+import os
+import mmap
+import uuid
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from scripts.transfer_encoding import open_encoder
+
+READ_BLOCK_SIZE = 1 << 23 # 8MB blocks
+
+def quote_field(value:str) -> str:
+    """
+    Escapes a Content-Disposition parameter value
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\r', '%0D').replace('\n', '%0A')
+
+class MultipartFileEncoder:
+    """
+    Iterable request body with text fields followed by one file.
+    Fields are sent first, so the server knows the destination (and the size) before the file data arrives.
+    callback(bytes_sent, total) is called after each block.
+    If encoding is given (i.e. zstd), the file part is compressed while it is sent. The length is not known then,
+    so the body must be sent chunked, and the callback reports the progress through the file instead.
+    usage : requests.post(url, data=encoder, headers={'Content-Type': encoder.content_type})
+            requests.post(url, data=iter(encoder), headers={'Content-Type': encoder.content_type}) (encoded)
+    """
+    def __init__(self, fields:Dict[str, str], file_field:str, filename:str, file_obj,
+                 callback:Optional[Callable[[int, int], None]] = None, content_type:str = 'application/octet-stream',
+                 encoding:str = ""):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self.file_obj = file_obj
+        self.file_size = os.fstat(file_obj.fileno()).st_size
+        self.callback = callback
+        self.encoding = encoding
+        preamble = b''
+        for name, value in fields.items():
+            preamble += (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{quote_field(name)}"\r\n\r\n').encode('utf-8')
+            preamble += str(value).encode('utf-8') + b'\r\n'
+        preamble += (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{quote_field(file_field)}"; '
+                     f'filename="{quote_field(filename)}"\r\nContent-Type: {content_type}\r\n\r\n').encode('utf-8')
+        self.preamble = preamble
+        self.epilogue = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.len = len(self.preamble) + self.file_size + len(self.epilogue) # before encoding
+
+    def __len__(self) -> int:
+        return self.len
+
+    def iter_file(self) -> Iterator[bytes]:
+        """
+        Yields the file in READ_BLOCK_SIZE blocks, as memoryviews of a memory map when possible
+        """
+        if self.file_size == 0:
+            return
+        try:
+            mapped = mmap.mmap(self.file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            mapped = None
+        if mapped is None:
+            self.file_obj.seek(0)
+            while True:
+                block = self.file_obj.read(READ_BLOCK_SIZE)
+                if not block:
+                    return
+                yield block
+        try:
+            if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, self.file_size, READ_BLOCK_SIZE):
+                    block = view[offset:offset + READ_BLOCK_SIZE]
+                    try:
+                        yield block
+                    finally:
+                        block.release() # sent by now, the map can only be closed once every view is released
+            finally:
+                view.release()
+        finally:
+            mapped.close()
+
+    def iter_encoded(self) -> Iterator[Tuple[bytes, int]]:
+        """
+        Yields (compressed data, file bytes consumed)
+        """
+        encoder = open_encoder(self.encoding)
+        for block in self.iter_file():
+            yield encoder.compress(block), len(block)
+        yield encoder.flush(), 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        sent = 0
+        file_blocks = self.iter_encoded() if self.encoding else ((block, len(block)) for block in self.iter_file())
+        for part in [(self.preamble, len(self.preamble))], file_blocks, [(self.epilogue, len(self.epilogue))]:
+            for data, progress in part:
+                if data:
+                    yield data
+                sent += progress
+                if self.callback is not None:
+                    self.callback(sent, self.len)
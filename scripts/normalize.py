@@ -0,0 +1,172 @@
+"""
+Optional normalization of uploaded models.
+Pickle checkpoints (.ckpt, .pt, .pth, .bin) are converted to safetensors, and float32/float64 tensors may be cast to float16.
+Tensors are read and written one at a time (safetensors through a memory map, pickles through torch.load(mmap=True)),
+so memory usage stays around the size of the largest tensor.
+The hash of the uploaded file is kept in the safetensors metadata, and in the hash index as an alias of the normalized
+file, so syncs can still compare against the original. Clearing the hash caches keeps the alias.
+The sync hash of the normalized file is the hash of its content.
+"""
+import os
+import json
+import mmap
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+from scripts.safetensors_header import DTYPE_SIZES, read_header
+from scripts.hash_index import hash_index
+
+try:
+    import numpy as np
+except (ImportError, ModuleNotFoundError):
+    np = None
+
+NORMALIZE_MODES = ("", "safetensors", "fp16") # "" keeps the upload as it is
+PICKLE_EXTENSIONS = ('.ckpt', '.pt', '.pth', '.bin')
+CAST_DTYPES = ('F32', 'F64') # cast to F16 in fp16 mode, BF16 is kept since its range does not fit F16
+ORIGINAL_HASH_KEY = 'uploader_original_hash'
+
+class NormalizeError(ValueError):
+    """
+    Raised when a file can not be normalized
+    """
+
+def normalized_filename(filename:str, mode:str) -> str:
+    """
+    Returns the name the normalized file is stored with, pickle checkpoints get the .safetensors extension
+    """
+    stem, extension = os.path.splitext(filename)
+    if mode and extension.lower() in PICKLE_EXTENSIONS:
+        return stem + '.safetensors'
+    return filename
+
+def register_original_hash(file_path:str, original_hash:str) -> None:
+    """
+    Registers original_hash, the hash of the upload file_path was normalized from, as an alias of file_path.
+    Only uploads normalized here are registered, the metadata of a received file is not trusted.
+    """
+    hash_index.set_original(file_path, original_hash)
+
+def get_original_hash(file_path:str) -> str:
+    """
+    Returns the upload hash file_path was normalized from, "" if it was not normalized here or changed since
+    """
+    return hash_index.get_original(file_path) or ""
+
+def write_safetensors(target_path:str, tensors:List[Tuple[str, str, list, int, Callable[[], bytes]]], metadata:Optional[Dict[str, str]] = None) -> None:
+    """
+    Writes a safetensors file. tensors are (name, dtype, shape, byte length, read), read() returns the tensor data
+    and is called once per tensor, in order, after the header is written.
+    """
+    header = {}
+    offset = 0
+    for name, dtype, shape, length, _ in tensors:
+        header[name] = {'dtype': dtype, 'shape': shape, 'data_offsets': [offset, offset + length]}
+        offset += length
+    if metadata:
+        header['__metadata__'] = metadata
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 8) # tensor data starts 8 byte aligned
+    with open(target_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, _, _, length, read in tensors:
+            data = read()
+            if len(data) != length:
+                raise NormalizeError(f"Tensor {name} has {len(data)} bytes, expected {length}")
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def normalize_safetensors(source_path:str, target_path:str, fp16:bool, original_hash:str = "") -> bool:
+    """
+    Casts float tensors of a safetensors file to float16, returns False if there was nothing to cast
+    """
+    header, data_offset = read_header(source_path)
+    entries = sorted(((name, info) for name, info in header.items() if name != '__metadata__'),
+                     key=lambda item: item[1]['data_offsets'][0])
+    if not fp16 or not any(info['dtype'] in CAST_DTYPES for _, info in entries):
+        return False
+    if np is None:
+        raise NormalizeError("Casting to fp16 requires numpy")
+    metadata = dict(header.get('__metadata__', {}))
+    if original_hash:
+        metadata[ORIGINAL_HASH_KEY] = original_hash
+    with open(source_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        def reader(info:dict) -> Callable[[], bytes]:
+            begin, end = info['data_offsets']
+            def read() -> bytes:
+                if info['dtype'] not in CAST_DTYPES:
+                    return mapped[data_offset + begin:data_offset + end]
+                source_dtype = '<f4' if info['dtype'] == 'F32' else '<f8'
+                count = (end - begin) // DTYPE_SIZES[info['dtype']]
+                return np.frombuffer(mapped, dtype=source_dtype, count=count, offset=data_offset + begin).astype('<f2').tobytes()
+            return read
+        tensors = []
+        for name, info in entries:
+            dtype = 'F16' if info['dtype'] in CAST_DTYPES else info['dtype']
+            length = info['data_offsets'][1] - info['data_offsets'][0]
+            if dtype != info['dtype']:
+                length = length // DTYPE_SIZES[info['dtype']] * DTYPE_SIZES['F16']
+            tensors.append((name, dtype, info['shape'], length, reader(info)))
+        write_safetensors(target_path, tensors, metadata)
+    return True
+
+def convert_pickle(source_path:str, target_path:str, fp16:bool, original_hash:str = "") -> bool:
+    """
+    Converts the tensors of a pickle checkpoint to safetensors, optionally casting float tensors to float16.
+    Only plain tensor checkpoints are loaded (weights_only), anything else is rejected instead of being unpickled.
+    """
+    try:
+        import torch
+    except (ImportError, ModuleNotFoundError) as e:
+        raise NormalizeError("Converting pickle checkpoints requires torch") from e
+    dtypes = {
+        torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+        torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8', torch.uint8: 'U8', torch.bool: 'BOOL',
+    }
+    try:
+        try:
+            state = torch.load(source_path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            # mmap requires the zipfile format, legacy checkpoints are loaded into memory
+            state = torch.load(source_path, map_location='cpu', weights_only=True)
+    except Exception as e:
+        raise NormalizeError(f"Could not load {os.path.basename(source_path)} as a weights only checkpoint : {e}") from e
+    if isinstance(state, dict) and isinstance(state.get('state_dict'), dict):
+        state = state['state_dict']
+    if not isinstance(state, dict):
+        raise NormalizeError("Checkpoint is not a dict of tensors")
+    tensors = []
+    for name, tensor in state.items():
+        if not isinstance(tensor, torch.Tensor) or tensor.dtype not in dtypes:
+            continue # i.e. global_step
+        target_dtype = torch.float16 if fp16 and dtypes[tensor.dtype] in CAST_DTYPES else tensor.dtype
+        def read(tensor=tensor, target_dtype=target_dtype) -> bytes:
+            return tensor.detach().to(target_dtype).contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+        length = tensor.numel() * DTYPE_SIZES[dtypes[target_dtype]]
+        tensors.append((str(name), dtypes[target_dtype], list(tensor.shape), length, read))
+    if not tensors:
+        raise NormalizeError("Checkpoint does not contain tensors")
+    write_safetensors(target_path, tensors, {ORIGINAL_HASH_KEY: original_hash} if original_hash else None)
+    return True
+
+def normalize_file(source_path:str, target_path:str, filename:str, mode:str, original_hash:str = "") -> bool:
+    """
+    Writes the normalized form of source_path (uploaded as filename) to target_path.
+    Returns False if the file is already normalized, target_path is not written then.
+    """
+    if mode not in NORMALIZE_MODES:
+        raise NormalizeError(f"Unknown normalize mode {mode}, expected one of {NORMALIZE_MODES}")
+    if not mode:
+        return False
+    fp16 = mode == 'fp16'
+    try:
+        if os.path.splitext(filename)[1].lower() in PICKLE_EXTENSIONS:
+            return convert_pickle(source_path, target_path, fp16, original_hash)
+        if filename.endswith('.safetensors'):
+            return normalize_safetensors(source_path, target_path, fp16, original_hash)
+    except BaseException:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+    return False
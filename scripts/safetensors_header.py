@@ -0,0 +1,136 @@
+"""
+Safetensors header parsing.
+A safetensors file is an 8 byte little-endian header length, a JSON header describing every tensor
+(dtype, shape, data_offsets), then the tensor data. The header alone tells the exact size of the file.
+"""
+import json
+import struct
+from typing import Tuple
+
+MAX_HEADER_SIZE = 100_000_000 # same limit as the safetensors library
+DTYPE_SIZES = {
+    'BOOL': 1, 'U8': 1, 'I8': 1, 'F8_E5M2': 1, 'F8_E4M3': 1,
+    'I16': 2, 'U16': 2, 'F16': 2, 'BF16': 2,
+    'I32': 4, 'U32': 4, 'F32': 4,
+    'I64': 8, 'U64': 8, 'F64': 8,
+}
+
+class SafetensorsError(ValueError):
+    """
+    Raised when a safetensors header is malformed or does not match the file
+    """
+
+def parse_header_length(prefix:bytes) -> int:
+    """
+    Returns the header length from the first 8 bytes of a safetensors file
+    """
+    header_length = struct.unpack('<Q', prefix[:8])[0]
+    if header_length > MAX_HEADER_SIZE:
+        raise SafetensorsError(f"Safetensors header length {header_length} is larger than {MAX_HEADER_SIZE}")
+    return header_length
+
+def parse_header(header_bytes:bytes) -> dict:
+    """
+    Parses and validates the JSON header, returns it as a dict
+    """
+    try:
+        header = json.loads(header_bytes.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise SafetensorsError(f"Safetensors header is not valid JSON : {e}") from e
+    if not isinstance(header, dict):
+        raise SafetensorsError("Safetensors header is not a JSON object")
+    metadata = header.get('__metadata__', {})
+    if not isinstance(metadata, dict) or not all(isinstance(v, str) for v in metadata.values()):
+        raise SafetensorsError("Safetensors __metadata__ must map strings to strings")
+    data_length(header) # validates tensor entries
+    return header
+
+def data_length(header:dict) -> int:
+    """
+    Returns the length of the tensor data described by header, raises SafetensorsError if the offsets are inconsistent
+    """
+    offsets = []
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        if not isinstance(info, dict) or 'dtype' not in info or 'shape' not in info or 'data_offsets' not in info:
+            raise SafetensorsError(f"Tensor {name} does not have dtype, shape and data_offsets")
+        if not isinstance(info['data_offsets'], list) or len(info['data_offsets']) != 2 \
+            or not all(isinstance(v, int) for v in info['data_offsets']):
+            raise SafetensorsError(f"Tensor {name} has invalid data_offsets {info['data_offsets']}")
+        begin, end = info['data_offsets']
+        if begin < 0 or end < begin:
+            raise SafetensorsError(f"Tensor {name} has invalid data_offsets {info['data_offsets']}")
+        if not isinstance(info['shape'], list) or not all(isinstance(dim, int) and dim >= 0 for dim in info['shape']):
+            raise SafetensorsError(f"Tensor {name} has invalid shape {info['shape']}")
+        itemsize = DTYPE_SIZES.get(info['dtype'])
+        if itemsize is not None: # newer dtypes are not checked
+            numel = 1
+            for dim in info['shape']:
+                numel *= dim
+            if numel * itemsize != end - begin:
+                raise SafetensorsError(f"Tensor {name} with shape {info['shape']} and dtype {info['dtype']} does not match data_offsets {info['data_offsets']}")
+        offsets.append((begin, end))
+    position = 0
+    for begin, end in sorted(offsets):
+        if begin != position:
+            raise SafetensorsError(f"Tensor data is not contiguous at offset {position}")
+        position = end
+    return position
+
+def read_header(file_path:str) -> Tuple[dict, int]:
+    """
+    Reads the header of a safetensors file, returns (header, offset of tensor data)
+    """
+    with open(file_path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise SafetensorsError(f"{file_path} is too small to be a safetensors file")
+        header_length = parse_header_length(prefix)
+        header_bytes = f.read(header_length)
+        if len(header_bytes) < header_length:
+            raise SafetensorsError(f"{file_path} is truncated inside the safetensors header")
+    return parse_header(header_bytes), 8 + header_length
+
+class SafetensorsStreamValidator:
+    """
+    Validates a safetensors file while it is streamed.
+    update() raises SafetensorsError as soon as the header is known to be malformed, or if the size declared
+    by the header does not match declared_size (exact) or max_size (upper bound, i.e. a request Content-Length).
+    finish() checks the received size against the header.
+    """
+    def __init__(self, declared_size:int = 0, max_size:int = 0):
+        self.declared_size = declared_size
+        self.max_size = max_size
+        self.expected_size = None
+        self.received = 0
+        self.header = None
+        self._buffer = bytearray()
+
+    def update(self, data:bytes) -> None:
+        self.received += len(data)
+        if self.expected_size is None:
+            self._buffer.extend(data)
+            self._parse()
+        if self.expected_size is not None and self.received > self.expected_size:
+            raise SafetensorsError(f"Received {self.received} bytes, but safetensors header declares {self.expected_size} bytes")
+
+    def _parse(self) -> None:
+        if len(self._buffer) < 8:
+            return
+        header_length = parse_header_length(self._buffer)
+        if len(self._buffer) < 8 + header_length:
+            return
+        self.header = parse_header(bytes(self._buffer[8:8 + header_length]))
+        self.expected_size = 8 + header_length + data_length(self.header)
+        self._buffer = bytearray()
+        if self.declared_size and self.expected_size != self.declared_size:
+            raise SafetensorsError(f"Safetensors header declares {self.expected_size} bytes, but the upload size is {self.declared_size}")
+        if self.max_size and self.expected_size > self.max_size:
+            raise SafetensorsError(f"Safetensors header declares {self.expected_size} bytes, but the request is only {self.max_size} bytes")
+
+    def finish(self) -> None:
+        if self.expected_size is None:
+            raise SafetensorsError(f"Received {self.received} bytes, which do not contain a complete safetensors header")
+        if self.received != self.expected_size:
+            raise SafetensorsError(f"Received {self.received} bytes, but safetensors header declares {self.expected_size} bytes")
@@ -0,0 +1,175 @@
+"""
+Background integrity scrub of the model library.
+The hash index trusts its entries as long as size, mtime and inode are unchanged, so bit rot or a partial overwrite
+which keeps them is never noticed. The scrubber slowly reads every indexed file in full and compares it with the index:
+the hash of fast_file_hash, and the full sha256 which it records on the first pass. Files are read at idle I/O priority
+within a MB/s budget and dropped from the page cache behind the read, so the scrub does not compete with generation.
+Mismatches are recorded in the hash index and returned by /uploader/scrubber.
+"""
+import os
+import time
+import ctypes
+import platform
+import threading
+from functools import lru_cache
+from logging import getLogger
+from typing import Dict, Optional
+from scripts.hashes import DEFAULT_ALGORITHM, DEFAULT_SIZE_TO_READ, MultiDigestHasher
+from scripts.hash_index import HashIndex
+from scripts.model_watcher import lower_thread_priority
+
+logger = getLogger("Auxilary API")
+
+SCRUB_BLOCK_SIZE = 1 << 22 # files are read in 4MB blocks, the budget is checked after each
+SCRUB_INTERVAL = 24 * 60 * 60.0 # seconds between the end of a pass and the start of the next one
+FULL_ALGORITHM = 'full:sha256' # index entry of the sha256 of the whole file
+FULL_SIZE_TO_READ = 1 << 62
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'amd64': 251, 'aarch64': 30, 'arm64': 30, 'i386': 289, 'i686': 289, 'armv7l': 314, 'ppc64le': 273}
+
+@lru_cache(maxsize=1)
+def get_scrub_rate() -> Optional[float]:
+    """
+    Returns --uploader-scrub-rate (MB/s), None if the scrubber is disabled
+    """
+    try:
+        from modules.shared import cmd_opts
+        return getattr(cmd_opts, 'uploader_scrub_rate', None)
+    except (ModuleNotFoundError, ImportError):
+        return None
+
+def set_idle_io_priority() -> bool:
+    """
+    Puts the calling thread in the idle I/O class, it only gets disk time nobody else wants. Linux only, returns True if set.
+    """
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+    if syscall_number is None or not hasattr(threading, 'get_native_id'):
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        result = libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, threading.get_native_id(), IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except (OSError, AttributeError):
+        return False
+    return result == 0
+
+def fadvise(fd:int, offset:int, length:int, advice_name:str) -> None:
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+class Scrubber:
+    """
+    Rehashes every file of index in full, at most rate MB/s, and records files whose hashes changed.
+    usage : scrubber = Scrubber(hash_index, 20); scrubber.start()
+    """
+    def __init__(self, index:HashIndex, rate:float, interval:float = SCRUB_INTERVAL):
+        self.index = index
+        self.rate = max(rate, 0.1) * (1 << 20) # bytes per second
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread:Optional[threading.Thread] = None
+        self.idle_io = False
+        self.current = ""
+        self.passes = 0
+        self.checked = 0
+        self.bytes_read = 0
+        self.pass_started = 0.0
+        self.pass_finished = 0.0
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='uploader-scrubber', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        lower_thread_priority()
+        self.idle_io = set_idle_io_priority()
+        while not self.stopped.is_set():
+            self.pass_started = time.time()
+            for file_path in self.index.paths():
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.scrub(file_path)
+                except OSError as e:
+                    logger.warning(f"Could not scrub {file_path} : {e}")
+            self.current = ""
+            self.passes += 1
+            self.pass_finished = time.time()
+            self.stopped.wait(self.interval)
+
+    def read_digests(self, file_path:str) -> Optional[Dict[str, str]]:
+        """
+        Reads file_path within the budget and returns its digests, None if the scrubber was stopped meanwhile
+        """
+        hasher = MultiDigestHasher()
+        buffer = memoryview(bytearray(SCRUB_BLOCK_SIZE))
+        started = time.monotonic()
+        with open(file_path, 'rb') as f:
+            fd = f.fileno()
+            fadvise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            offset = 0
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                hasher.update(buffer[:read])
+                # the scrubbed data is not needed again, keep the page cache for generation
+                fadvise(fd, offset, read, 'POSIX_FADV_DONTNEED')
+                offset += read
+                self.bytes_read += read
+                delay = started + offset / self.rate - time.monotonic()
+                if delay > 0 and self.stopped.wait(delay):
+                    return None
+        return hasher.digests()
+
+    def scrub(self, file_path:str) -> None:
+        """
+        Rehashes file_path and compares it with its index entries, files changed since they were hashed are skipped
+        """
+        expected = self.index.get(file_path, DEFAULT_SIZE_TO_READ, DEFAULT_ALGORITHM)
+        expected_full = self.index.get(file_path, FULL_SIZE_TO_READ, FULL_ALGORITHM)
+        if expected is None and expected_full is None:
+            return
+        self.current = file_path
+        stat = os.stat(file_path)
+        digests = self.read_digests(file_path)
+        if digests is None:
+            return
+        after = os.stat(file_path)
+        if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != (after.st_size, after.st_mtime_ns, after.st_ino):
+            return # written meanwhile, the index entries are replaced or removed on the next lookup
+        self.checked += 1
+        for algorithm, expected_hash, actual_hash in ((DEFAULT_ALGORITHM, expected, digests['hashvalue']),
+                                                      (FULL_ALGORITHM, expected_full, digests['sha256'])):
+            if expected_hash is not None and expected_hash != actual_hash:
+                logger.warning(f"Scrub of {file_path} found {algorithm} {actual_hash}, indexed {expected_hash}")
+                self.index.record_mismatch(file_path, algorithm, expected_hash, actual_hash)
+                return
+        self.index.clear_mismatch(file_path)
+        if expected_full is None:
+            self.index.set(file_path, digests['sha256'], FULL_SIZE_TO_READ, FULL_ALGORITHM, stat)
+
+    def status(self) -> dict:
+        return {
+            'running': self.thread is not None and self.thread.is_alive(),
+            'rate': self.rate / (1 << 20),
+            'idle_io': self.idle_io,
+            'current': self.current,
+            'passes': self.passes,
+            'checked': self.checked,
+            'bytes_read': self.bytes_read,
+            'pass_started': self.pass_started,
+            'pass_finished': self.pass_finished,
+            'mismatches': self.index.mismatches(),
+        }
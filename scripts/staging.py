@@ -0,0 +1,85 @@
+"""
+Staging area for uploads.
+Uploads are written to a staging directory inside the target model directory, so a finished upload
+is moved into place with a single rename on the same filesystem and webui never sees a partial file.
+"""
+import os
+import shutil
+import errno
+
+STAGING_DIR_NAME = '.uploader_staging'
+
+def get_staging_dir(model_dir:str) -> str:
+    """
+    Returns the staging directory of model_dir, files are staged there before they are moved into place
+    """
+    return os.path.join(model_dir, STAGING_DIR_NAME)
+
+def check_free_space(directory:str, size:int) -> None:
+    """
+    Raises OSError(ENOSPC) if directory does not have size bytes of free space
+    """
+    free = shutil.disk_usage(directory).free
+    if size > free:
+        raise OSError(errno.ENOSPC, f"Not enough space in {directory}, {size} bytes required but {free} bytes available")
+
+def preallocate(file_obj, size:int) -> None:
+    """
+    Reserves size bytes for file_obj, so writes do not fragment the file or fail for lack of space halfway
+    """
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file_obj.fileno(), 0, size)
+            return
+        except OSError:
+            pass # not supported by the filesystem
+    file_obj.truncate(size)
+
+def write_at(file_obj, data:bytes, offset:int) -> int:
+    """
+    Writes data at offset without moving a shared file position, returns the number of bytes written
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(file_obj.fileno(), view[written:], offset + written)
+        return written
+    file_obj.seek(offset)
+    file_obj.write(data)
+    file_obj.flush()
+    return len(data)
+
+def fsync_dir(directory:str) -> None:
+    """
+    Makes a rename in directory durable, does nothing where directories can not be opened (Windows)
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def commit_file(staged_path:str, real_file_path:str) -> None:
+    """
+    Moves a staged file (already fsynced) to real_file_path, replacing any existing file in a single rename
+    """
+    os.makedirs(os.path.dirname(real_file_path), exist_ok=True)
+    try:
+        os.replace(staged_path, real_file_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # staged on another filesystem, copy next to the target first so the final step is still a rename
+        temp_path = real_file_path + '.part'
+        shutil.copyfile(staged_path, temp_path)
+        os.replace(temp_path, real_file_path)
+        os.remove(staged_path)
+    fsync_dir(os.path.dirname(real_file_path))
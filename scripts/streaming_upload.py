@@ -0,0 +1,254 @@
+"""
+Streaming multipart ingest for the upload API.
+The request body is parsed chunk by chunk and file data is written to disk as it arrives,
+so uploaded models are never held in memory or spooled to a temporary file by starlette first.
+"""
+import os
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional, Tuple
+from fastapi import Request
+from scripts.staging import preallocate
+from scripts.hashes import FastFileHasher
+from scripts.transfer_encoding import DECODE_ERRORS, open_decoder
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+    from python_multipart.exceptions import FormParserError
+except (ImportError, ModuleNotFoundError):
+    import multipart
+    from multipart.multipart import parse_options_header
+    from multipart.exceptions import FormParserError
+
+MAX_FIELD_SIZE = 1 << 20 # non-file form fields are small, 1MB is plenty
+WRITE_BATCH_SIZE = 1 << 20 # received chunks are parsed and written in a worker thread once this much is buffered
+
+class UploadRejected(Exception):
+    """
+    Raised while streaming to abort the upload, the message is returned to the client
+    """
+
+class EncodingRejected(UploadRejected):
+    """
+    Raised when encoded file data can not be decoded, is truncated or decodes to more than its declared size
+    """
+
+class FileSink:
+    """
+    Receives streamed file data and writes it to target_path.
+    If size is given, the space is preallocated, the file is truncated to the received size on close.
+    The hash of the file (same as fast_file_hash) is computed while the data is written, hasher may be given to compute
+    more digests in the same pass (i.e. MultiDigestHasher).
+    If validator is given (i.e. SafetensorsStreamValidator), it checks the data as it arrives and aborts the upload on errors.
+    If encoding is given (i.e. zstd), the received data is decoded before it is checked, hashed and written,
+    size is then the exact decoded size, since nothing else bounds the decoded data.
+    The upload is aborted as soon as more than size bytes are received (size is an upper bound if it is not exact).
+    """
+    def __init__(self, target_path:str, filename:str = "", size:int = 0, validator = None, encoding:str = "", hasher = None):
+        self.target_path = target_path
+        self.filename = filename
+        self.size = 0
+        self.hasher = hasher or FastFileHasher()
+        self.validator = validator
+        self.encoded = encoding not in ("", "identity")
+        # unencoded data of unknown size (0) is not bounded here, the request body is
+        self.max_size = size if size or self.encoded else None
+        try:
+            self.decoder = open_decoder(encoding, self._write)
+        except ValueError as e:
+            raise EncodingRejected(str(e)) from e
+        self.file = open(target_path, 'wb')
+        try:
+            preallocate(self.file, size)
+        except OSError:
+            self.discard()
+            raise
+
+    def write(self, data:bytes) -> None:
+        """
+        Writes a chunk of received (possibly encoded) file data
+        """
+        try:
+            self.decoder.write(data)
+        except DECODE_ERRORS as e:
+            raise EncodingRejected(f"Could not decode {self.filename} : {e}") from e
+
+    def _write(self, data:bytes) -> None:
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            error = EncodingRejected if self.encoded else UploadRejected
+            raise error(f"Received more than {self.max_size} bytes of {self.filename}")
+        if self.validator is not None:
+            try:
+                self.validator.update(data)
+            except ValueError as e:
+                raise UploadRejected(f"Invalid {self.filename} : {e}") from e
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    @property
+    def hashvalue(self) -> str:
+        return self.hasher.hexdigest()
+
+    def close(self) -> None:
+        """
+        Flushes the received data to disk and closes the underlying file
+        """
+        if not self.file.closed:
+            try:
+                self.decoder.close()
+            except DECODE_ERRORS as e:
+                raise EncodingRejected(f"Could not decode {self.filename} : {e}") from e
+        if self.validator is not None and not self.file.closed:
+            try:
+                self.validator.finish()
+            except ValueError as e:
+                raise UploadRejected(f"Invalid {self.filename} : {e}") from e
+        if not self.file.closed:
+            self.file.flush()
+            self.file.truncate(self.size)
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def discard(self) -> None:
+        """
+        Closes and removes the partially written file
+        """
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.target_path):
+            os.remove(self.target_path)
+
+class MultipartStream:
+    """
+    Parses a multipart/form-data request body as it is received.
+    open_file(field_name, filename, fields) is called when a file part starts, fields are the
+    form fields received so far. It returns a FileSink which receives the file data.
+    Parsing and disk writes run on executor (default thread pool if None), the event loop only receives the body.
+    """
+    def __init__(self, request:Request, open_file:Callable[[str, str, dict], FileSink], executor:Optional[Executor] = None):
+        self.request = request
+        self.open_file = open_file
+        self.executor = executor
+        self.parser = None
+        self.fields = {}
+        self.files = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._field_name = ""
+        self._field_data = bytearray()
+        self._sink = None
+        self._pending = [] # file data received by the last parser.write, flushed after each chunk
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._field_name = ""
+        self._field_data = bytearray()
+        self._sink = None
+
+    def on_header_field(self, data:bytes, start:int, end:int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data:bytes, start:int, end:int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise UploadRejected("Content-Disposition of multipart part does not have a name")
+        self._field_name = options[b"name"].decode("utf-8", errors="replace")
+        if b"filename" in options:
+            if self._field_name in self.files:
+                raise UploadRejected(f"Received more than one file for {self._field_name}")
+            filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._flush()
+            self._sink = self.open_file(self._field_name, filename, dict(self.fields))
+            self.files[self._field_name] = self._sink
+
+    def on_part_data(self, data:bytes, start:int, end:int):
+        if self._sink is not None:
+            self._pending.append((self._sink, data[start:end]))
+            return
+        if len(self._field_data) + end - start > MAX_FIELD_SIZE:
+            raise UploadRejected(f"Form field {self._field_name} is too large")
+        self._field_data.extend(data[start:end])
+
+    def on_part_end(self):
+        if self._sink is None:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", errors="replace")
+
+    def _flush(self):
+        for sink, data in self._pending:
+            sink.write(data)
+        self._pending.clear()
+
+    def _write(self, chunks:List[bytes]):
+        for chunk in chunks:
+            self.parser.write(chunk)
+            self._flush()
+
+    def _finish(self):
+        self.parser.finalize()
+        for sink in self.files.values():
+            sink.close()
+
+    async def parse(self) -> Tuple[Dict[str, str], Dict[str, FileSink]]:
+        """
+        Consumes the request body, returns (fields, files)
+        On any error, files which were already opened are discarded.
+        """
+        content_type, params = parse_options_header(self.request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise UploadRejected("Expected a multipart/form-data request body")
+        callbacks = {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+        self.parser = multipart.MultipartParser(params[b"boundary"], callbacks)
+        loop = asyncio.get_running_loop()
+        try:
+            batch = []
+            buffered = 0
+            async for chunk in self.request.stream():
+                batch.append(chunk)
+                buffered += len(chunk)
+                if buffered >= WRITE_BATCH_SIZE:
+                    await loop.run_in_executor(self.executor, self._write, batch)
+                    batch = []
+                    buffered = 0
+            await loop.run_in_executor(self.executor, self._write, batch)
+            await loop.run_in_executor(self.executor, self._finish)
+        except BaseException as exception:
+            self.discard()
+            if isinstance(exception, FormParserError):
+                raise UploadRejected(f"Invalid multipart data : {exception}") from exception
+            raise
+        return self.fields, self.files
+
+    def discard(self) -> None:
+        """
+        Discards every file received so far
+        """
+        self._pending.clear()
+        for sink in self.files.values():
+            sink.discard()
+
+async def read_multipart(request:Request, open_file:Callable[[str, str, dict], FileSink],
+                         executor:Optional[Executor] = None) -> Tuple[Dict[str, str], Dict[str, FileSink]]:
+    """
+    Streams multipart/form-data from request, returns (fields, files)
+    """
+    return await MultipartStream(request, open_file, executor).parse()
@@ -0,0 +1,195 @@
+"""
+On-the-wire compression of uploads.
+The server advertises the encodings it can decode in the ping response. A client compresses a file with one of them
+only if a sample of the file compresses well, the server decodes while receiving, so files are stored uncompressed.
+Streamed responses (i.e. NDJSON hash listings) are compressed with gzip or zstd, as accepted by the client.
+"""
+import zlib
+from typing import Callable, List
+
+try:
+    import zstandard
+except (ImportError, ModuleNotFoundError):
+    zstandard = None
+
+ZSTD_LEVEL = 3 # fast enough to keep up with a gigabit link on a single core
+DECODE_CHUNK_SIZE = 1 << 20 # decoded data is written in chunks of at most this size
+# a 128KB zstd block may be encoded in a few bytes, encoded data is decompressed in slices of this size to bound the
+# data one call decodes
+DECODE_INPUT_SIZE = 1 << 12
+SAMPLE_SIZE = 1 << 20
+SAMPLE_COUNT = 3
+MIN_SAVING = 0.05 # compress only if the sample shrinks by at least 5%
+GZIP_LEVEL = 6
+DECODE_ERRORS = (zstandard.ZstdError,) if zstandard is not None else ()
+
+def supported_encodings() -> List[str]:
+    """
+    Returns the encodings this side can encode and decode
+    """
+    return ['zstd'] if zstandard is not None else []
+
+class CallbackWriter:
+    """
+    Writer object for zstandard stream writers which passes every write to a callback
+    """
+    def __init__(self, callback:Callable[[bytes], None]):
+        self.callback = callback
+
+    def write(self, data:bytes) -> int:
+        self.callback(data)
+        return len(data)
+
+    def close(self) -> None:
+        pass
+
+class ZstdFrameDecoder:
+    """
+    Decodes one zstd frame received in pieces, decoded data is passed to a callback in chunks of at most DECODE_CHUNK_SIZE.
+    close() raises zstandard.ZstdError if the frame is incomplete, i.e. the body was truncated.
+    """
+    def __init__(self, callback:Callable[[bytes], None]):
+        self.callback = callback
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.decoded = bytearray()
+
+    def write(self, data:bytes) -> int:
+        if data and self.decompressor.eof:
+            raise zstandard.ZstdError("Received data after the end of the zstd frame")
+        for start in range(0, len(data), DECODE_INPUT_SIZE):
+            self.decoded += self.decompressor.decompress(data[start:start + DECODE_INPUT_SIZE])
+            if len(self.decoded) >= DECODE_CHUNK_SIZE:
+                self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        decoded = self.decoded
+        self.decoded = bytearray()
+        for start in range(0, len(decoded), DECODE_CHUNK_SIZE):
+            self.callback(bytes(decoded[start:start + DECODE_CHUNK_SIZE]))
+
+    def close(self) -> None:
+        self.flush()
+        if not self.decompressor.eof:
+            raise zstandard.ZstdError("zstd frame is incomplete, the data was truncated")
+        if self.decompressor.unused_data:
+            raise zstandard.ZstdError("Received data after the end of the zstd frame")
+
+def open_decoder(encoding:str, write:Callable[[bytes], None]):
+    """
+    Returns an object with write(encoded data), which passes decoded data to write in chunks of at most DECODE_CHUNK_SIZE,
+    and close(), which passes the rest and raises DECODE_ERRORS if the encoded data is incomplete.
+    Raises ValueError if encoding is not supported.
+    """
+    if encoding in ("", "identity"):
+        return CallbackWriter(write)
+    if encoding not in supported_encodings():
+        raise ValueError(f"Unsupported encoding {encoding}, supported encodings are {supported_encodings()}")
+    return ZstdFrameDecoder(write)
+
+def open_encoder(encoding:str):
+    """
+    Returns a compressobj-like object with compress(data) and flush() for encoding
+    """
+    if encoding not in supported_encodings():
+        raise ValueError(f"Unsupported encoding {encoding}, supported encodings are {supported_encodings()}")
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).compressobj()
+
+def encode(encoding:str, data:bytes) -> bytes:
+    """
+    Compresses data in one piece
+    """
+    encoder = open_encoder(encoding)
+    return encoder.compress(data) + encoder.flush()
+
+def decode(encoding:str, data:bytes) -> bytes:
+    """
+    Decompresses data in one piece, encoding is "", 'gzip' or one of supported_encodings().
+    Raises ValueError if encoding is not supported, DECODE_ERRORS or zlib.error if data is invalid.
+    """
+    if encoding in ("", "identity"):
+        return data
+    if encoding == 'gzip':
+        return zlib.decompress(data, 31)
+    if encoding not in supported_encodings():
+        raise ValueError(f"Unsupported encoding {encoding}, supported encodings are {supported_encodings()}")
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    decoded = decompressor.decompress(data)
+    if not decompressor.eof:
+        raise zstandard.ZstdError("zstd frame is incomplete, the data was truncated")
+    return decoded
+
+def sample_ratio(read_range:Callable[[int, int], bytes], size:int, encoding:str = 'zstd') -> float:
+    """
+    Returns compressed size / original size of SAMPLE_COUNT samples spread over a file of size bytes.
+    read_range(offset, length) reads from the file.
+    """
+    if size <= 0:
+        return 1.0
+    if size <= SAMPLE_SIZE * SAMPLE_COUNT:
+        offsets = [0]
+        length = size
+    else:
+        # skip the start, headers compress better than the tensor data which makes up the file
+        step = size // (SAMPLE_COUNT + 1)
+        offsets = [step * (i + 1) for i in range(SAMPLE_COUNT)]
+        length = SAMPLE_SIZE
+    original = 0
+    compressed = 0
+    for offset in offsets:
+        data = read_range(offset, length)
+        original += len(data)
+        compressed += len(zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data))
+    return compressed / original if original else 1.0
+
+def choose_encoding(server_encodings:List[str], read_range:Callable[[int, int], bytes], size:int) -> str:
+    """
+    Returns 'zstd' if both sides support it and a sample of the file compresses by at least MIN_SAVING, otherwise ""
+    """
+    if 'zstd' not in server_encodings or 'zstd' not in supported_encodings():
+        return ""
+    if sample_ratio(read_range, size) > 1 - MIN_SAVING:
+        return ""
+    return 'zstd'
+
+def choose_response_encoding(accept_encoding:str) -> str:
+    """
+    Returns 'zstd' or 'gzip' if the Accept-Encoding header value allows it, zstd is preferred, otherwise ""
+    """
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip())
+    if 'zstd' in accepted and 'zstd' in supported_encodings():
+        return 'zstd'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return ""
+
+class ResponseEncoder:
+    """
+    Compresses a streamed response, every encode() returns data the client can decode right away.
+    usage : encoder = ResponseEncoder('gzip'); yield encoder.encode(part); ...; yield encoder.finish()
+    """
+    def __init__(self, encoding:str = ""):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # 31 writes the gzip header and trailer
+        elif encoding == 'zstd' and encoding in supported_encodings():
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif encoding in ("", "identity"):
+            self.compressor = None
+        else:
+            raise ValueError(f"Unsupported response encoding {encoding}")
+
+    def encode(self, data:bytes) -> bytes:
+        if self.compressor is None:
+            return data
+        if self.encoding == 'gzip':
+            return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush() if self.compressor is not None else b''
@@ -0,0 +1,277 @@
+"""
+Resumable upload sessions.
+A session owns a staging file inside the target model directory which receives byte ranges at arbitrary offsets.
+Session state is stored next to the staging file, so an interrupted upload can be resumed after a restart.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from typing import Callable, Iterable, List, Optional
+from scripts.staging import get_staging_dir, check_free_space, preallocate, write_at
+from scripts.hashes import BUF_SIZE
+from scripts.safetensors_header import SafetensorsStreamValidator
+from scripts.webui_hashes import new_upload_hasher
+
+SESSION_EXPIRE_SECONDS = 24 * 60 * 60 # unfinished sessions are removed after a day
+
+def merge_ranges(ranges:Iterable[List[int]]) -> List[List[int]]:
+    """
+    Merges overlapping or adjacent [start, end) ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class UploadSession:
+    """
+    State of a single resumable upload
+    """
+    def __init__(self, staging_dir:str, session_id:str, modeltype:str, path:str, filename:str,
+                 custom_name:str = "", size:int = 0, hashvalue:str = "", ranges:Optional[list] = None,
+                 created_at:float = 0):
+        self.staging_dir = staging_dir
+        self.session_id = session_id
+        self.modeltype = modeltype
+        self.path = path
+        self.filename = filename
+        self.custom_name = custom_name
+        self.size = size
+        self.hashvalue = hashvalue
+        self.ranges = ranges or []
+        self.created_at = created_at or time.time()
+        self.lock = threading.Lock()
+        # ranges written in order are hashed as they arrive, the rest is read back by finish_hash
+        self.hasher = new_upload_hasher(modeltype, filename)
+        self.hashed_until = 0
+        # the safetensors header is checked when the first range arrives
+        self.validator = SafetensorsStreamValidator(size) if filename.endswith('.safetensors') else None
+
+    @property
+    def part_path(self) -> str:
+        return os.path.join(self.staging_dir, self.session_id + '.part')
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.staging_dir, self.session_id + '.json')
+
+    def to_dict(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'modeltype': self.modeltype,
+            'path': self.path,
+            'filename': self.filename,
+            'custom_name': self.custom_name,
+            'size': self.size,
+            'hashvalue': self.hashvalue,
+            'ranges': self.ranges,
+            'created_at': self.created_at,
+        }
+
+    @classmethod
+    def load(cls, state_path:str) -> 'UploadSession':
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return cls(os.path.dirname(state_path), **state)
+
+    def save(self) -> None:
+        """
+        Writes the session state, replacing the previous state atomically
+        """
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temp_path, self.state_path)
+
+    def matches(self, modeltype:str, path:str, filename:str, custom_name:str, size:int, hashvalue:str) -> bool:
+        """
+        Returns True if this session uploads the same file to the same place, so it can be resumed
+        """
+        return (self.modeltype, self.path, self.filename, self.custom_name, self.size, self.hashvalue) == \
+            (modeltype, path, filename, custom_name, size, hashvalue)
+
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def missing(self) -> List[List[int]]:
+        """
+        Returns the ranges which were not received yet
+        """
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append([position, start])
+            position = max(position, end)
+        if position < self.size:
+            missing.append([position, self.size])
+        return missing
+
+    def is_complete(self) -> bool:
+        return not self.missing()
+
+    def add_range(self, start:int, end:int) -> None:
+        if end <= start:
+            return
+        with self.lock:
+            self.ranges = merge_ranges(self.ranges + [[start, end]])
+            self.save()
+
+    def write_range(self, offset:int, chunks:Iterable[bytes]) -> int:
+        """
+        Writes chunks starting at offset, returns the number of bytes written.
+        Bytes which were written before an error are still recorded, so the client can resume from there.
+        """
+        written = 0
+        try:
+            # each request uses its own descriptor and positioned writes, so ranges can be written concurrently
+            with open(self.part_path, 'r+b') as f:
+                for chunk in chunks:
+                    if offset + written + len(chunk) > self.size:
+                        raise ValueError(f"Received data beyond the declared size {self.size}")
+                    self.update_hash(offset + written, chunk)
+                    write_at(f, chunk, offset + written)
+                    written += len(chunk)
+                os.fsync(f.fileno())
+        finally:
+            self.add_range(offset, offset + written)
+        return written
+
+    def update_hash(self, offset:int, data:bytes) -> None:
+        """
+        Feeds data to the hasher (and the safetensors validator) if it continues the hashed prefix
+        """
+        with self.lock:
+            if offset == self.hashed_until:
+                if self.validator is not None:
+                    self.validator.update(data)
+                self.hasher.update(data)
+                self.hashed_until += len(data)
+
+    def finish_hash(self) -> str:
+        """
+        Returns the hash of the received file, only the part which was not hashed while writing is read from disk.
+        If the hasher also computes webui's hashes, the rest of the file is read too, while it is still cached.
+        """
+        with self.lock:
+            with open(self.part_path, 'rb') as f:
+                f.seek(self.hashed_until)
+                while self.hashed_until < self.size and not self.hasher.complete:
+                    data = f.read(min(BUF_SIZE * 16, self.size - self.hashed_until))
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    self.hashed_until += len(data)
+            self.hasher.size = self.size
+            return self.hasher.hexdigest()
+
+    def status(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'size': self.size,
+            'received': self.received(),
+            'ranges': self.ranges,
+            'missing': self.missing(),
+        }
+
+    def remove(self) -> None:
+        """
+        Removes the staging file and the session state
+        """
+        for file_path in (self.part_path, self.state_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+class SessionRangeWriter:
+    """
+    Writer which writes to a session starting at offset, data is written in batches of batch_size bytes
+    """
+    def __init__(self, session:UploadSession, offset:int, batch_size:int):
+        self.session = session
+        self.offset = offset
+        self.batch_size = batch_size
+        self.written = 0
+        self.chunks = []
+        self.buffered = 0
+
+    def write(self, data:bytes) -> None:
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        chunks = self.chunks
+        self.chunks = []
+        self.buffered = 0
+        self.written += self.session.write_range(self.offset + self.written, chunks)
+
+class UploadSessionStore:
+    """
+    Keeps track of upload sessions. get_model_dirs returns every model directory which may hold sessions,
+    sessions which are not in memory (i.e. after a restart) are loaded from their staging directories.
+    """
+    def __init__(self, get_model_dirs:Callable[[], List[str]]):
+        self.get_model_dirs = get_model_dirs
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def staging_dirs(self) -> List[str]:
+        return [get_staging_dir(model_dir) for model_dir in self.get_model_dirs() if model_dir]
+
+    def load_sessions(self) -> None:
+        """
+        Loads sessions stored on disk, removes expired ones
+        """
+        for staging_dir in self.staging_dirs():
+            if not os.path.isdir(staging_dir):
+                continue
+            for file in os.listdir(staging_dir):
+                if not file.endswith('.json') or file[:-len('.json')] in self.sessions:
+                    continue
+                try:
+                    session = UploadSession.load(os.path.join(staging_dir, file))
+                except (OSError, ValueError, TypeError):
+                    continue
+                if time.time() - session.created_at > SESSION_EXPIRE_SECONDS:
+                    session.remove()
+                    continue
+                self.sessions[session.session_id] = session
+
+    def create(self, model_dir:str, modeltype:str, path:str, filename:str, custom_name:str = "",
+               size:int = 0, hashvalue:str = "") -> UploadSession:
+        """
+        Creates a session, or returns the unfinished session which uploads the same file
+        """
+        with self.lock:
+            self.load_sessions()
+            for session in self.sessions.values():
+                if session.matches(modeltype, path, filename, custom_name, size, hashvalue):
+                    return session
+            staging_dir = get_staging_dir(model_dir)
+            os.makedirs(staging_dir, exist_ok=True)
+            check_free_space(staging_dir, size)
+            session = UploadSession(staging_dir, uuid.uuid4().hex, modeltype, path, filename,
+                                    custom_name=custom_name, size=size, hashvalue=hashvalue)
+            with open(session.part_path, 'wb') as f:
+                preallocate(f, size)
+            session.save()
+            self.sessions[session.session_id] = session
+            return session
+
+    def get(self, session_id:str) -> Optional[UploadSession]:
+        with self.lock:
+            if session_id not in self.sessions:
+                self.load_sessions()
+            return self.sessions.get(session_id)
+
+    def remove(self, session_id:str) -> None:
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.remove()
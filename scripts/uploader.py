@@ -2,8 +2,13 @@
     Uploads the model to the server / syncs / etc
 """
 import os
+import json
 import glob
-from typing import List
+import time
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 from pathlib import Path
 from logging import getLogger
 import tqdm
@@ -11,15 +16,54 @@ import requests
 from functools import lru_cache
 from scripts.paths import get_sd_ckpt_dir, get_vae_ckpt_dir, get_lora_ckpt_dir, get_textual_inversion_dir
 from scripts.api_functions_state import api_functions
+from scripts.hashes import compute_fileobj_hash, DEFAULT_ALGORITHM
+from scripts.multipart_encoder import MultipartFileEncoder
+from scripts.transfer_encoding import choose_encoding, encode
+from scripts.normalize import get_original_hash
 
+#Session = requests.Session()
 try:
-    import requests_toolbelt
-    has_toolbelt = True
+    import zstandard
 except (ImportError, ModuleNotFoundError):
-    getLogger(__name__).warning("requests_toolbelt not found. Please install it with 'pip install requests_toolbelt'")
-    #print("requests_toolbelt not found. Please install it with 'pip install requests_toolbelt'")
-    has_toolbelt = False
-#Session = requests.Session()
+    zstandard = None
+
+# files larger than this are sent through resumable upload sessions
+SESSION_UPLOAD_THRESHOLD = 1 << 28
+# bytes sent by each PUT request of an upload session
+SESSION_CHUNK_SIZE = 1 << 26
+# connections used to upload the parts of a single file
+DEFAULT_UPLOAD_CONCURRENCY = 4
+# retries for an upload session before giving up, the session resumes from the last received offset
+SESSION_MAX_RETRIES = 5
+# upload endpoint -> modeltype for upload sessions
+UPLOAD_MODELTYPES = {
+    'upload_sd_model': 'sd',
+    'upload_vae_model': 'vae',
+    'upload_lora_model': 'lora',
+    'upload_embedding': 'textual_inversion',
+    'upload_controlnet_model': 'controlnet',
+}
+# modeltype -> model directory of the models compared by /sync/diff
+SYNC_MODEL_DIRS = {
+    'sd': get_sd_ckpt_dir,
+    'vae': get_vae_ckpt_dir,
+    'lora': get_lora_ckpt_dir,
+    'textual_inversion': get_textual_inversion_dir,
+}
+# modeltype -> accessor of the full hash of a single model
+SYNC_HASH_ACCESSORS = {
+    'sd': 'get_hash_sd',
+    'vae': 'get_hash_vae',
+    'lora': 'get_hash_lora',
+    'textual_inversion': 'get_hash_textual_inversion',
+}
+# modeltype -> extension synced by servers without /sync/diff
+SYNC_GLOB_EXTENSIONS = {
+    'sd': '.safetensors',
+    'vae': '.safetensors',
+    'lora': '.safetensors',
+    'textual_inversion': '.pt',
+}
 
 @lru_cache(maxsize=1)
 def get_port():
@@ -65,12 +109,28 @@ def join_path(path1 : str, path2 : str) -> str:
     """
     return os.path.join(path1, *path2.split('/'))
 
-def progress_callback(monitor) -> None:
+def read_file_range(file_binary, offset:int, length:int, lock:threading.Lock) -> bytes:
     """
-    Callback for the upload progress
+    Reads length bytes at offset, safe to call from several threads sharing file_binary
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(file_binary.fileno(), length, offset)
+    with lock:
+        file_binary.seek(offset)
+        return file_binary.read(length)
+
+class SessionRejected(Exception):
+    """
+    Raised when the server rejects a part of an upload session, holds the response
+    """
+    def __init__(self, response:requests.Response):
+        super().__init__(response.text)
+        self.response = response
+
+class EndpointUnavailable(Exception):
+    """
+    Raised when the server answers 404 or 405 to an endpoint, i.e. it runs an older version of the extension
     """
-    percentage = monitor.bytes_read / monitor.len * 100
-    print("Uploaded: ", monitor.bytes_read, " of ", monitor.len, " bytes", f"{percentage:.2f}%")
 
 def decorate_check_connection(func):
     """
@@ -93,12 +153,24 @@ class Connection:
         """
         return f'http://127.0.0.1:{get_port()}/'
     
-    def __init__(self, target_ap_address: str = 'http://127.0.0.1:7860/', auth:str = "") -> None:
+    def __init__(self, target_ap_address: str = 'http://127.0.0.1:7860/', auth:str = "", concurrency:int = DEFAULT_UPLOAD_CONCURRENCY,
+                 compression:bool = True, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM, verify_full_hash:bool = False) -> None:
         """
         @param target_ap_address: address of the server
         @param auth: username:password
+        @param concurrency: number of connections used to upload parts of a large file
+        @param compression: compress uploads with zstd if the server supports it and the file compresses well
+        @param hash_mode: hash compared by syncs, "" for the full hash, 'fingerprint' for sampled blocks or 'structure' for the safetensors header
+        @param hash_algorithm: algorithm of the hashes compared by syncs, i.e. 'xxh3' if both sides have xxhash installed
+        @param verify_full_hash: if hash_mode or hash_algorithm is set, compare full sha256 hashes too when the quick hashes match
         """
         self.target_ap_address = target_ap_address
+        self.concurrency = max(1, concurrency)
+        self.compression = compression
+        self.hash_mode = hash_mode
+        self.hash_algorithm = hash_algorithm
+        self.verify_full_hash = verify_full_hash
+        self.server_encodings = None # encodings the server can decode, queried on first upload
         # if not ends with /, add it
         if not self.target_ap_address.endswith('/'):
             self.target_ap_address += '/'
@@ -127,18 +199,82 @@ class Connection:
         return result
     
     @staticmethod
-    def create_progressbar_callback(encoder_obj):
+    def create_progressbar_callback(total:int):
         """
-        Creates a callback for the progressbar
-        @param encoder_obj: MultipartEncoder object
+        Creates a callback(bytes_sent, total) for the progressbar, tqdm limits how often it is redrawn
+        @param total: total bytes to send
         """
-        pbar = tqdm.tqdm(total=encoder_obj.len, unit="B", unit_scale=True)
-        def callback(monitor):
-            if not hasattr(monitor, 'bytes_read'):
-                return
-            pbar.update(monitor.bytes_read - pbar.n)
+        pbar = tqdm.tqdm(total=total, unit="B", unit_scale=True)
+        def callback(bytes_sent:int, _total:int):
+            pbar.update(bytes_sent - pbar.n)
+            if bytes_sent >= total:
+                pbar.close()
         return callback
         
+    @staticmethod
+    def verify_upload(response:requests.Response, self_hash:str):
+        """
+        Compares the hash computed by the server while receiving the upload with the local hash.
+        Returns the response, or a failure dict if the hashes do not match.
+        """
+        if response.status_code != 200:
+            return response
+        response_json = response.json()
+        server_hash = response_json.get('hashvalue', "")
+        if response_json.get('success') and server_hash and server_hash != self_hash:
+            return {"message": f"Uploaded file hash {server_hash} does not match local hash {self_hash}", 'success': False}
+        return response
+
+    def query_model_hashes(self, accessor:str, server_endpoint:str, model_path:str, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM) -> Tuple[dict, dict]:
+        """
+        Returns (local response json, server response json) of the hash of model_path, computed with hash_mode and hash_algorithm
+        """
+        self_response_json = self.create_self_request(accessor, path = model_path, hash_mode = hash_mode, hash_algorithm = hash_algorithm)
+        if not self_response_json['success']:
+            raise FileNotFoundError(f'{self.get_master_ap_address()} does not have requested model in path ' + model_path + ' ' + str(self_response_json['message']))
+        server_hash_response = self.session.post(self.target_ap_address + server_endpoint, data={'path': model_path, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm})
+        if server_hash_response.status_code != 200:
+            raise ConnectionRefusedError(f'Server does not support Model Syncing, status {server_hash_response.status_code}, {server_hash_response.text}')
+        return self_response_json, server_hash_response.json()
+
+    def compare_model_hash(self, accessor:str, server_endpoint:str, model_path:str, hash_mode:Optional[str] = None) -> Tuple[bool, str]:
+        """
+        Compares the hash of a local model with the server's, returns (matched, local full hash or "" if it was not computed).
+        With hash_mode ('fingerprint' or 'structure', self.hash_mode if None) or another hash_algorithm than sha256,
+        quick hashes are compared first and full sha256 hashes only if they match and verify_full_hash is set.
+        Servers which do not know hash_mode or hash_algorithm answer without them, then full hashes are compared.
+        A file normalized from the other side's file (see normalize.py) matches by its original hash.
+        """
+        hash_mode = self.hash_mode if hash_mode is None else hash_mode
+        if hash_mode or self.hash_algorithm != DEFAULT_ALGORITHM:
+            self_json, response_json = self.query_model_hashes(accessor, server_endpoint, model_path, hash_mode, self.hash_algorithm)
+            if response_json.get('hash_mode') == hash_mode and response_json.get('hash_algorithm', DEFAULT_ALGORITHM) == self.hash_algorithm:
+                if not response_json['success']:
+                    return False, ""
+                if response_json['hashvalue'] == self_json['hashvalue']:
+                    if not self.verify_full_hash:
+                        return True, ""
+                # quick hashes of a normalized file differ from its original, those are compared by full hashes
+                elif not (self_json.get('original_hashvalue') or response_json.get('original_hashvalue')):
+                    return False, ""
+        self_json, response_json = self.query_model_hashes(accessor, server_endpoint, model_path)
+        self_hashes = {self_json['hashvalue'], self_json.get('original_hashvalue') or self_json['hashvalue']}
+        server_hashes = {response_json['hashvalue'], response_json.get('original_hashvalue') or response_json['hashvalue']}
+        # one side may hold a normalized copy of the other, which matches by its original hash
+        matched = bool(response_json['success']) and (self_json['hashvalue'] in server_hashes or response_json['hashvalue'] in self_hashes)
+        return matched, self_json['hashvalue']
+
+    def sync_model(self, accessor:str, server_endpoint:str, upload_func, model_path:str, hash_mode:Optional[str] = None):
+        """
+        Uploads model_path with upload_func(model_path, hashvalue=...) unless the server has the same file
+        """
+        matched, self_hash = self.compare_model_hash(accessor, server_endpoint, model_path, hash_mode)
+        if matched:
+            return {"message": "Ther file hash matched with request", 'success': True}
+        if not self_hash:
+            self_hash = self.create_self_request(accessor, path = model_path)['hashvalue'] # the upload is verified with the full hash
+        return self.verify_upload(upload_func(model_path, hashvalue=self_hash), self_hash)
+
     def check_connection(self) -> bool:
         """
         Send GET request to "/uploader/ping" to check if server is running
@@ -149,26 +285,216 @@ class Connection:
             return True
         raise ConnectionRefusedError(f'Server not running at {self.target_ap_address}, status {response.status_code}, {response.text}')
     
+    def get_server_encodings(self) -> List[str]:
+        """
+        Returns the encodings advertised by the server's ping response, empty for servers without compression support
+        """
+        if self.server_encodings is None:
+            try:
+                response = self.session.get(self.target_ap_address + 'uploader/ping')
+                self.server_encodings = response.json().get('encodings', []) if response.status_code == 200 else []
+            except (requests.RequestException, ValueError):
+                self.server_encodings = []
+        return self.server_encodings
+
+    def iter_model_hashes(self, modeltypes:Tuple[str, ...] = ('lora', 'vae', 'sd', 'textual_inversion'), path:str = "",
+                          page_size:int = 0, hash_mode:Optional[str] = None) -> Iterator[dict]:
+        """
+        Yields {"type", "path", "hashvalue"} of every model of modeltypes on the server as soon as the server computed it.
+        Uses /models/query_hash_stream with page_size files per request (0 for all), the response is decompressed by requests.
+        """
+        hash_mode = self.hash_mode if hash_mode is None else hash_mode
+        cursor = ""
+        while True:
+            response = self.session.post(self.target_ap_address + 'models/query_hash_stream', stream=True, data={
+                'path': path, 'modeltypes': ','.join(modeltypes), 'cursor': cursor, 'limit': page_size,
+                'hash_mode': hash_mode, 'hash_algorithm': self.hash_algorithm,
+            })
+            if response.status_code != 200:
+                raise ConnectionRefusedError(f'Server does not support streamed hash queries, status {response.status_code}, {response.text}')
+            last_line = None
+            with response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    entry = json.loads(line)
+                    if 'done' in entry:
+                        last_line = entry
+                        break
+                    if 'success' in entry: # the request was rejected before streaming
+                        raise ValueError(f"Server rejected the hash query : {entry.get('message')}")
+                    yield entry
+            if last_line is None:
+                raise ConnectionError("Hash stream ended before its last line")
+            if not last_line['done']:
+                raise ConnectionError(f"Server could not hash its models : {last_line.get('error')}")
+            cursor = last_line['next_cursor']
+            if not cursor:
+                return
+
+    def choose_file_encoding(self, file_binary) -> str:
+        """
+        Returns the encoding to send file_binary with, "" if it is sent uncompressed
+        """
+        if not self.compression:
+            return ""
+        read_lock = threading.Lock()
+        return choose_encoding(self.get_server_encodings(), lambda offset, length: read_file_range(file_binary, offset, length, read_lock),
+                               os.fstat(file_binary.fileno()).st_size)
+
     def send_data(self, file_binary: bytes,
                   model_path_arg:str = 'sd_path',
                   model_target_dir:str = 'test',
                   url:str = 'upload_sd_model',
-                  file_basename:str = 'test.safetensors'
+                  file_basename:str = 'test.safetensors',
+                  hashvalue:str = "",
+                  normalize:str = ""
                   ) -> requests.Response:
-        if has_toolbelt:
-            #curl -X POST -F "file=@F:\stable-diffusion-webui\models\Lora\Sketch_Like\\SketchLike.safetensors" -F "lora_path=test" http://onomaai.ngrok.dev/upload_lora_model
-            encoder = requests_toolbelt.MultipartEncoder(fields={
-                'file': (file_basename, file_binary, 'application/octet-stream'),
-                model_path_arg: model_target_dir
-            })
-            monitor = requests_toolbelt.MultipartEncoderMonitor(encoder,
-                callback=self.create_progressbar_callback(encoder_obj=encoder))
-            response = self.session.post(url, headers={'Content-Type': monitor.content_type}, data=monitor)
-        else:
-            files = {'file': (file_basename, file_binary, 'application/octet-stream')}
-            response = self.session.post(url, files=files, data={model_path_arg: model_target_dir})
+        """
+        Uploads file_binary to url. Large files are sent through a resumable upload session.
+        @param hashvalue: hash of the file if known, it is computed if a session is used and it is not given
+        @param normalize: "safetensors" to let the server convert pickle checkpoints, "fp16" to also cast float tensors to float16
+        """
+        modeltype = UPLOAD_MODELTYPES.get(url.rstrip('/').split('/')[-1])
+        if modeltype is not None and os.fstat(file_binary.fileno()).st_size >= SESSION_UPLOAD_THRESHOLD:
+            response = self.send_data_resumable(file_binary, modeltype, model_target_dir, file_basename, hashvalue, normalize)
+            if response is not None:
+                return response
+        #curl -X POST -F "file=@F:\stable-diffusion-webui\models\Lora\Sketch_Like\\SketchLike.safetensors" -F "lora_path=test" http://onomaai.ngrok.dev/upload_lora_model
+        fields = {model_path_arg: model_target_dir, 'size': os.fstat(file_binary.fileno()).st_size}
+        encoding = self.choose_file_encoding(file_binary)
+        if encoding:
+            fields['file_encoding'] = encoding
+        if normalize:
+            fields['normalize'] = normalize
+        encoder = MultipartFileEncoder(fields, 'file', file_basename, file_binary, encoding=encoding)
+        encoder.callback = self.create_progressbar_callback(encoder.len)
+        # the length of an encoded body is not known in advance, it is sent chunked
+        response = self.session.post(url, headers={'Content-Type': encoder.content_type}, data=iter(encoder) if encoding else encoder)
         return response
+
+    def create_worker_session(self) -> requests.Session:
+        """
+        Creates a session with the same auth, for requests sent from worker threads
+        """
+        session = requests.Session()
+        session.auth = self.session.auth
+        return session
+
+    def send_data_resumable(self, file_binary, modeltype:str, model_target_dir:str, file_basename:str, hashvalue:str = "",
+                            normalize:str = "") -> requests.Response:
+        """
+        Uploads file_binary through an upload session, in SESSION_CHUNK_SIZE parts sent over self.concurrency connections.
+        If the connection drops, the missing ranges are queried and the upload resumes from there.
+        An unfinished session for the same file (i.e. from a previous run) is resumed too.
+        Returns None if the server does not support upload sessions.
+        """
+        size = os.fstat(file_binary.fileno()).st_size
+        if not hashvalue:
+            hashvalue = compute_fileobj_hash(file_binary)
+        response = self.session.post(self.target_ap_address + 'upload_session/create', data={
+            'modeltype': modeltype,
+            'path': model_target_dir,
+            'filename': file_basename,
+            'size': size,
+            'hashvalue': hashvalue,
+        })
+        if response.status_code in (404, 405):
+            return None
+        if response.status_code != 200:
+            raise ConnectionRefusedError(f'Could not create upload session, status {response.status_code}, {response.text}')
+        status = response.json()
+        if not status['success']:
+            return response
+        session_url = self.target_ap_address + 'upload_session/' + status['session_id']
+        encoding = self.choose_file_encoding(file_binary)
+        pbar = tqdm.tqdm(total=size, initial=status['received'], unit="B", unit_scale=True)
+        pbar_lock = threading.Lock()
+        read_lock = threading.Lock()
+        local = threading.local()
+        def send_part(offset:int, length:int) -> None:
+            if not hasattr(local, 'session'):
+                local.session = self.create_worker_session()
+            data = read_file_range(file_binary, offset, length, read_lock)
+            if encoding:
+                part_response = local.session.put(session_url, params={'offset': offset}, data=encode(encoding, data),
+                                                  headers={'Content-Encoding': encoding})
+            else:
+                part_response = local.session.put(session_url, params={'offset': offset}, data=data)
+            part_response.raise_for_status()
+            if not part_response.json()['success']:
+                raise SessionRejected(part_response)
+            with pbar_lock:
+                pbar.update(len(data))
+        retries = 0
+        received = status['received']
+        try:
+            while status['missing']:
+                parts = [(offset, min(SESSION_CHUNK_SIZE, end - offset))
+                         for start, end in status['missing'] for offset in range(start, end, SESSION_CHUNK_SIZE)]
+                try:
+                    executor = ThreadPoolExecutor(max_workers=self.concurrency)
+                    try:
+                        for future in [executor.submit(send_part, *part) for part in parts]:
+                            future.result()
+                    except BaseException:
+                        # queued parts are not sent once a part failed or the session rejected one
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    executor.shutdown()
+                    status = self.session.get(session_url).json()
+                except requests.RequestException as exception:
+                    retries += 1
+                    if retries > SESSION_MAX_RETRIES:
+                        raise
+                    getLogger(__name__).warning(f"Upload of {file_basename} interrupted ({exception}), resuming ({retries}/{SESSION_MAX_RETRIES})")
+                    time.sleep(min(2 ** retries, 30))
+                    try:
+                        status = self.session.get(session_url).json()
+                    except requests.RequestException:
+                        continue
+                    if status['received'] > received:
+                        # the upload progressed since the last interruption, only interruptions in a row are limited
+                        retries = 0
+                    received = status['received']
+                    pbar.n = status['received']
+                    pbar.refresh()
+        except SessionRejected as rejected:
+            return rejected.response
+        finally:
+            pbar.close()
+        return self.session.post(session_url + '/finalize', data={'hashvalue': hashvalue, 'normalize': normalize})
         
+    def upload_archive(self, file_paths:List[str], base_dir:str, modeltype:str = 'lora', target_path:str = "", compression:str = "") -> requests.Response:
+        """
+        Uploads many files with a single request, as a tar archive which is built while it is sent.
+        Paths inside the archive are relative to base_dir, the server extracts them under <model dir>/<target_path>.
+        @param modeltype: sd, vae, lora, textual_inversion, controlnet or dynamic_prompts
+        @param compression: "" or "zstd" (requires zstandard)
+        """
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package, install it with 'pip install zstandard'")
+        read_fd, write_fd = os.pipe()
+        def write_archive():
+            try:
+                with os.fdopen(write_fd, 'wb') as pipe:
+                    output = zstandard.ZstdCompressor().stream_writer(pipe) if compression == 'zstd' else pipe
+                    with tarfile.open(fileobj=output, mode='w|') as archive:
+                        for file_path in file_paths:
+                            archive.add(file_path, arcname=os.path.relpath(file_path, base_dir).replace(os.sep, '/'))
+                    output.close()
+            except BrokenPipeError:
+                pass # the server stopped reading, its response tells why
+        writer = threading.Thread(target=write_archive, daemon=True)
+        writer.start()
+        with os.fdopen(read_fd, 'rb') as pipe:
+            response = self.session.post(self.target_ap_address + 'upload_archive',
+                                         params={'modeltype': modeltype, 'path': target_path, 'compression': compression},
+                                         headers={'Content-Type': 'application/x-tar'},
+                                         data=iter(lambda: pipe.read(1 << 20), b''))
+        writer.join()
+        return response
+
     def upload_lora_to(self, lora_path:str = 'test/test.safetensors', target_path:str = 'test') -> requests.Response:
         """
         Uploads lora from absolute path to target_path
@@ -206,22 +532,22 @@ class Connection:
         return responses
         
     @decorate_check_connection
-    def upload_sd_model(self, model_path: str = 'test/test.safetensors') -> requests.Response:
+    def upload_sd_model(self, model_path: str = 'test/test.safetensors', hashvalue:str = "") -> requests.Response:
         """
             Uploads the model to the server
             @param model_path: path to the model
-            
+            @param hashvalue: hash of the model if known
         """
         model_target_dirs = model_path.split('/')[:-1]
         model_target_dir = '/'.join(model_target_dirs)
         url = self.target_ap_address + 'upload_sd_model'
         real_model_path = join_path(get_sd_ckpt_dir(), model_path)
         with open(real_model_path, 'rb') as f:
-            response = self.send_data(f, 'sd_path', model_target_dir, url, file_basename=os.path.basename(real_model_path))
+            response = self.send_data(f, 'sd_path', model_target_dir, url, file_basename=os.path.basename(real_model_path), hashvalue=hashvalue)
         return response
         
     @decorate_check_connection
-    def upload_vae_model(self, model_path: str = 'test/test.safetensors') -> requests.Response:
+    def upload_vae_model(self, model_path: str = 'test/test.safetensors', hashvalue:str = "") -> requests.Response:
         """
             Uploads the model to the server
         """
@@ -231,11 +557,11 @@ class Connection:
         url = self.target_ap_address + 'upload_vae_model'
         real_model_path = join_path(get_vae_ckpt_dir(), model_path)
         with open(real_model_path, 'rb') as f:
-            response = self.send_data(f, 'vae_path', model_target_dir, url, file_basename=os.path.basename(real_model_path))
+            response = self.send_data(f, 'vae_path', model_target_dir, url, file_basename=os.path.basename(real_model_path), hashvalue=hashvalue)
         return response
     
     @decorate_check_connection
-    def upload_lora_model(self, model_path: str = 'test/test.safetensors') -> requests.Response:
+    def upload_lora_model(self, model_path: str = 'test/test.safetensors', hashvalue:str = "") -> requests.Response:
         """
             Uploads the model to the server
         """
@@ -245,95 +571,242 @@ class Connection:
         url = self.target_ap_address + 'upload_lora_model'
         real_model_path = join_path(get_lora_ckpt_dir(), model_path)
         with open(real_model_path, 'rb') as f:
-            response = self.send_data(f, 'lora_path', model_target_dir, url, file_basename=os.path.basename(real_model_path))
+            response = self.send_data(f, 'lora_path', model_target_dir, url, file_basename=os.path.basename(real_model_path), hashvalue=hashvalue)
         return response
     
     @decorate_check_connection
-    def upload_textual_inversion_model(self, model_path: str = 'test/test.pt') -> requests.Response:
+    def upload_textual_inversion_model(self, model_path: str = 'test/test.pt', hashvalue:str = "") -> requests.Response:
         """
             Uploads the model to the server
         """
         
         model_target_dirs = model_path.split('/')[:-1]
         model_target_dir = '/'.join(model_target_dirs)
-        url = self.target_ap_address + 'upload_textual_inversion_model'
+        url = self.target_ap_address + 'upload_embedding'
         real_model_path = join_path(get_textual_inversion_dir(), model_path)
         with open(real_model_path, 'rb') as f:
-            response = self.send_data(f, 'textual_inversion_path', model_target_dir, url, file_basename=os.path.basename(real_model_path))
+            response = self.send_data(f, 'textual_inversion_path', model_target_dir, url, file_basename=os.path.basename(real_model_path), hashvalue=hashvalue)
         return response
     
+    def create_manifest(self, modeltypes:Tuple[str, ...], hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM) -> dict:
+        """
+        Returns the /sync/diff manifest of the local models of modeltypes, relative paths use '/'
+        """
+        models = {}
+        for modeltype in modeltypes:
+            model_dir = SYNC_MODEL_DIRS[modeltype]()
+            response_json = self.create_self_request(f'get_hash_{modeltype}_all', path = "", hash_mode = hash_mode, hash_algorithm = hash_algorithm)
+            if not response_json['success']:
+                if not os.path.isdir(model_dir):
+                    models[modeltype] = []
+                    continue
+                raise ValueError(f"Could not hash local {modeltype} models : {response_json['message']}")
+            models[modeltype] = []
+            for relative_path, hashvalue in response_json['hashes'].items():
+                if not hashvalue:
+                    continue
+                file_path = join_path(model_dir, relative_path)
+                entry = [relative_path.replace('\\', '/'), os.path.getsize(file_path), hashvalue]
+                original_hash = get_original_hash(file_path) if not hash_mode and hash_algorithm == DEFAULT_ALGORITHM else ""
+                models[modeltype].append(entry + [original_hash] if original_hash else entry)
+        return {'models': models, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm}
+
+    def diff_hash_options(self, hash_mode:Optional[str] = None) -> List[Tuple[str, str]]:
+        """
+        Returns the (hash_mode, hash_algorithm) to compare whole libraries with, in order of preference.
+        Quick hashes are used unless verify_full_hash is set, full hashes are the fallback for servers which reject them.
+        """
+        hash_mode = self.hash_mode if hash_mode is None else hash_mode
+        options = [("", DEFAULT_ALGORITHM)]
+        if (hash_mode or self.hash_algorithm != DEFAULT_ALGORITHM) and not self.verify_full_hash:
+            options.insert(0, (hash_mode, self.hash_algorithm))
+        return options
+
+    def diff_model_tree(self, modeltype:str, hash_mode:str = "", hash_algorithm:str = DEFAULT_ALGORITHM) -> dict:
+        """
+        Compares the merkle trees of modeltype (see /models/merkle) level by level, descending only into directories
+        whose digests differ, one request per directory level. Returns missing, different and extra relative paths.
+        """
+        missing, different, extra = [], [], []
+        level = [""]
+        while level:
+            self_json = self.create_self_request('get_merkle_directories', modeltype = modeltype, paths = level, hash_mode = hash_mode, hash_algorithm = hash_algorithm)
+            if not self_json['success']:
+                raise ValueError(f"Could not summarize local {modeltype} models : {self_json['message']}")
+            response = self.session.post(self.target_ap_address + 'models/merkle', data={
+                'modeltype': modeltype, 'paths': level, 'hash_mode': hash_mode, 'hash_algorithm': hash_algorithm,
+            })
+            if response.status_code in (404, 405):
+                raise EndpointUnavailable('Server does not support /models/merkle')
+            if response.status_code != 200:
+                raise ConnectionRefusedError(f'Server could not summarize models, status {response.status_code}, {response.text}')
+            server_json = response.json()
+            if not server_json['success']:
+                raise ValueError(f"Server could not summarize {modeltype} models : {server_json['message']}")
+            next_level = []
+            for directory in level:
+                self_directory, server_directory = self_json['directories'][directory], server_json['directories'][directory]
+                if self_directory['digest'] == server_directory['digest']:
+                    continue
+                for name in sorted(set(self_directory['children']) | set(server_directory['children'])):
+                    self_child = self_directory['children'].get(name)
+                    server_child = server_directory['children'].get(name)
+                    if self_child == server_child or self.same_file_entry(self_child, server_child):
+                        continue
+                    child_path = f"{directory}/{name}" if directory else name
+                    # directories missing on one side are listed through the other side's descent
+                    if 'd' in (self_child and self_child[0], server_child and server_child[0]):
+                        next_level.append(child_path)
+                    if self_child is not None and self_child[0] == 'f':
+                        (different if server_child is not None and server_child[0] == 'f' else missing).append(child_path)
+                    elif server_child is not None and server_child[0] == 'f':
+                        extra.append(child_path)
+            level = next_level
+        return {'missing': missing, 'different': different, 'extra': extra}
+
+    @staticmethod
+    def same_file_entry(self_child:Optional[list], server_child:Optional[list]) -> bool:
+        """
+        Returns True if two merkle file entries [kind, hash(, original hash)] match, one side may hold a normalized copy of the other
+        """
+        if self_child is None or server_child is None or self_child[0] != 'f' or server_child[0] != 'f':
+            return False
+        return self_child[1] in server_child[1:] or server_child[1] in self_child[1:]
+
+    def diff_model_trees(self, modeltypes:Tuple[str, ...] = tuple(SYNC_MODEL_DIRS), hash_mode:Optional[str] = None) -> dict:
+        """
+        Same as diff_models, but compares merkle trees, so libraries which are (almost) in sync take a few requests
+        and send only the directories which differ. Raises EndpointUnavailable if the server has no merkle trees.
+        """
+        message = ""
+        for option_mode, option_algorithm in self.diff_hash_options(hash_mode):
+            try:
+                diffs = {modeltype: self.diff_model_tree(modeltype, option_mode, option_algorithm) for modeltype in modeltypes}
+            except ValueError as e:
+                message = str(e)
+                continue
+            return {'success': True, 'message': "", 'hash_mode': option_mode, 'hash_algorithm': option_algorithm,
+                    **{key: {modeltype: diff[key] for modeltype, diff in diffs.items() if diff[key]} for key in ('missing', 'different', 'extra')}}
+        raise ConnectionRefusedError(f"Could not compare models with the server : {message}")
+
+    def diff_models(self, modeltypes:Tuple[str, ...] = tuple(SYNC_MODEL_DIRS), hash_mode:Optional[str] = None) -> dict:
+        """
+        Compares the local models of modeltypes with the server's in one /sync/diff request.
+        Returns the response json, relative paths per model type : missing (not on the server), different, extra (only on the server).
+        Quick hashes (hash_mode, hash_algorithm) are compared unless verify_full_hash is set, the server then hashes every
+        file of equal size in full anyway. Servers which reject the quick hash options are compared with full hashes.
+        Raises EndpointUnavailable if the server has no /sync/diff.
+        """
+        message = ""
+        for option_mode, option_algorithm in self.diff_hash_options(hash_mode):
+            try:
+                manifest = self.create_manifest(modeltypes, option_mode, option_algorithm)
+            except ValueError as e:
+                message = str(e)
+                continue
+            body = json.dumps(manifest).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}
+            if 'zstd' in self.get_server_encodings():
+                body = encode('zstd', body)
+                headers['Content-Encoding'] = 'zstd'
+            response = self.session.post(self.target_ap_address + 'sync/diff', data=body, headers=headers)
+            if response.status_code in (404, 405):
+                raise EndpointUnavailable('Server does not support /sync/diff')
+            if response.status_code != 200:
+                raise ConnectionRefusedError(f'Server could not compare models, status {response.status_code}, {response.text}')
+            response_json = response.json()
+            if response_json['success']:
+                return response_json
+            message = response_json['message']
+        raise ConnectionRefusedError(f"Could not compare models with the server : {message}")
+
     @standalone
     @decorate_check_connection
-    def sync_all_sd_models(self) -> None:
+    def sync_models(self, modeltypes:Tuple[str, ...] = tuple(SYNC_MODEL_DIRS), hash_mode:Optional[str] = None) -> dict:
+        """
+            Syncs all models of modeltypes with the server, uploads the models which are missing or different there.
+            The libraries are compared with merkle trees, or with a /sync/diff manifest if the server has no merkle trees.
+            Returns modeltype -> relative path -> upload response. Models only on the server are kept.
+        """
+        upload_funcs = {'sd': self.upload_sd_model, 'vae': self.upload_vae_model, 'lora': self.upload_lora_model,
+                        'textual_inversion': self.upload_textual_inversion_model}
+        try:
+            diff = self.diff_model_trees(modeltypes, hash_mode)
+        except EndpointUnavailable:
+            try:
+                diff = self.diff_models(modeltypes, hash_mode)
+            except EndpointUnavailable:
+                return {modeltype: self.sync_models_per_file(modeltype, hash_mode) for modeltype in modeltypes}
+        results = {}
+        for modeltype in modeltypes:
+            results[modeltype] = {}
+            for model_path in diff['missing'].get(modeltype, []) + diff['different'].get(modeltype, []):
+                print("Syncing", model_path, "to", self.target_ap_address)
+                self_hash = self.create_self_request(SYNC_HASH_ACCESSORS[modeltype], path = model_path)['hashvalue']
+                results[modeltype][model_path] = self.verify_upload(upload_funcs[modeltype](model_path, hashvalue=self_hash), self_hash)
+        return results
+
+    def sync_models_per_file(self, modeltype:str, hash_mode:Optional[str] = None) -> dict:
         """
-            Syncs all models with the server
+            Syncs the models of modeltype one request per file, for servers without /sync/diff
         """
-        
-        for model_path in glob.glob(get_sd_ckpt_dir() + '/**/*.safetensors', recursive=True):
+        sync_funcs = {'sd': self.sync_sd_model, 'vae': self.sync_vae_model, 'lora': self.sync_lora_model,
+                      'textual_inversion': self.sync_textual_inversion_model}
+        base_ckpt_dir = SYNC_MODEL_DIRS[modeltype]()
+        results = {}
+        for model_path in glob.glob(base_ckpt_dir + f'/**/*{SYNC_GLOB_EXTENSIONS[modeltype]}', recursive=True):
             print("Syncing", model_path, "to", self.target_ap_address)
-            base_ckpt_dir = get_sd_ckpt_dir()
             # remove base_ckpt_dir from model_path
             model_path = model_path[len(base_ckpt_dir) + 1:]
-            self.sync_sd_model(model_path)
-            
+            results[model_path] = sync_funcs[modeltype](model_path, hash_mode)
+        return results
+
     @standalone
     @decorate_check_connection
-    def sync_all_vae_models(self) -> None:
+    def sync_all_sd_models(self) -> dict:
         """
             Syncs all models with the server
         """
-        for model_path in glob.glob(get_vae_ckpt_dir() + '/**/*.safetensors', recursive=True):
-            print("Syncing", model_path, "to", self.target_ap_address)
-            base_ckpt_dir = get_vae_ckpt_dir()
-            # remove base_ckpt_dir from model_path
-            model_path = model_path[len(base_ckpt_dir) + 1:]
-            print(model_path)
-            self.sync_vae_model(model_path)
+        return self.sync_models(('sd',))['sd']
             
     @standalone
     @decorate_check_connection
-    def sync_all_lora_models(self) -> None:
+    def sync_all_vae_models(self) -> dict:
         """
             Syncs all models with the server
         """
-        
-        for model_path in glob.glob(get_lora_ckpt_dir() + '/**/*.safetensors', recursive=True):
-            print("Syncing", model_path, "to", self.target_ap_address)
-            base_ckpt_dir = get_lora_ckpt_dir()
-            # remove base_ckpt_dir from model_path
-            model_path = model_path[len(base_ckpt_dir) + 1:]
-            self.sync_lora_model(model_path)
+        return self.sync_models(('vae',))['vae']
             
     @standalone
     @decorate_check_connection
-    def sync_all_textual_inversion_models(self) -> None:
+    def sync_all_lora_models(self) -> dict:
         """
             Syncs all models with the server
         """
-        
-        for model_path in glob.glob(get_textual_inversion_dir() + '/**/*.pt', recursive=True):
-            print("Syncing", model_path, "to", self.target_ap_address)
-            base_ckpt_dir = get_textual_inversion_dir()
-            # remove base_ckpt_dir from model_path
-            model_path = model_path[len(base_ckpt_dir) + 1:]
-            self.sync_textual_inversion_model(model_path)
+        return self.sync_models(('lora',))['lora']
             
     @standalone
     @decorate_check_connection
-    def sync_everything(self) -> None:
+    def sync_all_textual_inversion_models(self) -> dict:
         """
             Syncs all models with the server
         """
-        self.sync_all_sd_models()
-        self.sync_all_vae_models()
-        self.sync_all_lora_models()
-        self.sync_all_textual_inversion_models()
+        return self.sync_models(('textual_inversion',))['textual_inversion']
+            
+    @standalone
+    @decorate_check_connection
+    def sync_everything(self) -> dict:
+        """
+            Syncs all models with the server, see sync_models
+        """
+        return self.sync_models()
         
     @standalone
     @decorate_check_connection
-    def sync_sd_model(self, model_path: str = 'test/test.safetensors') -> requests.Response:
+    def sync_sd_model(self, model_path: str = 'test/test.safetensors', hash_mode:Optional[str] = None) -> requests.Response:
         """
             Syncs the model with the server
+            @param hash_mode: overrides the hash_mode of the connection for this model
         """
         if '/' in model_path:
             model_target_dirs = model_path.split('/')
@@ -343,31 +816,14 @@ class Connection:
             model_target_dirs = [model_path]
             
         model_path = '/'.join(model_target_dirs)
-        # query hash to self and server
-        self_response_json = self.create_self_request('get_hash_sd', path = model_path)
-        # {'hash': '1234567890'}
-        self_hash = self_response_json['hashvalue']
-        if not self_response_json['success']:
-            raise FileNotFoundError(f'{self.get_master_ap_address()} does not have requested model in path ' + model_path + ' ' + str(self_response_json['message']))
-        # server
-        server_target_access = self.target_ap_address + 'models/query_hash_sd'
-        server_hash_response = self.session.post(server_target_access, data={'path': model_path})
-        if server_hash_response.status_code == 200:
-            response_json = server_hash_response.json()
-            server_hash = response_json['hashvalue']
-            success = response_json['success']
-            if server_hash != self_hash or not success:
-                # sync
-                return self.upload_sd_model(model_path)
-            return {"message": "Ther file hash matched with request", 'success': True}
-        else:
-            raise ConnectionRefusedError(f'Server does not support Model Syncing, status {server_hash_response.status_code}, {server_hash_response.text}')
+        return self.sync_model('get_hash_sd', 'models/query_hash_sd', self.upload_sd_model, model_path, hash_mode)
             
     @standalone
     @decorate_check_connection
-    def sync_vae_model(self, model_path: str = 'test/test.safetensors') -> requests.Response:
+    def sync_vae_model(self, model_path: str = 'test/test.safetensors', hash_mode:Optional[str] = None) -> requests.Response:
         """
             Syncs the model with the server
+            @param hash_mode: overrides the hash_mode of the connection for this model
         """
         assert not model_path.startswith('/') and not model_path.startswith('\\'), "model_path should be relative path"
         if '/' in model_path:
@@ -377,33 +833,14 @@ class Connection:
         else:
             model_target_dirs = [model_path]
         model_path = '/'.join(model_target_dirs)
-        # query hash to self and server
-        print(f"Querying hash to self with data {{'path': {model_path}}}")
-        self_response_json = self.create_self_request('get_hash_vae', path = model_path)
-        # {'hash': '1234567890'}
-        print("Querying hash to server")
-        self_hash = self_response_json['hashvalue']
-        if not self_response_json['success']:
-            raise FileNotFoundError(f'{self.get_master_ap_address()} does not have requested model in path ' + model_path + ' ' + str(self_response_json['message']))
-        # server
-        server_target_access = self.target_ap_address + 'models/query_hash_vae'
-        server_hash_response = self.session.post(server_target_access, data={'path': model_path})
-        if server_hash_response.status_code == 200:
-            response_json = server_hash_response.json()
-            server_hash = response_json['hashvalue']
-            success = response_json['success']
-            if server_hash != self_hash or not success:
-                # sync
-                return self.upload_vae_model(model_path)
-            return {"message": "Ther file hash matched with request", 'success': True}
-        else:
-            raise ConnectionRefusedError(f'Server does not support Model Syncing, status {server_hash_response.status_code}, {server_hash_response.text}')
+        return self.sync_model('get_hash_vae', 'models/query_hash_vae', self.upload_vae_model, model_path, hash_mode)
         
     @standalone
     @decorate_check_connection
-    def sync_lora_model(self, model_path: str = 'test/test.safetensors') -> requests.Response:
+    def sync_lora_model(self, model_path: str = 'test/test.safetensors', hash_mode:Optional[str] = None) -> requests.Response:
         """
             Syncs the model with the server
+            @param hash_mode: overrides the hash_mode of the connection for this model
         """
         assert not model_path.startswith('/') and not model_path.startswith('\\'), "model_path should be relative path"
         if '/' in model_path:
@@ -413,31 +850,14 @@ class Connection:
         else:
             model_target_dirs = [model_path]
         model_path = '/'.join(model_target_dirs)
-        # query hash to self and server
-        self_response_json = self.create_self_request('get_hash_lora', path = model_path)
-        # {'hash': '1234567890'}
-        self_hash = self_response_json['hashvalue']
-        if not self_response_json['success']:
-            raise FileNotFoundError(f'{self.get_master_ap_address()} does not have requested model in path ' + model_path + ' ' + str(self_response_json['message']))
-        # server
-        server_target_access = self.target_ap_address + 'models/query_hash_lora'
-        server_hash_response = self.session.post(server_target_access, data={'path': model_path})
-        if server_hash_response.status_code == 200:
-            response_json = server_hash_response.json()
-            server_hash = response_json['hashvalue']
-            success = response_json['success']
-            if server_hash != self_hash or not success:
-                # sync
-                return self.upload_lora_model(model_path)
-            return {"message": "Ther file hash matched with request", 'success': True}
-        else:
-            raise ConnectionRefusedError(f'Server does not support Model Syncing, status {server_hash_response.status_code}, {server_hash_response.text}')
+        return self.sync_model('get_hash_lora', 'models/query_hash_lora', self.upload_lora_model, model_path, hash_mode)
     
     @standalone
     @decorate_check_connection
-    def sync_textual_inversion_model(self, model_path:str = 'test/test.pt'):
+    def sync_textual_inversion_model(self, model_path:str = 'test/test.pt', hash_mode:Optional[str] = None):
         """
             Syncs the model with the server
+            @param hash_mode: overrides the hash_mode of the connection for this model
         """
         assert not model_path.startswith('/') and not model_path.startswith('\\'), "model_path should be relative path"
         if '/' in model_path:
@@ -447,22 +867,4 @@ class Connection:
         else:
             model_target_dirs = [model_path]
         model_path = '/'.join(model_target_dirs)
-        # query hash to self and server
-        self_response_json = self.create_self_request('get_hash_textual_inversion', path = model_path)
-        # {'hash': '1234567890'}
-        self_hash = self_response_json['hashvalue']
-        if not self_response_json['success']:
-            raise FileNotFoundError(f'{self.get_master_ap_address()} does not have requested model in path ' + model_path + ' ' + str(self_response_json['message']))
-        # server
-        server_target_access = self.target_ap_address + 'models/query_hash_embedding'
-        server_hash_response = self.session.post(server_target_access, data={'path': model_path})
-        if server_hash_response.status_code == 200:
-            response_json = server_hash_response.json()
-            server_hash = response_json['hashvalue']
-            success = response_json['success']
-            if server_hash != self_hash or not success:
-                # sync
-                return self.upload_textual_inversion_model(model_path)
-            return {"message": "Ther file hash matched with request", 'success': True}
-        else:
-            raise ConnectionRefusedError(f'Server does not support Model Syncing, status {server_hash_response.status_code}, {server_hash_response.text}')
\ No newline at end of file
+        return self.sync_model('get_hash_textual_inversion', 'models/query_hash_embedding', self.upload_textual_inversion_model, model_path, hash_mode)
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+Hashes in the format of webui's own hash cache.
+webui stores the full sha256 of checkpoints, LoRAs and embeddings in its cache (cache.json or the cache directory)
+and reads the whole file again to compute it when it is missing. Uploads and hash walks compute these hashes in the
+same pass as our own hash (see MultiDigestHasher) and write them to that cache, so webui does not read the file again.
+"""
+import os
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+from scripts.hashes import DEFAULT_SIZE_TO_READ, FastFileHasher, MultiDigestHasher
+from scripts.paths import get_sd_ckpt_dir, get_lora_ckpt_dir, get_textual_inversion_dir
+
+@lru_cache(maxsize=1)
+def get_webui_cache() -> Optional[Tuple[Callable, Callable]]:
+    """
+    Returns (cache, dump_cache) of webui, None if not running in webui
+    """
+    try:
+        from modules.cache import cache, dump_cache
+    except (ModuleNotFoundError, ImportError):
+        try:
+            # webui before 1.6 kept the cache in modules.hashes
+            from modules.hashes import cache, dump_cache
+        except (ModuleNotFoundError, ImportError):
+            return None
+    return cache, dump_cache
+
+def webui_hash_title(modeltype:str, file_path:str) -> str:
+    """
+    Returns the title webui caches the hash of file_path under, "" if webui does not hash modeltype.
+    Checkpoints are named by their path in the checkpoint directory, LoRAs and embeddings by their file name.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    try:
+        if modeltype == 'sd':
+            return "checkpoint/" + os.path.relpath(os.path.abspath(file_path), os.path.abspath(get_sd_ckpt_dir()))
+        if modeltype == 'lora':
+            return "lora/" + name
+        if modeltype == 'textual_inversion':
+            return "textual_inversion/" + name
+    except AssertionError:
+        return "" # the model directory does not exist
+    return ""
+
+def find_modeltype(file_path:str) -> str:
+    """
+    Returns the modeltype whose directory contains file_path, "" if webui does not hash it
+    """
+    getters = {'sd': get_sd_ckpt_dir, 'lora': get_lora_ckpt_dir, 'textual_inversion': get_textual_inversion_dir}
+    file_path = os.path.abspath(file_path)
+    for modeltype, getter in getters.items():
+        try:
+            model_dir = os.path.abspath(getter())
+        except AssertionError:
+            continue
+        if file_path.startswith(model_dir.rstrip(os.sep) + os.sep):
+            return modeltype
+    return ""
+
+def uses_addnet_hash(modeltype:str, file_path:str) -> bool:
+    """
+    webui identifies safetensors LoRAs by the hash of their tensor data
+    """
+    return modeltype == 'lora' and file_path.lower().endswith('.safetensors')
+
+def new_upload_hasher(modeltype:str, filename:str):
+    """
+    Returns the hasher for an upload, a MultiDigestHasher if webui caches hashes of modeltype, else a FastFileHasher
+    """
+    if get_webui_cache() is None or not webui_hash_title(modeltype, filename):
+        return FastFileHasher()
+    return MultiDigestHasher(addnet=uses_addnet_hash(modeltype, filename))
+
+def upload_digests(hasher) -> Dict[str, str]:
+    """
+    Returns the digests of an upload hasher, empty if it only computes our hash
+    """
+    return hasher.digests() if isinstance(hasher, MultiDigestHasher) else {}
+
+def has_webui_hash(modeltype:str, file_path:str) -> bool:
+    """
+    Returns True if webui's cache holds a current hash of file_path
+    """
+    webui_cache = get_webui_cache()
+    title = webui_hash_title(modeltype, file_path)
+    if webui_cache is None or not title:
+        return False
+    cache, _ = webui_cache
+    try:
+        hashes = cache("hashes-addnet" if uses_addnet_hash(modeltype, file_path) else "hashes")
+        entry = hashes[title] if title in hashes else {}
+        return bool(entry.get("sha256")) and os.path.getmtime(file_path) <= entry.get("mtime", 0)
+    except Exception as e:
+        print(f"Could not read webui hash cache : {e}")
+        return False
+
+def register_webui_hashes(modeltype:str, file_path:str, digests:Dict[str, str]) -> bool:
+    """
+    Writes the sha256 (or addnet hash) of digests to webui's cache for file_path, returns True if it was written
+    """
+    webui_cache = get_webui_cache()
+    title = webui_hash_title(modeltype, file_path)
+    addnet = uses_addnet_hash(modeltype, file_path)
+    sha256 = digests.get('addnet' if addnet else 'sha256')
+    if webui_cache is None or not title or not sha256:
+        return False
+    cache, dump_cache = webui_cache
+    try:
+        hashes = cache("hashes-addnet" if addnet else "hashes")
+        hashes[title] = {"mtime": os.path.getmtime(file_path), "sha256": sha256}
+        dump_cache()
+    except Exception as e:
+        print(f"Could not write webui hash of {file_path} : {e}")
+        return False
+    return True
+
+def wants_webui_hashes(file_path:str, size_to_read:int = DEFAULT_SIZE_TO_READ) -> str:
+    """
+    Returns the modeltype of file_path if hashing it should also produce webui's hashes, else "".
+    Only files which are read completely by our hash anyway qualify, so the webui hashes never cost an extra read.
+    """
+    if get_webui_cache() is None or size_to_read != DEFAULT_SIZE_TO_READ:
+        return ""
+    modeltype = find_modeltype(file_path)
+    if not modeltype or os.path.getsize(file_path) > size_to_read or has_webui_hash(modeltype, file_path):
+        return ""
+    return modeltype
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the extension's modules are imported as scripts.<module>, like webui does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+import argparse
+import pytest
+from preload import preload
+from scripts import admission
+
+def parse(*args):
+    parser = argparse.ArgumentParser()
+    preload(parser)
+    return parser.parse_args(list(args))
+
+@pytest.mark.parametrize("name, option", [
+    ('upload', '--uploader-max-uploads'),
+    ('hash', '--uploader-max-hashes'),
+    ('sync', '--uploader-max-syncs'),
+    ('download', '--uploader-max-downloads'),
+])
+def test_limit_option(monkeypatch, name, option):
+    monkeypatch.setattr(admission, 'get_cmd_opts', lambda: parse(option, '7'))
+    assert admission.get_limit(name) == 7
+
+def test_limit_defaults(monkeypatch):
+    monkeypatch.setattr(admission, 'get_cmd_opts', lambda: parse())
+    assert {name: admission.get_limit(name) for name in admission.DEFAULT_LIMITS} == admission.DEFAULT_LIMITS
+
+def test_limit_options_match_preload():
+    options = vars(parse())
+    assert all(attribute in options for attribute in admission.LIMIT_OPTIONS.values())
@@ -0,0 +1,82 @@
+import os
+import pytest
+from scripts.hash_index import HashIndex
+
+@pytest.fixture
+def index(tmp_path):
+    index = HashIndex(str(tmp_path / 'hashes.sqlite3'))
+    yield index
+    index.close()
+
+@pytest.fixture
+def model(tmp_path):
+    file_path = str(tmp_path / 'model.bin')
+    with open(file_path, 'wb') as f:
+        f.write(b'a' * 1000)
+    return file_path
+
+def modify(file_path:str, data:bytes = b'b' * 1000) -> None:
+    stat = os.stat(file_path)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    # the mtime alone must tell the change, even on filesystems with coarse timestamps
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def test_set_and_get(index, model):
+    stat = os.stat(model)
+    index.set(model, 'hash', stat=stat)
+    assert index.get(model) == 'hash'
+    index.flush()
+    assert index.get(model) == 'hash'
+    assert model in index
+
+def test_stale_stat_is_rejected(index, model):
+    # the file changed while it was hashed, the hash may belong to neither version
+    stat = os.stat(model)
+    modify(model)
+    index.set(model, 'hash of the old content', stat=stat)
+    assert index.get(model) is None
+    assert model not in index
+
+def test_changed_file_is_not_returned(index, model):
+    index.set(model, 'hash', stat=os.stat(model))
+    index.flush()
+    modify(model)
+    assert index.get(model) is None
+    index.flush()
+    assert model not in index
+
+def test_read_length_must_match(index, model):
+    index.set(model, 'hash', 1 << 31)
+    assert index.get(model, 1 << 31) == 'hash'
+    # 1000 bytes hold no whole block, both hashes read nothing
+    assert index.get(model, 1 << 16) == 'hash'
+    with open(model, 'wb') as f:
+        f.write(b'a' * (1 << 17))
+    index.set(model, 'hash', 1 << 31)
+    assert index.get(model, 1 << 16) is None
+
+def test_algorithms_are_separate(index, model):
+    index.set(model, 'sha', algorithm='sha256')
+    index.set(model, 'blake', algorithm='blake2b')
+    assert index.get(model, algorithm='sha256') == 'sha'
+    assert index.get(model, algorithm='blake2b') == 'blake'
+    index.remove(model)
+    assert index.get(model, algorithm='blake2b') is None
+
+def test_entries_persist(tmp_path, model):
+    index = HashIndex(str(tmp_path / 'hashes.sqlite3'))
+    index.set(model, 'hash')
+    index.close()
+    reopened = HashIndex(str(tmp_path / 'hashes.sqlite3'))
+    try:
+        assert reopened.get(model) == 'hash'
+    finally:
+        reopened.close()
+
+def test_remove_missing(index, model):
+    index.set(model, 'hash')
+    index.flush()
+    os.remove(model)
+    assert index.remove_missing() == 1
+    assert index.paths() == []
@@ -0,0 +1,56 @@
+import os
+import hashlib
+import struct
+import pytest
+from scripts.hashes import AUTOV1_LENGTH, AUTOV1_OFFSET, BUF_SIZE, FastFileHasher, MultiDigestHasher, compute_file_digests, compute_file_hash
+
+def write_file(tmp_path, data:bytes, name:str = 'model.bin') -> str:
+    file_path = str(tmp_path / name)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    return file_path
+
+def feed(hasher, data:bytes, chunk_size:int):
+    for start in range(0, len(data), chunk_size):
+        hasher.update(data[start:start + chunk_size])
+    return hasher
+
+@pytest.mark.parametrize("size", [0, 1, BUF_SIZE - 1, BUF_SIZE, BUF_SIZE + 1, 3 * BUF_SIZE + 123, AUTOV1_OFFSET + AUTOV1_LENGTH + 5])
+@pytest.mark.parametrize("chunk_size", [1000, BUF_SIZE, 1 << 20])
+def test_multi_digest_hasher_matches_file_hashes(tmp_path, size, chunk_size):
+    data = os.urandom(size)
+    file_path = write_file(tmp_path, data)
+    digests = feed(MultiDigestHasher(), data, chunk_size).digests()
+    assert digests['hashvalue'] == compute_file_hash(file_path)
+    assert digests['sha256'] == hashlib.sha256(data).hexdigest()
+    assert digests['autov1'] == hashlib.sha256(data[AUTOV1_OFFSET:AUTOV1_OFFSET + AUTOV1_LENGTH]).hexdigest()[:8]
+    assert digests['autov2'] == digests['sha256'][:10]
+    assert digests == compute_file_digests(file_path)
+
+def test_final_partial_block_is_not_hashed():
+    # baseline quirk of fast_file_hash : only whole BUF_SIZE blocks are hashed, the rest only counts in the size
+    data = bytearray(os.urandom(2 * BUF_SIZE + 100))
+    before = feed(MultiDigestHasher(), bytes(data), 4096).digests()
+    data[-1] ^= 0xff
+    after = feed(MultiDigestHasher(), bytes(data), 4096).digests()
+    assert after['hashvalue'] == before['hashvalue']
+    assert after['sha256'] != before['sha256']
+    assert feed(FastFileHasher(), bytes(data), 4096).hexdigest() == before['hashvalue']
+    data[0] ^= 0xff
+    assert feed(MultiDigestHasher(), bytes(data), 4096).digests()['hashvalue'] != before['hashvalue']
+
+def test_size_to_read(tmp_path):
+    data = os.urandom(5 * BUF_SIZE + 7)
+    file_path = write_file(tmp_path, data)
+    size_to_read = 2 * BUF_SIZE + 10
+    hashvalue = feed(MultiDigestHasher(size_to_read), data, 3000).hexdigest()
+    assert hashvalue == compute_file_hash(file_path, size_to_read)
+    assert hashvalue == feed(FastFileHasher(size_to_read), data, 3000).hexdigest()
+
+def test_addnet_hash():
+    tensor_data = os.urandom(3 * BUF_SIZE)
+    header = b'{"t": {"dtype": "U8", "shape": [%d], "data_offsets": [0, %d]}}' % (len(tensor_data), len(tensor_data))
+    data = struct.pack('<Q', len(header)) + header + tensor_data
+    digests = feed(MultiDigestHasher(addnet=True), data, 5).digests()
+    assert digests['addnet'] == hashlib.sha256(tensor_data).hexdigest()
+    assert 'addnet' not in MultiDigestHasher().digests()
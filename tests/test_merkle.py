@@ -0,0 +1,142 @@
+import os
+import hashlib
+from typing import Dict, List
+import pytest
+from scripts.merkle import DIRECTORY, FILE, MerkleTree
+from scripts.uploader import Connection, EndpointUnavailable
+
+def make_tree(root) -> MerkleTree:
+    def list_files() -> Dict[str, str]:
+        return {os.path.relpath(os.path.join(directory, name), root): os.path.join(directory, name)
+                for directory, _, names in os.walk(root) for name in names}
+    def hash_files(file_paths:List[str]) -> Dict[str, str]:
+        hashes = {}
+        for file_path in file_paths:
+            with open(file_path, 'rb') as f:
+                hashes[file_path] = hashlib.sha256(f.read()).hexdigest()
+        return hashes
+    return MerkleTree(list_files, hash_files)
+
+def write(root, relative_path:str, data:bytes) -> None:
+    file_path = os.path.join(root, *relative_path.split('/'))
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    stat = os.stat(file_path) if os.path.exists(file_path) else None
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    if stat is not None:
+        # the refresh finds changed files by their stat, make sure the mtime changes
+        os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+LIBRARY = {
+    'a.safetensors': b'a',
+    'x/b.safetensors': b'b',
+    'x/y/c.safetensors': b'c',
+    'z/d.safetensors': b'd',
+}
+
+@pytest.fixture
+def roots(tmp_path):
+    for name in ('local', 'server'):
+        for relative_path, data in LIBRARY.items():
+            write(tmp_path / name, relative_path, data)
+    return tmp_path / 'local', tmp_path / 'server'
+
+def refreshed(root) -> MerkleTree:
+    tree = make_tree(root)
+    tree.refresh()
+    return tree
+
+def test_equal_libraries_have_equal_digests(roots):
+    local, server = refreshed(roots[0]), refreshed(roots[1])
+    assert local.directory("")['digest'] == server.directory("")['digest']
+    assert local.directory("")['children'] == {'a.safetensors': [FILE, hashlib.sha256(b'a').hexdigest()],
+                                               'x': [DIRECTORY, local.directory("x")['digest']],
+                                               'z': [DIRECTORY, local.directory("z")['digest']]}
+
+def test_change_only_touches_ancestors(roots):
+    tree = refreshed(roots[0])
+    before = {directory: tree.directory(directory)['digest'] for directory in ("", "x", "x/y", "z")}
+    write(roots[0], 'x/y/c.safetensors', b'changed')
+    assert tree.refresh() == 1
+    after = {directory: tree.directory(directory)['digest'] for directory in ("", "x", "x/y", "z")}
+    assert [directory for directory in before if before[directory] != after[directory]] == ["", "x", "x/y"]
+
+def test_removed_files_remove_empty_directories(roots):
+    tree = refreshed(roots[0])
+    os.remove(os.path.join(roots[0], 'x', 'y', 'c.safetensors'))
+    assert tree.refresh() == 1
+    assert tree.directory("x/y") == {'digest': "", 'children': {}}
+    assert set(tree.directory("x")['children']) == {'b.safetensors'}
+    assert tree.directory("")['digest'] != refreshed(roots[1]).directory("")['digest']
+
+def test_name_and_kind_are_part_of_the_digest(tmp_path):
+    write(tmp_path / 'one', 'a', b'same')
+    write(tmp_path / 'two', 'b', b'same')
+    write(tmp_path / 'three', 'a/a', b'same')
+    digests = {refreshed(tmp_path / name).directory("")['digest'] for name in ('one', 'two', 'three')}
+    assert len(digests) == 3
+
+class FakeResponse:
+    def __init__(self, status_code:int, json_data:dict):
+        self.status_code = status_code
+        self.json_data = json_data
+        self.text = str(json_data)
+
+    def json(self) -> dict:
+        return self.json_data
+
+def connect(local:MerkleTree, server:MerkleTree, status_code:int = 200):
+    """
+    Returns a Connection which compares local with server, and the list of directory levels the server was asked for
+    """
+    connection = Connection('http://127.0.0.1:9/')
+    requested = []
+    def create_self_request(name:str, modeltype:str, paths:List[str], **kwargs) -> dict:
+        return {'success': True, 'directories': {path: local.directory(path) for path in paths}}
+    def post(url:str, data:dict, **kwargs) -> FakeResponse:
+        requested.append(list(data['paths']))
+        return FakeResponse(status_code, {'success': True, 'directories': {path: server.directory(path) for path in data['paths']}})
+    connection.create_self_request = create_self_request
+    connection.session.post = post
+    return connection, requested
+
+def test_diff_of_equal_trees_takes_one_request(roots):
+    connection, requested = connect(refreshed(roots[0]), refreshed(roots[1]))
+    assert connection.diff_model_tree('lora') == {'missing': [], 'different': [], 'extra': []}
+    assert requested == [[""]]
+
+def test_diff_descends_only_into_changed_directories(roots):
+    local_root, server_root = roots
+    write(local_root, 'x/y/c.safetensors', b'changed')
+    write(local_root, 'x/y/new.safetensors', b'new')
+    write(local_root, 'new/dir/e.safetensors', b'e')
+    os.remove(os.path.join(local_root, 'a.safetensors'))
+    write(server_root, 'z/only_on_server.safetensors', b's')
+    write(server_root, 'gone/f.safetensors', b'f')
+    connection, requested = connect(refreshed(local_root), refreshed(server_root))
+    diff = connection.diff_model_tree('lora')
+    assert sorted(diff['missing']) == ['new/dir/e.safetensors', 'x/y/new.safetensors']
+    assert diff['different'] == ['x/y/c.safetensors']
+    assert sorted(diff['extra']) == ['a.safetensors', 'gone/f.safetensors', 'z/only_on_server.safetensors']
+    # one request per directory level, only directories whose digests differ are requested
+    assert requested == [[""], ['gone', 'new', 'x', 'z'], ['new/dir', 'x/y']]
+
+def test_diff_accepts_original_hash_of_normalized_files(roots):
+    local, server = refreshed(roots[0]), refreshed(roots[1])
+    write(roots[1], 'a.safetensors', b'normalized')
+    server.refresh()
+    server_directory = server.directory
+    def directory_with_original(path:str) -> dict:
+        directory = server_directory(path)
+        if path == "":
+            directory['children']['a.safetensors'].append(hashlib.sha256(b'a').hexdigest())
+        return directory
+    server.directory = directory_with_original
+    connection, _ = connect(local, server)
+    assert connection.diff_model_tree('lora') == {'missing': [], 'different': [], 'extra': []}
+
+@pytest.mark.parametrize("status_code", [404, 405])
+def test_diff_without_merkle_endpoint(roots, status_code):
+    connection, _ = connect(refreshed(roots[0]), refreshed(roots[1]), status_code)
+    with pytest.raises(EndpointUnavailable):
+        connection.diff_model_tree('lora')
@@ -0,0 +1,77 @@
+import json
+import struct
+import pytest
+from scripts.safetensors_header import MAX_HEADER_SIZE, SafetensorsError, SafetensorsStreamValidator
+
+def make_safetensors(tensors:int = 2, elements:int = 16) -> bytes:
+    header = {f"t{i}": {'dtype': 'F32', 'shape': [elements], 'data_offsets': [i * elements * 4, (i + 1) * elements * 4]}
+              for i in range(tensors)}
+    header_bytes = json.dumps(header).encode('utf-8')
+    return struct.pack('<Q', len(header_bytes)) + header_bytes + b'\0' * (tensors * elements * 4)
+
+def feed(validator:SafetensorsStreamValidator, data:bytes, chunk_size:int) -> None:
+    for start in range(0, len(data), chunk_size):
+        validator.update(data[start:start + chunk_size])
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_valid_file(chunk_size):
+    data = make_safetensors()
+    validator = SafetensorsStreamValidator(len(data))
+    feed(validator, data, chunk_size)
+    validator.finish()
+    assert set(validator.header) == {'t0', 't1'}
+
+def test_truncated_header():
+    data = make_safetensors()
+    validator = SafetensorsStreamValidator()
+    feed(validator, data[:20], 3)
+    assert validator.header is None
+    with pytest.raises(SafetensorsError, match="complete safetensors header"):
+        validator.finish()
+
+def test_truncated_length_prefix():
+    validator = SafetensorsStreamValidator()
+    validator.update(b'\x10\0\0')
+    with pytest.raises(SafetensorsError):
+        validator.finish()
+
+def test_truncated_data():
+    data = make_safetensors()
+    validator = SafetensorsStreamValidator()
+    feed(validator, data[:-1], 64)
+    with pytest.raises(SafetensorsError, match="declares"):
+        validator.finish()
+
+def test_oversized_header_length():
+    # rejected from the first 8 bytes, the header itself is never buffered
+    validator = SafetensorsStreamValidator()
+    with pytest.raises(SafetensorsError, match="larger than"):
+        validator.update(struct.pack('<Q', MAX_HEADER_SIZE + 1))
+
+def test_header_declares_more_than_the_request():
+    data = make_safetensors()
+    with pytest.raises(SafetensorsError, match="request is only"):
+        feed(SafetensorsStreamValidator(max_size=len(data) - 1), data, 1 << 20)
+
+def test_header_does_not_match_declared_size():
+    data = make_safetensors()
+    with pytest.raises(SafetensorsError, match="upload size"):
+        feed(SafetensorsStreamValidator(declared_size=len(data) + 1), data, 1 << 20)
+
+def test_data_beyond_header_size():
+    data = make_safetensors()
+    validator = SafetensorsStreamValidator()
+    feed(validator, data, 64)
+    with pytest.raises(SafetensorsError, match="Received"):
+        validator.update(b'\0')
+
+@pytest.mark.parametrize("header", [
+    b'not json',
+    b'[]',
+    json.dumps({'t': {'dtype': 'F32', 'shape': [4], 'data_offsets': [0, 8]}}).encode('utf-8'), # shape does not match offsets
+    json.dumps({'t': {'dtype': 'F32', 'shape': [1], 'data_offsets': [4, 8]}}).encode('utf-8'), # gap before the data
+    json.dumps({'__metadata__': {'a': 1}}).encode('utf-8'),
+])
+def test_malformed_header(header):
+    with pytest.raises(SafetensorsError):
+        SafetensorsStreamValidator().update(struct.pack('<Q', len(header)) + header)
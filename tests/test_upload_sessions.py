@@ -0,0 +1,71 @@
+import os
+import pytest
+from scripts.hashes import compute_file_hash
+from scripts.upload_sessions import UploadSessionStore, merge_ranges
+
+@pytest.mark.parametrize("ranges, merged", [
+    ([], []),
+    ([[0, 10]], [[0, 10]]),
+    ([[20, 30], [0, 10]], [[0, 10], [20, 30]]), # out of order
+    ([[0, 10], [10, 20]], [[0, 20]]), # adjacent
+    ([[0, 15], [10, 20]], [[0, 20]]), # overlapping
+    ([[5, 8], [0, 20]], [[0, 20]]), # contained
+    ([[30, 40], [0, 10], [5, 35]], [[0, 40]]),
+])
+def test_merge_ranges(ranges, merged):
+    assert merge_ranges(ranges) == merged
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadSessionStore(lambda: [str(tmp_path)])
+
+def write(session, offset, data):
+    return session.write_range(offset, [data])
+
+def test_session_out_of_order_ranges(tmp_path, store):
+    data = os.urandom(1 << 18)
+    session = store.create(str(tmp_path), 'lora', 'test', 'test.bin', size=len(data))
+    assert session.missing() == [[0, len(data)]]
+    write(session, 200000, data[200000:])
+    write(session, 0, data[:50000])
+    assert session.ranges == [[0, 50000], [200000, len(data)]]
+    assert session.missing() == [[50000, 200000]]
+    assert session.received() == len(data) - 150000
+    assert not session.is_complete()
+    write(session, 50000, data[50000:200000])
+    assert session.ranges == [[0, len(data)]]
+    assert session.is_complete()
+    with open(tmp_path / 'expected.bin', 'wb') as f:
+        f.write(data)
+    # the ranges after the first one were not hashed in order, finish_hash reads them back
+    assert session.finish_hash() == compute_file_hash(str(tmp_path / 'expected.bin'))
+
+def test_session_overlapping_ranges(tmp_path, store):
+    data = os.urandom(100000)
+    session = store.create(str(tmp_path), 'lora', 'test', 'test.bin', size=len(data))
+    write(session, 10000, data[10000:60000])
+    write(session, 40000, data[40000:80000])
+    write(session, 0, data[:20000])
+    assert session.ranges == [[0, 80000]]
+    assert session.missing() == [[80000, 100000]]
+    assert session.received() == 80000
+    write(session, 80000, data[80000:])
+    assert session.is_complete()
+    with open(session.part_path, 'rb') as f:
+        assert f.read() == data
+
+def test_session_rejects_data_beyond_size(tmp_path, store):
+    session = store.create(str(tmp_path), 'lora', 'test', 'test.bin', size=1000)
+    with pytest.raises(ValueError):
+        session.write_range(900, [b'x' * 50, b'x' * 100])
+    # the chunk written before the error stays recorded
+    assert session.ranges == [[900, 950]]
+
+def test_session_state_is_reloaded(tmp_path, store):
+    session = store.create(str(tmp_path), 'lora', 'test', 'test.bin', size=1000)
+    write(session, 500, b'x' * 500)
+    reloaded = UploadSessionStore(lambda: [str(tmp_path)]).get(session.session_id)
+    assert reloaded.ranges == [[500, 1000]]
+    assert reloaded.missing() == [[0, 500]]
+    # an unfinished session of the same file is resumed
+    assert store.create(str(tmp_path), 'lora', 'test', 'test.bin', size=1000).session_id == session.session_id